@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# bench_compress.py
+#
+# CPU cost against bytes saved for data payload compression, on made up
+# traces of tap frames (ethernet + ip + tcp headers, then):
+#   http     - request/response headers and json bodies
+#   db       - replication stream, rows of mostly repeating fields
+#   logs     - syslog lines
+#   media    - already compressed (random bytes)
+#   mixed    - a tenth each of http, db and logs, the rest media
+# For each codec, 'always' compresses every frame and 'adaptive' is the
+# Compressor the router uses, which stops trying on traffic that doesn't
+# compress.  us/frame is the compression cost per frame, decompression is
+# timed separately for what was compressed.
+#
+# usage: python -m pylans.bench_compress [frames] [size]
+
+import json
+import os
+import random
+import sys
+from time import time
+
+from . import compress
+from .compress import Compressor
+
+
+def _header():
+    # ethernet, ipv4 and tcp headers, with the fields that vary random
+    return (os.urandom(12) + '\x08\x00' + '\x45\x00' + os.urandom(6)
+                + '\x40\x06' + os.urandom(10) + os.urandom(12) + '\x50\x18'
+                + os.urandom(6))
+
+def http(size):
+    body = json.dumps([{'id': random.randint(0, 1 << 20), 'name': 'user%d'
+                % random.randint(0, 999), 'active': random.random() < 0.5,
+                'tags': ['a', 'b', 'c'][:random.randint(0, 3)]}
+                for i in range(size // 60)])
+    text = ('HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+            'Cache-Control: no-cache\r\nConnection: keep-alive\r\n'
+            'Content-Length: %d\r\n\r\n' % len(body)) + body
+    return text
+
+def db(size):
+    rows = []
+    while sum(len(r) for r in rows) < size:
+        rows.append('I\x00\x00\x40\x01t\x00\x05' + os.urandom(4)
+                    + '\x00\x00\x00\x0bcustomer_%03d' % random.randint(0, 999)
+                    + '\x00\x00\x00\x06ACTIVE\x00\x00\x00\x08'
+                    + '2011-%02d-%02d' % (random.randint(1, 12),
+                                          random.randint(1, 28)))
+    return ''.join(rows)
+
+def logs(size):
+    lines = []
+    while sum(len(l) for l in lines) < size:
+        lines.append('<%d>Mar %2d %02d:%02d:%02d host%d sshd[%d]: Accepted '
+                    'publickey for user%d from 10.0.%d.%d port %d ssh2\n' % (
+                    random.randint(0, 191), random.randint(1, 31),
+                    random.randint(0, 23), random.randint(0, 59),
+                    random.randint(0, 59), random.randint(0, 9),
+                    random.randint(1000, 30000), random.randint(0, 99),
+                    random.randint(0, 255), random.randint(0, 255),
+                    random.randint(1024, 65535)))
+    return ''.join(lines)
+
+def media(size):
+    return os.urandom(size)
+
+def trace(kinds, n, size):
+    frames = []
+    for i in range(n):
+        kind = kinds[i % len(kinds)]
+        frames.append((_header() + kind(size))[:size])
+    return frames
+
+def run(frames, compressor):
+    out = []
+    t = time()
+    for f in frames:
+        out.append(compressor(f))
+    return time() - t, out
+
+def report(name, frames, dt, out):
+    z = [p for p in out if p is not None]
+    before = sum(len(f) for f in frames)
+    after = sum(len(p) if p is not None else len(f)
+                    for f, p in zip(frames, out))
+    t = time()
+    for p in z:
+        compress.decompress(p)
+    unz = time() - t
+    print '  %-16s %6.2f us/frame  %5.1f%% saved  %5.1f%% compressed' \
+          '  (%5.2f us to decompress)' % (name, dt * 1e6 / len(frames),
+                100.0 * (before - after) / before, 100.0 * len(z) / len(frames),
+                unz * 1e6 / len(frames))
+
+class _Always(object):
+    '''Compress everything, keep it if it's smaller'''
+    def __init__(self, codec):
+        self.head, self.compress = chr(compress.codecs[codec][0]), \
+                                        compress.codecs[codec][1]
+
+    def __call__(self, packet):
+        data = self.compress(packet)
+        return self.head + data if len(data) + 1 < len(packet) else None
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1400
+
+    traces = [('http', [http]), ('db', [db]), ('logs', [logs]),
+              ('media', [media]),
+              ('mixed', [http, db, logs] + [media] * 7)]
+    print 'codecs: %s' % ', '.join(compress.features)
+    for name, kinds in traces:
+        frames = trace(kinds, n, size)
+        print '%s, %d frames of %d bytes' % (name, n, size)
+        for codec in compress.features:
+            report('%s always' % codec, frames,
+                                    *run(frames, _Always(codec)))
+            report('%s adaptive' % codec, frames,
+                                    *run(frames, Compressor(codec)))
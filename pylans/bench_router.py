@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# bench_router.py
+#
+# Per-packet cost of the router's hot paths:
+#   recv - DATA packets (decrypted with a real session key, and with a no-op
+#          decode to see just the router's share) and clear control packets
+#          going through a registered handler
+#   send - tap frames to a known mac, through Router.send, through the
+#          cached SendContext (TapRouter.send_packet) and aggregated (with
+#          frames of size/8 or less), all really encrypted
+# The router is built by hand with just what those touch, no tap, no
+# sockets, no reactor.
+#
+# usage: python -m pylans.bench_router [packets] [size]
+
+import itertools
+import os
+import sys
+from struct import pack
+from time import time
+
+from .crypto import crypto
+from .packets import PacketType
+from .router import TapRouter, RouteMap, AggregatingSendContext
+
+
+class _Peer(object):
+    id = os.urandom(16)
+
+class _PeerManager(object):
+    _self = _Peer()
+
+    def get(self, id, default=None):
+        return default
+
+class _Multipath(object):
+    def live_paths(self, sid):
+        return []
+
+class _FEC(object):
+    groups = {}
+
+class _SessionManager(object):
+    def __init__(self, sid):
+        self.session_map = {sid: None}
+        self.crypter = crypto.Crypter(os.urandom(crypto.Crypter.key_size))
+
+    def encode(self, sid, data, lane=0, ad=''):
+        return self.crypter.encrypt(data, ad)
+
+    def encoders(self, sid):
+        return [self.crypter.encrypt]
+
+    def decode(self, sid, data, ad=''):
+        return self.crypter.decrypt(data, ad)
+
+    def send(self, data, sid, address):
+        pass
+
+def router(sid):
+    r = object.__new__(TapRouter)
+    r.pm = _PeerManager()
+    r.sm = _SessionManager(sid)
+    r.handlers = {}
+    r._dispatch = {}
+    r._send_ctx = {}
+    r.crypto_workers = 0
+    r.fragment_ids = itertools.count()
+    r.aggregate_delay = None
+    r.compression = False
+    r.multipath = _Multipath()
+    r.fec = _FEC()
+    r.addr_map = RouteMap(r._send_ctx)
+    r.recv_packet = lambda packet, src, address: None
+    r.register_handler(PacketType.PING, lambda *x: None)
+    return r
+
+def run(f, packets, *args):
+    t = time()
+    for p in packets:
+        f(p, *args)
+    return time() - t
+
+def report(name, n, dt):
+    print '%-10s %8d packets %8.0f packets/s %6.2f us/packet' % (name,
+                                                n, n / dt, dt * 1e6 / n)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1400
+
+    sid = os.urandom(16)
+    r = router(sid)
+    head = r.pm._self.id + sid
+    address = ('127.0.0.1', 8015)
+
+    # encrypt a handful and replay them, decrypt only looks at the iv
+    data = [pack('!2H', PacketType.DATA, 0) + head
+                + r.sm.crypter.encrypt(os.urandom(size)) for i in range(64)]
+    ping = [pack('!2H', PacketType.PING, 0) + head + 'x'*32] * 64
+    data = data * (n // len(data))
+    ping = ping * (n // len(ping))
+
+    report('recv DATA', len(data), run(r.recv, data, address))
+    decode, r.sm.decode = r.sm.decode, lambda sid, data, ad: data
+    report('recv DATA*', len(data), run(r.recv, data, address))
+    r.sm.decode = decode
+    report('recv PING', len(ping), run(r.recv, ping, address))
+
+    # tap frames to a peer's mac
+    mac = os.urandom(6)
+    route = (address, sid)
+    r.addr_map[mac] = route
+    frames = [mac + os.urandom(size - 6)] * n
+    send = lambda packet: r.send(PacketType.DATA, packet, route)
+    report('send', n, run(send, frames))
+    report('send ctx', n, run(r.send_packet, frames))
+
+    # small frames held until aggregate_size fills up
+    r.aggregate_delay = 0
+    r.aggregate_size = size
+    r.call_after_batch = lambda f: None
+    small = [mac + os.urandom(max(size // 8 - 6, 54))] * n
+    ctx = r._send_ctx[mac] = AggregatingSendContext(r, route)
+    dt = run(r.send_packet, small)
+    ctx.flush()
+    report('send agg', n, dt)
+    del r._send_ctx[mac]
+    r.aggregate_delay = None
+    report('send small', n, run(r.send_packet, small))
@@ -200,6 +200,14 @@ class Prompt(Cmd):
                 print '# of peers:  {0}'.format(len(net.router.pm))
                 print 'my vip       {0}'.format(net.router.pm._self.vip_str)
                 print 'my addr      {0}'.format(net.router.pm._self.addr_str)
+                nb = getattr(net.router, 'neighbours', None)
+                if nb is not None:
+                    print 'arp proxied  {0} (nd {1}, sent {2})'.format(
+                            nb.arp_suppressed, nb.nd_suppressed, nb.forwarded)
+                fec = net.router.fec
+                if fec.running or fec.recovered:
+                    print 'fec rebuilt  {0} ({1} groups lost, {2} peers)'.format(
+                            fec.recovered, fec.unrecoverable, len(fec.groups))
             else:
                 print 'network offline'
   
@@ -235,8 +243,8 @@ class Prompt(Cmd):
             if lt:
                 print '========= Peers ({0}:{1}) ========='.format(
                                     net.name, net.virtual_address)
-                print '{0:15}  {1:10}  {2:10}  {3:10}'.format(
-                        'vip', 'name', 'ping_time', 'relay')
+                print '{0:15}  {1:10}  {2:10}  {3:10}  {4:5}'.format(
+                        'vip', 'name', 'ping_time', 'relay', 'pmtu')
                 for p in sorted(self.iface.get_peer_list(net), key=sort_key):
                     if not p.is_direct:
                         rp = self.iface.get_peer_info(p.relay_id)
@@ -251,8 +259,9 @@ class Prompt(Cmd):
                     if( p.timeouts > 0 ):
                         to = '({0})'.format(p.timeouts)
                         
-                    print (' {0:15}  {1:10}  {2:<7.2f} {4:5} {3:10}'
-                        .format(p.vip_str, p.name, p.ping_time*1e3, relay, to))
+                    print (' {0:15}  {1:10}  {2:<7.2f} {4:5} {3:10}  {5:5}'
+                        .format(p.vip_str, p.name, p.ping_time*1e3, relay, to,
+                                p.pmtu or '-'))
             else:
                 print '========= Peers (%s) =========' % net.name
                 for p in sorted(self.iface.get_peer_list(net), key=sort_key):
@@ -273,6 +282,7 @@ class Prompt(Cmd):
                             print '  relay: error, could not lookup pid {0}' \
                                         .format(p.relay_id.encode('hex'))
                     print 'ping_time: {0:.3f} ms'.format(p.ping_time * 1e3)
+                    print 'pmtu:      {0}'.format(p.pmtu or 'unknown')
                     if not ls or p.timeouts > 0:
                         print 'timeouts:  {0}'.format(p.timeouts)
                     print
@@ -290,6 +300,75 @@ class Prompt(Cmd):
     def do_ls(self, line):
         self.do_list(line, ls=True)
 
+    def do_macs(self, line):
+        line = line.split()
+        if len(line) > 0:
+            nets = [ self.iface.get_network(net) for net in line ]
+        else:
+            nets = self.iface.get_network_list()
+
+        for net in (x for x in nets if x.router is not None and x.is_running):
+            print '========= Address Map ({0}) ========='.format(net.name)
+            print '{0:17}  {1:10}  {2:21}  {3:7}  {4:>6}  {5:>8}'.format(
+                    'addr', 'peer', 'address', 'type', 'idle', 'hits')
+            for addr, route, learned, idle, hits in net.router.addr_map.dump():
+                peer = net.router.pm.get(route[-1])
+                if len(addr) == 6:
+                    addr = util.decode_mac(addr)
+                else:
+                    addr = util.decode_ip(addr)
+                print '{0:17}  {1:10}  {2:21}  {3:7}  {4:>6.0f}  {5:>8}'.format(
+                        addr, peer.name if peer is not None else '-',
+                        '{0}:{1}'.format(*route[0]),
+                        'learned' if learned else 'peer', idle, hits)
+
+    def complete_macs(self, text, line, begidx, endidx):
+        nets = self.iface.get_network_names()
+        if not text:
+            return nets
+
+        return [ net for net in nets if net.startswith(text) ]
+
+    def help_macs(self):
+        print 'macs ([network])\n dump the address map (forwarding table) of'\
+                + ' specified or active networks\n'
+
+    def do_queues(self, line):
+        line = line.split()
+        if len(line) > 0:
+            nets = [ self.iface.get_network(net) for net in line ]
+        else:
+            nets = self.iface.get_network_list()
+
+        for net in (x for x in nets if x.router is not None and x.is_running):
+            sm = net.router.sm
+            print '========= Send Queues ({0}) ========='.format(net.name)
+            print 'dropped {0} datagrams{1}'.format(sm.dropped,
+                    ', shaping' if sm.shaping else '')
+            print '{0:10}  {1:7}  {2:>6}  {3:>8}  {4:>8}  {5:>7}'.format(
+                    'peer', 'traffic', 'queued', 'bytes', 'sent', 'dropped')
+            for sid, relayed, queued, size, sent, dropped in sm.queue_stats():
+                if sid is None:
+                    name, kind = '-', 'control'
+                else:
+                    peer = net.router.pm.get(sid)
+                    name = peer.name if peer is not None \
+                                        else sid.encode('hex')[:10]
+                    kind = 'relayed' if relayed else 'own'
+                print '{0:10}  {1:7}  {2:>6}  {3:>8}  {4:>8}  {5:>7}'.format(
+                        name, kind, queued, size, sent, dropped)
+
+    def complete_queues(self, text, line, begidx, endidx):
+        nets = self.iface.get_network_names()
+        if not text:
+            return nets
+
+        return [ net for net in nets if net.startswith(text) ]
+
+    def help_queues(self):
+        print 'queues ([network])\n show outgoing queue depths and drops per'\
+                + ' peer of specified or active networks\n'
+
     def do_msg(self, line):
         # this doesn't work if the network as a '@' in it
         name = line.split()[0]
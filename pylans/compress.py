@@ -0,0 +1,143 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# compress.py
+#
+# Compression for data payloads, before they're encrypted.  A compressed
+# payload is [codec-1B][compressed frame(s)], sent as a DATA (AGGREGATE,
+# MULTIPATH) packet with the COMPRESSED bit set in its type, which is
+# authenticated along with the payload (see router._ad).  Peers say which
+# codecs they take in their features, zlib always and lz4 if it's installed.
+#
+# Whether to bother is decided per packet and learned per flow.  A packet
+# whose last 64 bytes are nearly all different is already compressed (or
+# encrypted) and left alone.  And a Compressor keeps a moving average of how
+# well its flow's packets compressed, when that's poor it stops trying for a
+# while, backing off further each time the traffic still doesn't compress.
+
+from struct import Struct
+import zlib
+from .packets import PacketType
+
+try:
+    import lz4.block as _lz4
+except ImportError:
+    try:
+        import lz4 as _lz4 # older python-lz4
+    except ImportError:
+        _lz4 = None
+
+# type bit for data packets with compressed payloads
+PacketType.add(COMPRESSED=0x40)
+
+ZLIB = 1
+LZ4 = 2
+
+# nothing we send decompresses to more than this
+MAX_SIZE = 0x10000
+
+# codec name -> (id, compress)
+codecs = {'zlib': (ZLIB, lambda data: zlib.compress(data, 1))}
+_decompress = {ZLIB: lambda data: zlib.decompressobj().decompress(data,
+                                                                MAX_SIZE)}
+if _lz4 is not None:
+    codecs['lz4'] = (LZ4, _lz4.compress)
+
+    _lz4_size = Struct('<I').unpack_from
+
+    def _lz4_decompress(data):
+        # size first, so nothing can make us allocate too much
+        if len(data) < 4 or _lz4_size(data)[0] > MAX_SIZE:
+            return None
+        return _lz4.decompress(data)
+    _decompress[LZ4] = _lz4_decompress
+
+# for Router.features, best first
+features = tuple(c for c in ('lz4', 'zlib') if c in codecs)
+
+
+def decompress(payload):
+    '''The frame(s) in a compressed payload, or None if it's no good'''
+    try:
+        return _decompress[ord(payload[0])](payload[1:])
+    except Exception:
+        # unknown codec, zlib.error, and lz4 raises its own
+        return None
+
+def pick(theirs, codec='auto'):
+    '''Name of the codec to send with, given a peer's features (and the
+    compress_codec option), or None'''
+    if codec != 'auto':
+        return codec if codec in codecs and codec in theirs else None
+    for c in features:
+        if c in theirs:
+            return c
+    return None
+
+
+class Compressor(object):
+    '''
+    Compresses one flow's payloads, when it's worth it.  Calling it returns
+    the compressed payload, or None to send the packet as it is.
+    '''
+    __slots__ = ('head', 'compress', 'min_size', 'ratio', 'skip', 'backoff',
+                 'tried', 'saved')
+
+    ALPHA = 0.1         # weight of each packet in the moving average
+    SAMPLE = 64         # bytes looked at for the entropy check
+    DISTINCT = 48       # random data has ~57 different bytes in 64
+    GOOD = 0.9          # worth it below this ratio (compressed / original)
+    MAX_BACKOFF = 1024  # most packets to skip between tries
+
+    def __init__(self, codec, min_size=128):
+        id, self.compress = codecs[codec]
+        self.head = chr(id)
+        self.min_size = min_size
+        # compressed/original size, moving average
+        self.ratio = 0.5
+        # packets left to skip before trying again, and how many next time
+        self.skip = 0
+        self.backoff = 8
+        # for the curious: packets compressed, and bytes that saved
+        self.tried = 0
+        self.saved = 0
+
+    def __call__(self, packet):
+        size = len(packet)
+        if size < self.min_size:
+            return None
+        if self.skip:
+            self.skip -= 1
+            return None
+        if len(set(packet[-self.SAMPLE:])) > self.DISTINCT:
+            return None
+
+        data = self.compress(packet)
+        self.tried += 1
+        ratio = float(len(data) + 1) / size
+        self.ratio += self.ALPHA * (ratio - self.ratio)
+        if self.ratio >= self.GOOD:
+            # not compressible, leave it alone for a while
+            self.skip = self.backoff
+            self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+            # give it a fair chance when we try again
+            self.ratio = self.GOOD - self.ALPHA
+        elif ratio < self.GOOD:
+            self.backoff = 8
+        if ratio >= 1.0:
+            return None
+        self.saved += size - len(data) - 1
+        return self.head + data
@@ -1 +1,2 @@
-from .crypto import Crypter
+from .crypto import Crypter, AuthenticationError
+from . import suites
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# bench_pake.py
+#
+# The CPU one side of a handshake costs (a whole handshake between two
+# sides, halved), for each PAKE a handshake1 can carry: JPAKE (one, two and
+# three) with each parameter set, with and without its fixed-base table, and
+# SPAKE2 over edwards25519 (one and two).  Also the security level and the
+# handshake1 and handshake2 sizes, with a signer id like the session
+# manager's.  The tables are built before timing (bench_jpake times that).
+#
+# usage: python -m pylans.crypto.bench_pake [seconds]
+
+import sys
+import timeit
+
+from .jpake import jpake
+from . import spake2
+
+ID = 'f' * 32 + ':aes256-ctr-hmac,aes256-ctr'
+
+def _jpake(params):
+    def both():
+        # a whole handshake, both sides
+        jA = jpake.JPAKE('password', params=params, signerid=ID + 'A')
+        jB = jpake.JPAKE('password', params=params, signerid=ID + 'B')
+        m1A, m1B = jA.one(), jB.one()
+        m2A, m2B = jA.two(m1B), jB.two(m1A)
+        jA.three(m2B), jB.three(m2A)
+        return len(jA.pack_one(m1A)), len(jA.pack_two(m2A))
+    return both
+
+def _spake2():
+    jA = spake2.SPAKE2('password', signerid=ID + 'A')
+    jB = spake2.SPAKE2('password', signerid=ID + 'B')
+    m1A, m1B = jA.one(), jB.one()
+    jA.two(m1B), jB.two(m1A)
+    return len(jA.pack_one(m1A)), 0
+
+def best(f, seconds):
+    t = timeit.Timer(f)
+    n = 1
+    while t.timeit(n) < seconds / 10 and n < 100000:
+        n *= 2
+    return min(t.repeat(3, n)) / n
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+
+    pakes = []
+    for name, params, bits in (('params_80', jpake.params_80, 80),
+                               ('params_112', jpake.params_112, 112),
+                               ('params_128', jpake.params_128, 128)):
+        jpake.table(params)
+        pakes.append(('jpake %s' % name, bits, False, _jpake(params)))
+        pakes.append(('  + table', bits, True, _jpake(params)))
+    spake2.table(spake2.G)
+    spake2.table(spake2.S)
+    pakes.append(('spake2 ed25519', 128, True, _spake2))
+
+    print '%-18s %4s %12s %6s %6s' % ('', 'bits', 'per side', 'hs1', 'hs2')
+    for name, bits, tables, both in pakes:
+        jpake.use_tables = tables
+        hs1, hs2 = both()
+        t = best(both, seconds) / 2
+        print '%-18s %4d %9.2f ms %6d %6s' % (name, bits, t * 1e3, hs1,
+                                              hs2 or '-')
+    jpake.use_tables = True
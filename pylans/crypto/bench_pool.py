@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# bench_pool.py
+#
+# Packets/sec through Crypter on the calling thread vs. a CryptoPool with n
+# workers, encrypting and then decrypting batches for one session the way
+# the router does.  Also shows the cpu time the calling (reactor) process
+# spent per packet, which is what the pool takes off the reactor, and checks
+# that everything comes back intact and in order.  The pool only wins on
+# wall clock with spare cores.
+#
+# usage: python -m pylans.crypto.bench_pool [packets] [size] [workers ...]
+
+import os
+import resource
+import sys
+from time import time
+
+from twisted.internet import reactor
+
+from .crypto import Crypter
+from .pool import CryptoPool
+
+BATCH = 64
+IN_FLIGHT = 32
+
+def cpu():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+def run_local(key, packets):
+    c = Crypter(key)
+    t, c0 = time(), cpu()
+    for i in xrange(0, len(packets), BATCH):
+        for p in packets[i:i+BATCH]:
+            c.decrypt(c.encrypt(p))
+    return time() - t, cpu() - c0
+
+def run_pool(key, packets, workers):
+    sid = os.urandom(16)
+    local = Crypter(key)
+    pool = CryptoPool(workers)
+    pool.start()
+    # both ends are us
+    pool.open(sid, key, Crypter.name, sid)
+    batches = [packets[i:i+BATCH] for i in xrange(0, len(packets), BATCH)]
+    state = {'next': 0, 'done': 0, 'ok': True}
+
+    def decrypted(out, batch):
+        state['ok'] = state['ok'] and out == batch
+        state['done'] += 1
+        if state['done'] == len(batches):
+            reactor.stop()
+        else:
+            submit()
+
+    def encrypted(out, batch):
+        # make sure the pool's ciphertext is good, then decrypt it there
+        state['ok'] = state['ok'] and local.decrypt(out[0]) == batch[0]
+        pool.decrypt(sid, out, lambda out: decrypted(out, batch))
+
+    def submit():
+        if state['next'] < len(batches):
+            batch = batches[state['next']]
+            state['next'] += 1
+            pool.encrypt(sid, batch, lambda out: encrypted(out, batch))
+
+    def start():
+        state['t'], state['cpu'] = time(), cpu()
+        for i in range(IN_FLIGHT):
+            submit()
+
+    reactor.callWhenRunning(start)
+    reactor.run(installSignalHandlers=False)
+    dt, dcpu = time() - state['t'], cpu() - state['cpu']
+    pool.stop()
+    return dt, dcpu, state['ok']
+
+def report(name, n, size, dt, dcpu, extra=''):
+    print '%-10s %8.0f packets/s %7.1f MB/s %6.2f us cpu/packet %s' % (name,
+                    n / dt, n * size / dt / 2**20, dcpu * 1e6 / n, extra)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1400
+    workers = [int(x) for x in sys.argv[3:]] or [1, 2, 4]
+
+    key = os.urandom(Crypter.key_size)
+    packets = [os.urandom(size) for i in range(BATCH)] * (n // BATCH)
+    n = len(packets)
+
+    report('local', n, size, *run_local(key, packets))
+    # the reactor can only run once, the rest get their own process
+    for w in workers:
+        pid = os.fork()
+        if pid == 0:
+            dt, dcpu, ok = run_pool(key, packets, w)
+            report('%d workers' % w, n, size, dt, dcpu, 'ok' if ok else 'BAD')
+            sys.stdout.flush()
+            os._exit(0)
+        os.waitpid(pid, 0)
@@ -16,233 +16,99 @@
 #
 #
 # crypto.py
-# TODO: make pycrypto and pycryptopp consistent wrt CTR counters
-# TODO: cython?
+#
+# Session encryption.  The cipher suites sessions pick from are in suites.py,
+# the aes ctr ones are here.
 
 # import python modules
-import cPickle as pickle
-import hashlib
-import struct
 from binascii import hexlify, unhexlify
-import hmac
 import os
 import logging
 
 logger = logging.getLogger(__name__)
 
 # encryption classes
-try:
-    from Crypto.Cipher import AES, Blowfish
-    from Crypto.Hash import SHA256
-    from Crypto.PublicKey import RSA
-except ImportError:
-    AES = None
-
 try:
     from pycryptopp.cipher import aes
-    from pycryptopp.hash import sha256
 except ImportError:
     aes = None
-    if AES is None:
-        logger.critical('No encryption modules found, exiting...')
-        exit(1)
-    else:
-        logger.warning('No pycryptopp found, trying to use pycrypto...')
-
-
-
-## PyCrypto's CTR mode requires a custom counter
-class _Counter(object):
-    def __init__(self, n=0, maxn=0xEFFFFFFFFFFFFFFF, salt=None, iv=None):
-        salt = salt or os.urandom(8)
-        if iv is None:
-            self.n = n
-            self.salt = salt
-        else:
-            self.n = struct.unpack('<Q',iv[8:])[0]
-            self.salt = iv[:8]
-        self.maxn = maxn
-
-    def __call__(self):
-        iv = struct.pack('<Q',self.n) + self.salt
-        self.inc()
-        return iv
-
-    def inc(self):
-        self.n += 1
-        if self.n == self.maxn:
-            self.n = 0
-            self.salt = os.urandom(8)
-
-    def iv(self):
-        return struct.pack('<Q',self.n) + self.salt
-
-class _BCounter(object):
-    def __init__(self, n=0, maxn=0xEFFFFFFFFFFFFFFF, salt=os.urandom(8), iv=None):
-        if iv is None:
-            self._iv = bytearray(struct.pack('<Q',n) + salt)
-        else:
-            self._iv = bytearray(iv)
-
-    def __call__(self):
-        iv = bytes(self._iv)
-        self.inc()
-        return iv
-
-    def iv(self):
-        return str(self._iv)
-
-    def inc(self):
-        j = 0
-        while self._iv[j] == 0xff:
-            if j == 15: # reset at  2^15
-                self._iv = bytearray('\x00'*8 + os.urandom(8))
-            else:
-                j += 1
-        self._iv[j] += 1
-
-# testing cython stuff
-try:
-    from cutil import Counter, BCounter
-    from cutil import AESCrypterPP2
-#    print 'using cython'
-    logger.debug('using cython counters')
-except ImportError, e:
-    logger.debug('could not import cython counters, using python ones')
-#    print e
-    Counter = _Counter
-    BCounter = _BCounter
-
-    # test pycryptopp, using one object for all encryptions.  need to keep track of count/position
-    # faster encryption, slower decryption
-    class AESCrypterPP2(object):
-        '''aes in ctr mode with one object for all encrypts, new object for decrypts'''
-        block_size = 16
-        key_size = 16
-        def __init__(self, key): #pycryptopp uses CTR mode
-            self.key = hashlib.md5(key).digest()
-            self.pos_q = 0
-            self.pos_r = 0
-            self.pos_sz = 17
-            self.iv_salt = os.urandom(8) # Added salt, to make it resistant against stream cipher attacks (repeated IV+key = very bad)
-            self.obj = aes.AES(self.key, iv=self.iv_salt+'\x00'*8)
-
-        def encrypt(self, string):
-            # need to reset before 64-bit counter overflows
-            if self.pos_q > 0xEFFFFFFFFFFFFFFF:
-                self._reset()
 
-            l = len(string)
-            iv = chr(self.pos_r) + self.iv_salt + struct.pack('>Q', self.pos_q)
 
-            # keep track of pos
-            self.pos_q += (self.pos_r + l) // 16
-            self.pos_r = (self.pos_r + l) % 16
-            return self.obj.process(string) + iv
+class AuthenticationError(Exception): pass
 
-        def decrypt(self, string):
-            # create a CTR obj with the right iv, then process stream to starting spot
-            r, iv = ord(string[-self.pos_sz]), string[-self.pos_sz+1:]
-            e = aes.AES(self.key, iv=iv)
-            e.process('\x00'*r)
-            return e.process(string[:-self.pos_sz])
 
-        def _reset(self):
-            # re-salt & reset counter
-            self.pos_q = 0
-            self.pos_r = 0
-            self.iv_salt = os.urandom(8)
-            self.obj = aes.AES(self.key, iv=self.iv_salt+'\x00'*8)
-
-
-def hmac_authentication(auth_f, cauth_f):
+class _Suite(object):
     '''
-    Class decorator to add hmac authentication.
-        auth_f - encoding function to authenticate (takes and returns string)
-        cauth_f - decoding function to check authentication (takes and returns string)
+    What every cipher suite has: encrypt/decrypt for one packet, and
+    encrypt_many/decrypt_many for a batch.  Packets that fail to decrypt (or
+    authenticate) come back empty from decrypt_many, decrypt raises.
+
+    ad is associated data (the packet's header), authenticated along with
+    the packet but not sent in it, so decrypt needs the same ad that
+    encrypt got.  The _many calls take a list of them, one per packet.
+    Suites that don't authenticate ignore it.
     '''
-    def wrapper(cls):
-        init = getattr(cls, '__init__')
-        enc = getattr(cls, auth_f)
-        dec = getattr(cls, cauth_f)
-        def new_init(self, key):
-            init(self, key)
-            self.hmac = hashlib.md5
-            self.hmac_key = self.hmac(self.key).digest() # probably not secure
-            self.sig_size = self.hmac().digest_size
-
-        def auth(self, data):
-            data = enc(self, data)
-            sig = hmac.new(self.hmac_key, data, self.hmac).digest()
-            return data + sig
-
-        def check_auth(self, data):
-            data, sig = data[:-self.sig_size], data[-self.sig_size:]
-            if hmac.new(self.hmac_key, data, self.hmac).digest() != sig:
-                raise AuthenticationError("message authentication failed")
-            return dec(self, data)
-
-        setattr(cls, '__init__', new_init)
-        setattr(cls, auth_f, auth)
-        setattr(cls, cauth_f, check_auth)
-        return cls
-    return wrapper
-
-# a little faster than above hmac
-@hmac_authentication('encrypt','decrypt')
-class AESCrypterPP4(AESCrypterPP2):
-    '''aes in ctr mode with one object for all encrypts, new object for decrypts. hmac authentican, abstracted'''
-    pass
-#    __metaclass__ = HMACAuthentication
-
-
-#print AESCrypterPP2
-# test pycrypto, using one object for all encryptions.  need to keep track of count/position
-# very slow (because it relies on python counter instead of using its own (fixed in newer pycrypto))
-class AESCrypter3(object):
-    '''aes in ctr mode with one object for all encrypts, new object for decrypts'''
-    block_size = 16
-    key_size = 16
-    def __init__(self, key):
-        self.key = hashlib.md5(key).digest()
-        self.counter = Counter()
-        self.pos_sz = 16
-        self.obj = AES.new(self.key, AES.MODE_CTR, counter=self.counter)
-
-    def encrypt(self, string):
-        iv = self.counter.iv()
-        pad = self.block_size - len(string) % self.block_size
-        string = string + pad * chr(pad)
-
-        return self.obj.encrypt(string) + iv
-
-    def decrypt(self, string):
-        iv = string[-self.pos_sz:]
-        e = AES.new(self.key, AES.MODE_CTR, counter=Counter(iv=iv))
-        string = e.decrypt(string[:-self.pos_sz])
-        return string[:-ord(string[-1])]
-
+    name = None
+    # bytes encrypt adds to a packet
+    overhead = 0
+    # whether decrypt catches tampering
+    authenticated = False
+
+    def encrypt_many(self, packets, ads=None):
+        encrypt = self.encrypt
+        if ads is None:
+            return [encrypt(p) for p in packets]
+        return [encrypt(p, ad) for p, ad in zip(packets, ads)]
+
+    def decrypt_many(self, packets, ads=None):
+        decrypt = self.decrypt
+        if ads is None:
+            ads = [''] * len(packets)
+        out = []
+        for p, ad in zip(packets, ads):
+            try:
+                out.append(decrypt(p, ad))
+            except Exception:
+                out.append('')
+        return out
+
+
+# keystream to skip to get to a byte offset in a counter block
+_ZEROS = ['\x00'*i for i in range(16)]
 
 # test pycryptopp, using one object for all encryptions.  need to keep track of count/position
 # faster encryption, slower decryption
-class _Crypter0(object):
+class _Crypter0(_Suite):
     '''aes 128 (pycryptopp) in ctr mode'''
     block_size = 16
     key_size = 16
-    def __init__(self, key, can_rollover=False, callback=None, args=None): #pycryptopp uses CTR mode
+    overhead = block_size + 1
+    def __init__(self, key, can_rollover=False, callback=None, args=None,
+                    lane=0, lanes=1, ours=None, theirs=None):
+        #pycryptopp uses CTR mode
+        '''lane/lanes split the counter space into disjoint slices, so several
+        objects can encrypt with the same key (ie: one per tap queue) without
+        ever reusing keystream.  decrypt only needs the IV, so the other side
+        doesn't care.  ours/theirs (the sides' ids) are for the suites that
+        key each direction apart, this one uses key both ways.'''
         assert len(key) == self.key_size, "Invalid key size"
+        assert 0 <= lane < lanes, "Invalid lane"
         self.key = key
+        # what decrypt takes the other side's packets with
+        self.rx_key = key
         self.can_rollover = can_rollover
         self.callback = callback
         self.args = args or ()
-        self.pos_q = 0
-        self.max_q = int(hexlify('\xFF'*(self.block_size-2)), 16)
+        span = (int(hexlify('\xFF'*(self.block_size-2)), 16) + 1) // lanes
+        self.min_q = span * lane
+        self.pos_q = self.min_q
+        self.max_q = self.min_q + span - 1
         self.pos_r = 0
         self.pos_sz = self.block_size + 1
         self.__fmt = '%%0.%dx'%(self.block_size*2)
-        self.obj = aes.AES(self.key, iv='\x00'*self.block_size)
+        self.obj = aes.AES(self.key, iv=unhexlify(self.__fmt%self.min_q))
 
-    def encrypt(self, string):
+    def encrypt(self, string, ad=''):
         # need to reset before 64-bit counter overflows
         if self.pos_q > self.max_q:
             self._reset()
@@ -255,31 +121,61 @@ class _Crypter0(object):
         self.pos_r = (self.pos_r + l) % self.block_size
         return self.obj.process(string) + iv
 
-    def decrypt(self, string):
-        # create a CTR obj with the right iv, then process stream to starting spot
-        r, iv = ord(string[-self.pos_sz]), string[-self.pos_sz+1:]
+    def encrypt_many(self, packets, ads=None):
+        # one pass over the keystream for the lot, then cut it up
+        if self.pos_q > self.max_q:
+            self._reset()
 
-        e = aes.AES(self.key, iv=iv)
-        e.process('\x00'*r)
-        return e.process(string[:-self.pos_sz])
+        fmt, bs = self.__fmt, self.block_size
+        q, r = self.pos_q, self.pos_r
+        ivs = []
+        for p in packets:
+            ivs.append(chr(r) + unhexlify(fmt%q))
+            l = r + len(p)
+            q += l // bs
+            r = l % bs
+        self.pos_q, self.pos_r = q, r
+
+        data = self.obj.process(''.join(packets))
+        out = []
+        i = 0
+        for p, iv in zip(packets, ivs):
+            j = i + len(p)
+            out.append(data[i:j] + iv)
+            i = j
+        return out
+
+    def decrypt(self, string, ad=''):
+        # create a CTR obj with the right iv, then process stream to starting
+        # spot.  pycryptopp can't seek or take a new iv.  A new object, key
+        # schedule and all, costs about 1us, no more than keeping objects
+        # around at the spot the sender's next packet starts would
+        n = len(string) - self.pos_sz
+        e = aes.AES(self.rx_key, iv=string[n+1:])
+        r = ord(string[n])
+        if r:
+            e.process(_ZEROS[r])
+        return e.process(string[:n])
 
     def _reset(self):
         # re-salt & reset counter
         if self.callback is None:
             if self.can_rollover:
-                self.pos_q = 0
+                self.pos_q = self.min_q
                 self.pos_r = 0
-                self.obj = aes.AES(self.key, iv='\x00'*self.block_size)
+                self.obj = aes.AES(self.key, 
+                                   iv=unhexlify(self.__fmt%self.min_q))
             else:
                 raise ValueError, 'AES counter rolled over'
 
         else:
             # so we don't keep calling this function over and over
             self.max_q = self.max_q << 1
-            self.callback(self, *args)
+            self.callback(*self.args)
 
 class _Crypter1(_Crypter0):
     '''aes 256 (pycryptopp) in ctr mode'''
+    name = 'aes256-ctr'
     key_size = 32
     block_size = 16
 
@@ -287,46 +183,6 @@ class _Crypter1(_Crypter0):
 if aes is not None:
     Crypter = _Crypter1
 else:
+    logger.critical('No encryption modules found (pycryptopp)')
     raise ImportError, 'missing pycryptopp'
-    #Crypter = AESCrypter3
-
-
-if __name__ == "__main__":
-    # test some speeeeeeeds
-    key = os.urandom(56)
-
-    data = os.urandom(1023)
-    tmax = 5
-
-    from time import time
-    lchr = chr # local function lookups are faster than global function lookups
-#    clses = [AESCrypterPP, AESCrypterPP2, AESCrypterPP3, AESCrypterPP4,
-#                AESCrypter, AESCrypter2, AESCrypter3, BFCrypter]
-    clses = [_Crypter0,_Crypter1]
-    for cls in clses:
-        e = cls(key[:cls.key_size])
-        pd = []
-        print "Testing speed {0} ({1})".format(e.__class__.__name__,e.__class__.__doc__)
-        t1 = time()
-        n = 0
-        enc = e.encrypt # dot reference lookups are costly
-        ap = pd.append
-        while True:
-            for i in xrange(200):
-                ap(enc(lchr(i)+data))
-#                ap(enc(data))
-            n += 200
-            t2 = time()
-            if t2 - t1 > tmax:
-                break
-        print "%d MB encrypted in %0.1f seconds: %0.1f MB/s" % (n/1024., t2-t1, n/(t2-t1)/1024. )
-        t1 = time()
 
-        dec = e.decrypt
-        for blk in pd:
-            dec(blk)
-        #map(dec, pd) - slower
-        n = len(pd)
-        t2 = time()
-        print "%d MB decrypted in %0.1f seconds: %0.1f MB/s" % (n/1024., t2-t1, n/(t2-t1)/1024. )
-        print
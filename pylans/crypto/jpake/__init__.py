@@ -1,8 +1,10 @@
 
 from jpake import JPAKE, JPAKEError, params_80, params_112, params_128
 from jpake import DuplicateSignerID, BadZeroKnowledgeProof, GX4MustNotBeOne
+from jpake import FixedBase, table
 _hush_pyflakes = [JPAKE, JPAKEError, params_80, params_112, params_128,
-                  DuplicateSignerID, BadZeroKnowledgeProof, GX4MustNotBeOne]
+                  DuplicateSignerID, BadZeroKnowledgeProof, GX4MustNotBeOne,
+                  FixedBase, table]
 del _hush_pyflakes
 
 try:
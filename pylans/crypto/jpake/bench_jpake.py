@@ -1,6 +1,7 @@
 
-import timeit, sys
-from jpake import JPAKE, params_80, params_112, params_128
+import timeit, sys, tempfile, shutil
+import jpake
+from jpake import JPAKE, FixedBase, params_80, params_112, params_128
 hush_pyflakes = [params_80, params_112, params_128]
 
 class Harness:
@@ -23,6 +24,31 @@ class Harness:
 
 h = Harness()
 
+def best(f, repeat=3):
+    # seconds per call, best of repeat runs of enough calls to take ~0.2s
+    t = timeit.Timer(f)
+    n = 1
+    while t.timeit(n) < 0.2 and n < 100000:
+        n *= 10
+    return min(t.repeat(repeat, n)) / n
+
+def table_times(params):
+    # building the fixed-base table, and reading it back from a file
+    g, p = params.g, params.p
+    bits = len("%x" % params.q) * 4
+    d = tempfile.mkdtemp()
+    try:
+        build = best(lambda: FixedBase(g, p, bits).save(d), 1)
+        load = best(lambda: FixedBase.load(d, g, p, bits), 1)
+    finally:
+        shutil.rmtree(d)
+    return build, load
+
+def show(t):
+    if t < 1e-3:
+        return "%.1f usec" % (t * 1e6)
+    return "%.1f msec" % (t * 1e3)
+
 if __name__ == "__main__":
     if len(sys.argv) == 1:
         all_params = ["params_80", "params_112", "params_128"]
@@ -32,24 +58,33 @@ if __name__ == "__main__":
         all_params = [params]
         all_names = [name]
     for params in all_params:
+        build, load = table_times(getattr(jpake, params))
+        print "%s table: build+save %s, load %s" % (params, show(build),
+                                                    show(load))
         for name in all_names:
-            print "%s %s:" % (params, name),
-            timeit.main(["--setup",
-                         ("import bench_jpake; "
-                          "bench_jpake.h.setup(bench_jpake.%s)" % params),
-                         "bench_jpake.h.%s()" % name,
-                         ])
-            
-# % python jpake/bench_jpake.py 
-# params_80 construct: 100000 loops, best of 3: 14.9 usec per loop
-# params_80 one: 10 loops, best of 3: 38.9 msec per loop
-# params_80 two: 10 loops, best of 3: 66.3 msec per loop
-# params_80 three: 10 loops, best of 3: 48.1 msec per loop
-# params_112 construct: 100000 loops, best of 3: 14.6 usec per loop
-# params_112 one: 10 loops, best of 3: 184 msec per loop
-# params_112 two: 10 loops, best of 3: 295 msec per loop
-# params_112 three: 10 loops, best of 3: 219 msec per loop
-# params_128 construct: 100000 loops, best of 3: 13.5 usec per loop
-# params_128 one: 10 loops, best of 3: 424 msec per loop
-# params_128 two: 10 loops, best of 3: 659 msec per loop
-# params_128 three: 10 loops, best of 3: 495 msec per loop
+            # (one() leaves jA fit only for another one())
+            jpake.use_tables = False
+            h.setup(getattr(jpake, params))
+            without = best(getattr(h, name))
+            jpake.use_tables = True
+            h.setup(getattr(jpake, params))
+            tables = best(getattr(h, name))
+            print "%s %s: %s, with table %s (x%.1f)" % (params, name,
+                        show(without), show(tables), without / tables)
+
+# % python jpake/bench_jpake.py
+# params_80 table: build+save 33.5 msec, load 6.0 msec
+# params_80 construct: 3.3 usec, with table 3.3 usec (x1.0)
+# params_80 one: 3.5 msec, with table 419.7 usec (x8.4)
+# params_80 two: 6.1 msec, with table 4.5 msec (x1.4)
+# params_80 three: 4.5 msec, with table 4.4 msec (x1.0)
+# params_112 table: build+save 153.1 msec, load 23.1 msec
+# params_112 construct: 3.2 usec, with table 3.6 usec (x0.9)
+# params_112 one: 21.6 msec, with table 1.7 msec (x12.7)
+# params_112 two: 29.0 msec, with table 21.3 msec (x1.4)
+# params_112 three: 24.5 msec, with table 20.1 msec (x1.2)
+# params_128 table: build+save 374.3 msec, load 46.2 msec
+# params_128 construct: 3.7 usec, with table 6.2 usec (x0.6)
+# params_128 one: 48.8 msec, with table 4.5 msec (x10.9)
+# params_128 two: 58.1 msec, with table 37.8 msec (x1.5)
+# params_128 three: 43.4 msec, with table 41.7 msec (x1.0)
@@ -1,5 +1,5 @@
 
-import os, binascii
+import os, binascii, marshal
 from hashlib import sha256, sha1
 try:
     import json
@@ -117,6 +117,129 @@ def randrange(order, entropy):
                        " is very wrong or you got realllly unlucky. Order was"
                        " %x" % order)
 
+# Fixed-base exponentiation. All the pow(g, x, p) calls (two in one(), one
+# in each createZKP() and checkZKP() with g as the generator) use the same g
+# and p, with x < q. So for each parameter set we build a table of
+# g**(d << window*i) % p for every window-bit digit d and position i, once,
+# and then g**x is one multiply per window bits of x instead of a square per
+# bit and then some. With window=8 that's 10-14 times faster, for tables of
+# 0.6MB (params_80) to 3MB (params_128) that take 30ms to 300ms to build.
+# Set table_dir to keep built tables in files there and load them next time.
+# The tables live here, not on Params, so pickled instances stay small.
+
+WINDOW = 8
+table_dir = None
+use_tables = True # (off to compare)
+_tables = {} # (p, g) -> FixedBase
+
+class FixedBase:
+    """pow(base, e, p) from a table of base**(d << window*i) % p, for
+    exponents below 2**bits (bigger or negative ones use pow())."""
+    def __init__(self, base, p, bits, window=WINDOW, rows=None):
+        self.base = base
+        self.p = p
+        self.bits = bits
+        self.window = window
+        if rows is None:
+            rows = []
+            b = base
+            for i in range((bits + window - 1) // window):
+                row = [1, b]
+                for d in range(2, 1 << window):
+                    row.append(row[-1] * b % p)
+                rows.append(row)
+                b = row[-1] * b % p
+        self.rows = rows
+
+    def pow(self, e):
+        if e < 0 or e >> self.bits:
+            return pow(self.base, e, self.p)
+        p = self.p; w = self.window; mask = (1 << w) - 1
+        r = 1
+        for row in self.rows:
+            d = e & mask
+            if d:
+                r = r * row[d] % p
+            e >>= w
+        return r
+
+    def check(self):
+        """Whether the table is the one it says it is (for ones read from
+        a file): each row starts where the last one ended, and a random
+        power comes out the same as pow()'s."""
+        p = self.p; b = self.base
+        if len(self.rows) != (self.bits + self.window - 1) // self.window:
+            return False
+        for row in self.rows:
+            if len(row) != 1 << self.window or row[0] != 1 or row[1] != b:
+                return False
+            b = row[-1] * b % p
+        e = string_to_number(os.urandom((self.bits + 7) // 8))
+        e >>= (-self.bits) % 8
+        return self.pow(e) == pow(self.base, e, p)
+
+    def filename(self):
+        h = sha256("%x %x %d" % (self.p, self.base, self.window)).hexdigest()
+        return "jpake-%s.table" % h[:16]
+
+    def save(self, directory):
+        # a sha256 of the rest, then the table
+        data = marshal.dumps((self.base, self.p, self.bits, self.window,
+                              self.rows))
+        path = os.path.join(directory, self.filename())
+        f = open(path + ".new", "wb")
+        try:
+            f.write(sha256(data).digest() + data)
+        finally:
+            f.close()
+        os.rename(path + ".new", path)
+
+    @classmethod
+    def load(klass, directory, base, p, bits, window=WINDOW):
+        """The table for base from a file in directory, or None if it isn't
+        there (or isn't right)"""
+        self = klass(base, p, bits, window, rows=[])
+        try:
+            f = open(os.path.join(directory, self.filename()), "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return None
+        if sha256(data[32:]).digest() != data[:32]:
+            return None
+        try:
+            saved = marshal.loads(data[32:])
+        except (EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(saved, tuple) or len(saved) != 5 \
+                or saved[:4] != (base, p, bits, window):
+            return None
+        self.rows = saved[4]
+        if not self.check():
+            return None
+        return self
+
+def table(params):
+    """The FixedBase for params.g, built (or loaded from table_dir) the
+    first time it's asked for"""
+    key = (params.p, params.g)
+    t = _tables.get(key)
+    if t is None:
+        bits = len("%x" % params.q) * 4 # exponents are below q
+        if table_dir is not None:
+            t = FixedBase.load(table_dir, params.g, params.p, bits)
+        if t is None:
+            t = FixedBase(params.g, params.p, bits)
+            if table_dir is not None:
+                try:
+                    t.save(table_dir)
+                except (IOError, OSError):
+                    pass # it's only a cache
+        _tables[key] = t
+    return t
+
 class JPAKE:
     """This class manages one half of a J-PAKE key negotiation.
 
@@ -218,15 +341,21 @@ class JPAKE:
             self.s = 1 + (string_to_number(sha256(password).digest()) % (q-1))
         
 
+    def power(self, base, exponent):
+        """base**exponent % p, from the table when base is g"""
+        if use_tables and base == self.params.g:
+            return table(self.params).pow(exponent)
+        return pow(base, exponent, self.params.p)
+
     def createZKP(self, generator, exponent, gx):
         # This returns a proof that I know a secret value 'exponent' that
         # satisfies the equation A^exponent=B mod P, where A,B,P are known to
         # the recipient of this proof (A=generator, P=self.params.p). It
         # happens that everywhere createZKP() is called, we already have
         # A^exponent, so we pass it in to save some computation time.
-        p = self.params.p; q = self.params.q
+        q = self.params.q
         r = randrange(q, self.entropy) # [0,q)
-        gr = pow(generator, r, p)
+        gr = self.power(generator, r)
         #gx = pow(generator, exponent, p) # the verifier knows this already
         # Ben's C implementation hashes the pieces this way:
         def hashbn(bn):
@@ -265,17 +394,17 @@ class JPAKE:
                      number_to_string(len(zkp["id"]), 2),
                      str(zkp["id"])])
         h = string_to_number(sha1(s).digest())
-        gb = pow(generator, b, p)
+        gb = self.power(generator, b)
         y = pow(gx, h, p)
         if gr != (gb*y)%p:
             raise BadZeroKnowledgeProof
 
     def one(self):
-        g = self.params.g; p = self.params.p; q = self.params.q
+        g = self.params.g; q = self.params.q
         self.x1 = randrange(q, self.entropy) # [0,q)
         self.x2 = 1+randrange(q-1, self.entropy) # [1,q)
-        gx1 = self.gx1 = pow(g, self.x1, p)
-        gx2 = self.gx2 = pow(g, self.x2, p)
+        gx1 = self.gx1 = self.power(g, self.x1)
+        gx2 = self.gx2 = self.power(g, self.x2)
         zkp_x1 = self.createZKP(g, self.x1, gx1)
         zkp_x2 = self.createZKP(g, self.x2, gx2)
         # now serialize all four. Use simple jsonable dict for now
@@ -1,7 +1,9 @@
 
 import unittest
+import os, shutil, tempfile
+import jpake as jpake_module
 from jpake import JPAKE, params_80, params_112, params_128, \
-     DuplicateSignerID, SignerIDMustBeASCII
+     DuplicateSignerID, SignerIDMustBeASCII, FixedBase, table
 from binascii import hexlify
 from hashlib import sha256
 try:
@@ -149,6 +151,73 @@ class OtherEntropy(unittest.TestCase):
         self.failUnlessEqual(kA1, kA2)
         self.failUnlessEqual(kB1, kB2)
 
+class Tables(unittest.TestCase):
+    def test_pow(self):
+        for params in [params_80, params_112, params_128]:
+            t = table(params)
+            self.failUnless(table(params) is t)
+            q = params.q
+            for x in [0, 1, 2, 255, 256, q-1, (1<<t.bits)-1] + \
+                    [jpake_module.randrange(q, os.urandom) for i in range(20)]:
+                self.failUnlessEqual(t.pow(x), pow(params.g, x, params.p))
+
+    def test_too_big(self):
+        # falls back to pow()
+        t = table(params_80)
+        for x in [1<<t.bits, (1<<t.bits)+5, params_80.p]:
+            self.failUnlessEqual(t.pow(x), pow(params_80.g, x, params_80.p))
+
+    def test_other_base(self):
+        t = FixedBase(3, 1019, 10, window=3)
+        for x in range(1<<10):
+            self.failUnlessEqual(t.pow(x), pow(3, x, 1019))
+
+    def test_same_messages(self):
+        # tables or not, the same entropy makes the same messages
+        def run():
+            entropy = PRNG("seed")
+            jA = JPAKE("password", signerid="Alice", entropy=entropy)
+            jB = JPAKE("password", signerid="Bob", entropy=entropy)
+            m1A,m1B = jA.one(), jB.one()
+            m2A,m2B = jA.two(m1B), jB.two(m1A)
+            return m1A, m1B, m2A, m2B, jA.three(m2B), jB.three(m2A)
+        with_tables = run()
+        jpake_module.use_tables = False
+        try:
+            without = run()
+        finally:
+            jpake_module.use_tables = True
+        self.failUnlessEqual(with_tables, without)
+
+    def test_save_load(self):
+        d = tempfile.mkdtemp()
+        try:
+            g, p, bits = params_80.g, params_80.p, 160
+            self.failUnlessEqual(FixedBase.load(d, g, p, bits), None)
+            t = FixedBase(g, p, bits)
+            t.save(d)
+            t2 = FixedBase.load(d, g, p, bits)
+            self.failUnlessEqual(t2.rows, t.rows)
+            x = jpake_module.randrange(params_80.q, os.urandom)
+            self.failUnlessEqual(t2.pow(x), pow(g, x, p))
+            # the wrong base, window, or a broken file
+            self.failUnlessEqual(FixedBase.load(d, g+1, p, bits), None)
+            self.failUnlessEqual(FixedBase.load(d, g, p, bits, window=4),
+                                 None)
+            path = os.path.join(d, t.filename())
+            data = open(path, "rb").read()
+            open(path, "wb").write(data[:len(data)//2])
+            self.failUnlessEqual(FixedBase.load(d, g, p, bits), None)
+            i = len(data)//2
+            open(path, "wb").write(data[:i] + chr(ord(data[i])^1) + data[i+1:])
+            self.failUnlessEqual(FixedBase.load(d, g, p, bits), None)
+            # or saved wrong
+            t.rows[3][1] += 1
+            t.save(d)
+            self.failUnlessEqual(FixedBase.load(d, g, p, bits), None)
+        finally:
+            shutil.rmtree(d)
+
 class Serialize(unittest.TestCase):
     def replace(self, orig):
         data = json.dumps(orig.to_json())
@@ -0,0 +1,357 @@
+# Copyright (C) 2010  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# pool.py
+#
+# Process pool for session encryption/decryption, so the AES work isn't all
+# stuck on the reactor thread.
+#
+# Each worker is a forked process sharing an anonymous mmap (its ring) with
+# the reactor.  The reactor copies a batch of packets into free space in the
+# ring and writes a small job header down the worker's job pipe.  The worker
+# does the crypto in place and writes the header back on its result pipe,
+# which the reactor watches like any other reader.  Jobs are done in order,
+# so ring space is handed back in order too.
+#
+# Workers keep their own suite object per session id.  Each one encrypts on
+# its own slice of the session's counter space (see _Crypter0's lanes), so a
+# session's batches can be split across all of them without reusing
+# keystream.  Results go back to the caller in the order batches went in,
+# per session.
+#
+# Ring layout of a job: [sid-16B][count-4B]([len-4B][data])*count, then the
+# packets' associated data (see crypto._Suite) the same way, the result
+# overwrites it in the same format.  Packets that fail come back empty.  An
+# OPEN job is [sid-16B][suite name length-1B][suite name][our id length-1B]
+# [our id][key].
+
+from collections import deque
+from twisted.internet import reactor
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implements
+import errno
+import logging
+import mmap
+import os
+import signal
+import struct
+
+from .suites import suites, MAX_OVERHEAD
+
+logger = logging.getLogger(__name__)
+
+# needs fork to share the rings
+available = hasattr(os, 'fork')
+
+OPEN, CLOSE, ENCRYPT, DECRYPT = range(4)
+OK, FAILED = range(2)
+
+# op, status, ring offset, length
+_job = struct.Struct('=BBII')
+_count = struct.Struct('=I')
+# most encrypt adds to each packet
+_OVERHEAD = MAX_OVERHEAD
+_SID_SIZE = 16
+
+
+def _split(ring, off):
+    '''Read a batch of packets out of ring at off, and where it ends.'''
+    n = _count.unpack_from(ring, off)[0]
+    off += _count.size
+    packets = []
+    for i in xrange(n):
+        l = _count.unpack_from(ring, off)[0]
+        off += _count.size
+        packets.append(ring[off:off+l])
+        off += l
+    return packets, off
+
+def _join(packets):
+    '''Pack a batch of packets for the ring.'''
+    pack = _count.pack
+    return pack(len(packets)) + ''.join([pack(len(p)) + p for p in packets])
+
+def _read(fd, size):
+    while True:
+        try:
+            return os.read(fd, size)
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+def _work(lane, lanes, jobs, results, ring):
+    '''Worker process loop, runs until the job pipe is closed.'''
+    crypters = {}
+    while True:
+        head = _read(jobs, _job.size)
+        if not head:
+            return
+        op, status, off, size = _job.unpack(head)
+        sid = ring[off:off+_SID_SIZE]
+        status = OK
+        try:
+            if op == OPEN:
+                i = off + _SID_SIZE
+                n = ord(ring[i])
+                name = ring[i+1:i+1+n]
+                i += 1 + n
+                n = ord(ring[i])
+                ours = ring[i+1:i+1+n]
+                crypters[sid] = suites[name](ring[i+1+n:off+size],
+                            lane=lane, lanes=lanes, ours=ours, theirs=sid)
+            elif op == CLOSE:
+                crypters.pop(sid, None)
+            else:
+                c = crypters[sid]
+                packets, end = _split(ring, off+_SID_SIZE)
+                ads = _split(ring, end)[0]
+                if op == ENCRYPT:
+                    out = _join(c.encrypt_many(packets, ads))
+                else:
+                    out = _join(c.decrypt_many(packets, ads))
+                ring[off+_SID_SIZE:off+_SID_SIZE+len(out)] = out
+                size = _SID_SIZE + len(out)
+        except Exception:
+            status = FAILED
+        os.write(results, _job.pack(op, status, off, size))
+
+
+class _Batch(object):
+    '''One encrypt/decrypt call, possibly split over several workers.'''
+    __slots__ = ('parts', 'left', 'callback')
+
+    def __init__(self, parts, callback):
+        self.parts = [None] * parts
+        self.left = parts
+        self.callback = callback
+
+
+class _Worker(object):
+    '''Reactor side of one worker process.'''
+
+    implements(IReadDescriptor)
+
+    def __init__(self, pool, lane, lanes, ring_size, inherited):
+        self.pool = pool
+        self.ring = mmap.mmap(-1, ring_size)
+        self.ring_size = ring_size
+        # ring offset of the next job, and (offset, op, sid, batch, part,
+        # packets) for jobs in flight, oldest first
+        self.head = 0
+        self.jobs = deque()
+        # jobs waiting for ring space
+        self.waiting = deque()
+
+        jobs_r, jobs_w = os.pipe()
+        results_r, results_w = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 0
+            try:
+                # don't hold the other workers' pipes open
+                for fd in inherited + [jobs_w, results_r]:
+                    os.close(fd)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                _work(lane, lanes, jobs_r, results_w, self.ring)
+            except:
+                status = 1
+            os._exit(status)
+
+        os.close(jobs_r)
+        os.close(results_w)
+        self.jobs_fd = jobs_w
+        self.results_fd = results_r
+
+    def fileno(self):
+        return self.results_fd
+
+    def logPrefix(self):
+        return 'CryptoWorker'
+
+    def connectionLost(self, reason):
+        pass
+
+    def _alloc(self, size):
+        '''Find size free bytes in the ring, or None.'''
+        if not self.jobs:
+            self.head = 0
+            return 0 if size <= self.ring_size else None
+        tail = self.jobs[0][0]
+        head = self.head
+        if head > tail:
+            if head + size <= self.ring_size:
+                return head
+            elif size <= tail:
+                return 0 # wrap
+        elif head + size <= tail:
+            return head
+        return None
+
+    def submit(self, op, sid, data, space=0, batch=None, part=0, n=0):
+        '''Queue a job (of n packets), space is how many more bytes the
+        result needs.'''
+        job = (op, sid, data, space, batch, part, n)
+        if self.waiting or not self._start(job):
+            self.waiting.append(job)
+
+    def _start(self, job):
+        op, sid, data, space, batch, part, n = job
+        size = _SID_SIZE + len(data)
+        off = self._alloc(size + space)
+        if off is None:
+            return False
+        self.ring[off:off+size] = sid + data
+        self.head = off + size + space
+        self.jobs.append((off, op, sid, batch, part, n))
+        os.write(self.jobs_fd, _job.pack(op, OK, off, size))
+        return True
+
+    def doRead(self):
+        '''Results are in.  Called by twisted.'''
+        try:
+            heads = os.read(self.results_fd, _job.size * 256)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        if not heads:
+            logger.critical('crypto worker {0} died', self.pid)
+            reactor.removeReader(self)
+            return
+
+        pool = self.pool
+        for i in xrange(0, len(heads), _job.size):
+            op, status, off, size = _job.unpack_from(heads, i)
+            off, op, sid, batch, part, n = self.jobs.popleft()
+            if status != OK:
+                logger.error('crypto worker {0} failed job {1} for {2}',
+                                            self.pid, op, sid.encode('hex'))
+                if batch is not None:
+                    pool._done(sid, batch, part, ['']*n)
+            elif batch is not None:
+                pool._done(sid, batch, part,
+                                        _split(self.ring, off+_SID_SIZE)[0])
+
+        # room for the ones waiting?
+        while self.waiting and self._start(self.waiting[0]):
+            self.waiting.popleft()
+
+    def stop(self):
+        reactor.removeReader(self)
+        os.close(self.jobs_fd)
+        os.close(self.results_fd)
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        self.ring.close()
+
+
+class CryptoPool(object):
+    '''
+        Encrypts and decrypts batches of packets for sessions in worker
+        processes.  Results come back through callbacks on the reactor thread,
+        in the order they were asked for (per session).
+
+        Worker i encrypts with counter lane first_lane+i out of lanes, keep
+        the other lanes for Crypters outside the pool.
+    '''
+    def __init__(self, workers, first_lane=1, lanes=None,
+                    ring_size=4*1024*1024, chunk=16):
+        if not available:
+            raise OSError('crypto pool needs os.fork')
+        if lanes is None:
+            lanes = first_lane + workers
+        self.chunk = chunk
+        self.ring_size = ring_size
+        self.workers = []
+        fds = []
+        for i in range(workers):
+            w = _Worker(self, first_lane+i, lanes, ring_size, fds)
+            fds.extend([w.jobs_fd, w.results_fd])
+            self.workers.append(w)
+        # sid -> deque of _Batch, oldest first
+        self._order = {}
+        # next worker to start a batch on, so small batches spread out too
+        self._next = 0
+
+    def start(self):
+        for w in self.workers:
+            reactor.addReader(w)
+
+    def stop(self):
+        for w in self.workers:
+            w.stop()
+        self.workers = []
+
+    def open(self, sid, key, suite, ours):
+        '''Give the workers a session's key, its cipher suite's name and our
+        id (the session's other side is sid)'''
+        for w in self.workers:
+            w.submit(OPEN, sid, chr(len(suite)) + suite 
+                                        + chr(len(ours)) + ours + key)
+
+    def close(self, sid):
+        '''Drop a session from the workers'''
+        for w in self.workers:
+            w.submit(CLOSE, sid, '')
+
+    def encrypt(self, sid, packets, callback, ads=None):
+        '''Encrypt packets for session sid, callback(list) gets the results.
+        Packets that wouldn't encrypt come back empty.  ads are the packets'
+        associated data, if any.'''
+        self._submit(ENCRYPT, sid, packets, callback, _OVERHEAD, ads)
+
+    def decrypt(self, sid, packets, callback, ads=None):
+        '''Decrypt packets from session sid, callback(list) gets the results.
+        Packets that wouldn't decrypt come back empty.'''
+        self._submit(DECRYPT, sid, packets, callback, 0, ads)
+
+    def _submit(self, op, sid, packets, callback, overhead, ads=None):
+        if not packets:
+            callback([])
+            return
+        if ads is None:
+            ads = [''] * len(packets)
+        workers = self.workers
+        chunk = self.chunk
+        parts = range(0, len(packets), chunk)
+        batch = _Batch(len(parts), callback)
+        self._order.setdefault(sid, deque()).append(batch)
+        for part, i in enumerate(parts):
+            ps = packets[i:i+chunk]
+            w = workers[(self._next + part) % len(workers)]
+            w.submit(op, sid, _join(ps) + _join(ads[i:i+chunk]),
+                                overhead*len(ps), batch, part, len(ps))
+        self._next = (self._next + len(parts)) % len(workers)
+
+    def _done(self, sid, batch, part, packets):
+        batch.parts[part] = packets
+        batch.left -= 1
+        # hand back every finished batch at the front of the line
+        order = self._order[sid]
+        while order and order[0].left == 0:
+            batch = order.popleft()
+            out = []
+            for packets in batch.parts:
+                out.extend(packets)
+            try:
+                batch.callback(out)
+            except Exception:
+                logger.error('crypto pool callback failed', exc_info=True)
+        if not order:
+            del self._order[sid]
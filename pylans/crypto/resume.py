@@ -0,0 +1,93 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# resume.py
+#
+# Session resumption: after a handshake, both sides keep a secret made from
+# the session key (a ticket, see secret()), and a peer that comes back can
+# skip the PAKE.  Each side sends a fresh nonce with a MAC of it under the
+# ticket, which only the two of them can make, and the new key is a MAC of
+# both nonces; the handshake3s then check both sides got the same one.
+#
+# There's no new Diffie-Hellman in a resumed key, so whoever gets hold of a
+# ticket (and saw the handshake1s) can work out the sessions resumed from
+# it, and the tickets made from those.  A full handshake starts a new chain.
+
+from binascii import hexlify
+from hashlib import sha256
+import hmac
+import os
+from struct import pack
+
+NONCE = 16
+PROOF = 32
+
+
+class ResumeError(Exception):
+    pass
+
+
+def _mac(secret, *strings):
+    return hmac.new(secret, ''.join(pack('!H', len(s)) + s for s in strings),
+                                                        sha256).digest()
+
+def secret(session_key):
+    '''The ticket to keep for resuming a session with key session_key'''
+    return _mac(session_key, 'pylans resume ticket')
+
+
+class Resume(object):
+    '''
+    One side of a resumed handshake, with the same steps as spake2.SPAKE2:
+    one() makes our message, two() checks theirs and gives the key.  The
+    signer ids go into the proofs and the key like they do there.
+    '''
+    def __init__(self, secret, signerid=None, entropy=None):
+        if entropy is None:
+            entropy = os.urandom
+        self.entropy = entropy
+        if signerid is None:
+            signerid = hexlify(entropy(16))
+        self.signerid = signerid
+        self.secret = secret
+
+    def one(self):
+        self.nonce = self.entropy(NONCE)
+        return {'nonce': self.nonce, 'id': self.signerid,
+                'proof': _mac(self.secret, 'pylans resume one', self.nonce,
+                                                            self.signerid)}
+
+    def pack_one(self, data):
+        # the rest of the string is signerid
+        return data['nonce'] + data['proof'] + data['id']
+
+    def unpack_one(self, packed):
+        if len(packed) < NONCE + PROOF:
+            raise ResumeError('message too short')
+        return {'nonce': packed[:NONCE],
+                'proof': packed[NONCE:NONCE+PROOF],
+                'id': packed[NONCE+PROOF:]}
+
+    def two(self, m1):
+        if m1['nonce'] == self.nonce or m1['id'] == self.signerid:
+            raise ResumeError('got our own message back')
+        proof = _mac(self.secret, 'pylans resume one', m1['nonce'], m1['id'])
+        if not hmac.compare_digest(proof, m1['proof']):
+            raise ResumeError('bad proof, the tickets differ')
+        # the two messages in the same order on both sides
+        first, second = sorted([(self.nonce, self.signerid),
+                                (m1['nonce'], m1['id'])])
+        return _mac(self.secret, 'pylans resume key', *(first + second))
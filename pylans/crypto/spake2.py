@@ -0,0 +1,287 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# spake2.py
+#
+# Symmetric SPAKE2 over edwards25519 (the ed25519 group, about 128 bit
+# security), for handshakes with peers that take it: each side sends
+# X = x*G + w*S for a random x and the password's w, and gets the key from
+# K = x*8*(Y - w*S), the same on both sides when the passwords match.  S is
+# a point nobody knows the log of (from hashing a string, see _arbitrary).
+# One message each way instead of JPAKE's two, and at 128 bits it's a few
+# ms of pure python, where JPAKE's params_128 is most of a second.
+#
+# Points are in extended coordinates (X, Y, Z, T), x = X/Z, y = Y/Z and
+# x*y = T/Z.  x*G and w*S come from tables of j*256**i*B (like the jpake
+# module's for g), built the first time they're needed; the one multiply by
+# the peer's point uses 4 bit windows.
+
+from binascii import hexlify, unhexlify
+from hashlib import sha256, sha512
+import os
+from struct import pack
+
+p = 2**255 - 19
+L = 2**252 + 27742317777372353535851937790883648493
+d = -121665 * pow(121666, p-2, p) % p
+_d2 = 2 * d % p
+_I = pow(2, (p-1) // 4, p) # sqrt(-1)
+
+_ZERO = (0, 1, 1, 0)
+
+
+class SPAKE2Error(Exception):
+    pass
+
+
+###### edwards25519
+
+def _add(P, Q):
+    X1, Y1, Z1, T1 = P
+    X2, Y2, Z2, T2 = Q
+    A = (Y1-X1)*(Y2-X2) % p
+    B = (Y1+X1)*(Y2+X2) % p
+    C = T1*T2 % p * _d2 % p
+    D = 2*Z1*Z2 % p
+    E, F, G, H = B-A, D-C, D+C, B+A
+    return (E*F % p, G*H % p, F*G % p, E*H % p)
+
+def _cached(P):
+    '''P in the form _add_cached takes'''
+    X, Y, Z, T = P
+    return ((Y-X) % p, (Y+X) % p, 2*Z % p, T*_d2 % p)
+
+def _add_cached(P, Q):
+    '''P + Q, for Q from _cached (one multiply less)'''
+    X1, Y1, Z1, T1 = P
+    A = (Y1-X1)*Q[0] % p
+    B = (Y1+X1)*Q[1] % p
+    C = T1*Q[3] % p
+    D = Z1*Q[2] % p
+    E, F, G, H = B-A, D-C, D+C, B+A
+    return (E*F % p, G*H % p, F*G % p, E*H % p)
+
+def _add_affine(P, Q):
+    '''P + Q, for Q from a FixedBase table (Z = 1, three multiplies less)'''
+    X1, Y1, Z1, T1 = P
+    A = (Y1-X1)*Q[0] % p
+    B = (Y1+X1)*Q[1] % p
+    C = T1*Q[2] % p
+    D = 2*Z1
+    E, F, G, H = B-A, D-C, D+C, B+A
+    return (E*F % p, G*H % p, F*G % p, E*H % p)
+
+def _double(P):
+    X1, Y1, Z1, T1 = P
+    A = X1*X1 % p
+    B = Y1*Y1 % p
+    C = 2*Z1*Z1 % p
+    H = A+B
+    E = H - (X1+Y1)*(X1+Y1) % p
+    G = A-B
+    F = C+G
+    return (E*F % p, G*H % p, F*G % p, E*H % p)
+
+def _double_xyz(P):
+    '''2*P without its T, for when the next thing is another double'''
+    X1, Y1, Z1, T1 = P
+    A = X1*X1 % p
+    B = Y1*Y1 % p
+    C = 2*Z1*Z1 % p
+    H = A+B
+    E = H - (X1+Y1)*(X1+Y1) % p
+    G = A-B
+    F = C+G
+    return (E*F % p, G*H % p, F*G % p, None)
+
+def _neg(P):
+    X, Y, Z, T = P
+    return (-X % p, Y, Z, -T % p)
+
+def _is_zero(P):
+    X, Y, Z, T = P
+    return X % p == 0 and (Y - Z) % p == 0
+
+def _mul(P, k):
+    '''k*P for any point, 4 bits at a time'''
+    cached = [None, _cached(P)]
+    Q = P
+    for i in range(2, 16):
+        Q = _add_cached(Q, cached[1])
+        cached.append(_cached(Q))
+    R = _ZERO
+    for shift in range((k.bit_length() + 3) & ~3, -4, -4):
+        R = _double(_double_xyz(_double_xyz(_double_xyz(R))))
+        digit = (k >> shift) & 15
+        if digit:
+            R = _add_cached(R, cached[digit])
+    return R
+
+def _encode(P):
+    X, Y, Z, T = P
+    zi = pow(Z, p-2, p)
+    x, y = X*zi % p, Y*zi % p
+    return unhexlify('%064x' % (y | (x & 1) << 255))[::-1]
+
+def _decode(s):
+    '''The point s encodes, or SPAKE2Error if it isn't one'''
+    if len(s) != 32:
+        raise SPAKE2Error('points are 32 bytes')
+    y = int(hexlify(s[::-1]), 16)
+    sign, y = y >> 255, y & ((1 << 255) - 1)
+    if y >= p:
+        raise SPAKE2Error('not a point')
+    # x = sqrt((y^2 - 1) / (d y^2 + 1))
+    u = (y*y - 1) % p
+    v = (d*y*y + 1) % p
+    x = u * pow(v, 3, p) * pow(u * pow(v, 7, p), (p-5) // 8, p) % p
+    vx2 = v*x*x % p
+    if vx2 != u:
+        if vx2 != -u % p:
+            raise SPAKE2Error('not a point')
+        x = x*_I % p
+    if x == 0 and sign:
+        raise SPAKE2Error('not a point')
+    if x & 1 != sign:
+        x = p - x
+    return (x, y, 1, x*y % p)
+
+def _scalar(s):
+    '''A scalar from a string (of 64 bytes, for no noticeable bias)'''
+    return int(hexlify(s), 16) % L
+
+def _arbitrary(seed):
+    '''A point in the prime order group that nobody knows the log of'''
+    for i in xrange(1000):
+        try:
+            P = _decode(sha256('%s %d' % (seed, i)).digest())
+        except SPAKE2Error:
+            continue
+        P = _double(_double(_double(P))) # into the prime order group
+        if not _is_zero(P):
+            return P
+    raise RuntimeError('no point from ' + seed)
+
+
+class FixedBase(object):
+    '''
+    k*B for one point B and k < 2**256, from a table of j*256**i*B (with
+    Z = 1, so each of the 32 adds is a mixed one)
+    '''
+    def __init__(self, B):
+        rows = []
+        for i in range(32):
+            row = [B]
+            for j in range(2, 256):
+                row.append(_add(row[-1], B))
+            B = _add(row[-1], B)
+            rows.append(row)
+        # to Z = 1, all with one inversion
+        points = [P for row in rows for P in row]
+        acc, prods = 1, []
+        for P in points:
+            prods.append(acc)
+            acc = acc * P[2] % p
+        inv = pow(acc, p-2, p)
+        affine = [None] * len(points)
+        for n in range(len(points) - 1, -1, -1):
+            X, Y, Z, T = points[n]
+            zi = inv * prods[n] % p
+            inv = inv * Z % p
+            x, y = X*zi % p, Y*zi % p
+            affine[n] = ((y-x) % p, (y+x) % p, x*y % p * _d2 % p)
+        self.rows = [[None] + affine[i*255:(i+1)*255] for i in range(32)]
+
+    def mul(self, k):
+        if k < 0 or k >> 256:
+            k %= L
+        R = _ZERO
+        for row in self.rows:
+            digit = k & 255
+            if digit:
+                R = _add_affine(R, row[digit])
+            k >>= 8
+        return R
+
+# the base point, and the symmetric mode's S
+G = _decode(unhexlify(
+        '5866666666666666666666666666666666666666666666666666666666666666'))
+S = _arbitrary('pylans spake2 symmetric')
+
+_tables = {}
+
+def table(B):
+    '''The FixedBase for G or S, built the first time it's asked for'''
+    key = B[:2]
+    t = _tables.get(key)
+    if t is None:
+        t = _tables[key] = FixedBase(B)
+    return t
+
+
+class SPAKE2(object):
+    '''
+    One side of a symmetric SPAKE2 handshake, with the same steps as
+    jpake.JPAKE: one() makes our message, two() takes theirs and gives the
+    key.  The signer ids (which carry anything the peers want vouched for)
+    go into the key, so if either was changed on the way the keys differ.
+    '''
+    def __init__(self, password, signerid=None, entropy=None):
+        if entropy is None:
+            entropy = os.urandom
+        self.entropy = entropy
+        if signerid is None:
+            signerid = hexlify(entropy(16))
+        self.signerid = signerid
+        self.w = _scalar(sha512('pylans spake2 password ' + password)
+                                                        .digest())
+
+    def one(self):
+        x = 0
+        while not x:
+            x = _scalar(self.entropy(64))
+        self.x = x
+        X = _add(table(G).mul(x), table(S).mul(self.w))
+        self.element = _encode(X)
+        return {'element': self.element, 'id': self.signerid}
+
+    def pack_one(self, data):
+        # the rest of the string is signerid
+        return data['element'] + data['id']
+
+    def unpack_one(self, packed):
+        if len(packed) < 32:
+            raise SPAKE2Error('message too short')
+        return {'element': packed[:32], 'id': packed[32:]}
+
+    def two(self, m1):
+        if m1['element'] == self.element or m1['id'] == self.signerid:
+            raise SPAKE2Error('got our own message back')
+        Y = _decode(m1['element'])
+        P = _add(Y, _neg(table(S).mul(self.w)))
+        # clear the cofactor (a small order part would give away bits of x)
+        P = _double(_double(_double(P)))
+        if _is_zero(P):
+            raise SPAKE2Error('bad point')
+        K = _encode(_mul(P, self.x))
+        # the two messages in the same order on both sides
+        first, second = sorted([(self.element, self.signerid),
+                                (m1['element'], m1['id'])])
+        w = unhexlify('%064x' % self.w)
+        h = sha256()
+        for s in ('pylans spake2',) + first + second + (K, w):
+            h.update(pack('!H', len(s)) + s)
+        return h.digest()
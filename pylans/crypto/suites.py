@@ -0,0 +1,381 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# suites.py
+#
+# Cipher suites for sessions, by name:
+#   aes256-gcm          - AEAD, from cryptography or pycryptodome
+#   chacha20-poly1305   - AEAD, from cryptography or pycryptodome
+#   aes256-ctr-hmac     - aes 256 ctr (pycryptopp) with a HMAC-SHA256 tag
+#   aes256-ctr          - plain aes 256 ctr, no authentication, for peers
+#                         that don't know any of the above
+# The AEAD suites are only there if one of their libraries is installed.
+#
+# Each side of a handshake says which suites it takes, best first (see
+# advertise), and both pick the same one from the two lists (negotiate).
+# Best is the fastest on this host, timed the first time it's asked for
+# (preference), authenticated suites always ahead of aes256-ctr.
+#
+# Authenticated suites encrypt with keys derived from the session key, their
+# name and the id of the side sending, so a session key is never used by two
+# different ciphers, and the two directions of a session (which both start
+# their counters at the bottom of the same lanes) never share a key and
+# nonce.  aes256-ctr uses the session key both ways, as old peers do.
+#
+# They also authenticate the packet header the router hands them as
+# associated data (see crypto._Suite), so a packet can't be passed off as
+# another type (or as compressed when it isn't) on the way.
+#
+# A suite is only offered (see preference) once it has been seen to work
+# here: both directions round trip, and tampering (with the packet or its
+# header) is caught (selftest).
+
+from binascii import unhexlify
+from struct import pack
+import hashlib
+import hmac
+import logging
+import os
+from time import time
+
+from .crypto import _Suite, _Crypter1, AuthenticationError
+
+try:
+    from hmac import compare_digest
+except ImportError:
+    def compare_digest(a, b):
+        '''a == b, in time that doesn't depend on where they differ'''
+        if len(a) != len(b):
+            return False
+        x = 0
+        for c, d in zip(a, b):
+            x |= ord(c) ^ ord(d)
+        return x == 0
+
+try:
+    from cryptography.hazmat.primitives.ciphers import aead as _aead
+except ImportError:
+    _aead = None
+
+try:
+    from Crypto.Cipher import AES as _AES, ChaCha20_Poly1305 as _ChaCha
+except ImportError:
+    _AES = _ChaCha = None
+
+logger = logging.getLogger(__name__)
+
+LEGACY = _Crypter1.name
+
+# name -> suite class
+suites = {}
+
+def register(cls):
+    suites[cls.name] = cls
+    return cls
+
+def derive(key, label):
+    '''A 32 byte key for label from a session key'''
+    return hmac.new(key, label, hashlib.sha256).digest()
+
+def _sides(ours, theirs):
+    assert ours is not None and theirs is not None, \
+                                    "authenticated suites need both ids"
+    return ' ' + ours, ' ' + theirs
+
+
+class _CTR(_Crypter1):
+    '''aes 256 (pycryptopp) in ctr mode, with a HMAC-SHA256 tag (first 16
+    bytes) over the associated data (length first), ciphertext and iv.
+    ours and theirs are the two sides' ids, we encrypt and tag with keys for
+    ours, check and decrypt with keys for theirs.'''
+    name = 'aes256-ctr-hmac'
+    authenticated = True
+    tag_size = 16
+    overhead = _Crypter1.overhead + tag_size
+
+    _ipad = ''.join(chr(x ^ 0x36) for x in range(256))
+    _opad = ''.join(chr(x ^ 0x5C) for x in range(256))
+
+    def __init__(self, key, callback=None, args=None, lane=0, lanes=1,
+                    ours=None, theirs=None):
+        send, recv = _sides(ours, theirs)
+        _Crypter1.__init__(self, derive(key, self.name + ' encrypt' + send),
+                    callback=callback, args=args, lane=lane, lanes=lanes)
+        self.rx_key = derive(key, self.name + ' encrypt' + recv)
+        # hmac by hand, copying the keyed inner and outer hashes is a lot
+        # cheaper than hmac.new per packet
+        self._mac = self._keyed(derive(key, self.name + ' authenticate'
+                                                                + send))
+        self._rx_mac = self._keyed(derive(key, self.name + ' authenticate'
+                                                                + recv))
+
+    def _keyed(self, mac_key):
+        mac_key = mac_key.ljust(64, '\x00')
+        return (hashlib.sha256(mac_key.translate(self._ipad)),
+                hashlib.sha256(mac_key.translate(self._opad)))
+
+    def _tag(self, ad, data, mac):
+        inner = mac[0].copy()
+        inner.update(pack('!H', len(ad)) + ad)
+        inner.update(data)
+        outer = mac[1].copy()
+        outer.update(inner.digest())
+        return outer.digest()[:self.tag_size]
+
+    def encrypt(self, string, ad=''):
+        data = _Crypter1.encrypt(self, string)
+        return data + self._tag(ad, data, self._mac)
+
+    def encrypt_many(self, packets, ads=None):
+        tag, mac = self._tag, self._mac
+        if ads is None:
+            ads = [''] * len(packets)
+        return [data + tag(ad, data, mac) for data, ad in
+                            zip(_Crypter1.encrypt_many(self, packets), ads)]
+
+    def decrypt(self, string, ad=''):
+        n = len(string) - self.tag_size
+        data = string[:n]
+        if n < self.pos_sz or not compare_digest(
+                            self._tag(ad, data, self._rx_mac), string[n:]):
+            raise AuthenticationError('message authentication failed')
+        return _Crypter1.decrypt(self, data)
+
+
+class _AEAD(_Suite):
+    '''
+    An AEAD cipher with a 96 bit nonce, sent after the ciphertext and tag.
+    Nonces count up from the start of the object's lane, like _Crypter0's
+    counters, under a key for ours (the other side seals under one for
+    theirs, so its nonces don't clash with ours).
+    '''
+    authenticated = True
+    key_size = 32
+    nonce_size = 12
+    tag_size = 16
+    overhead = nonce_size + tag_size
+
+    def __init__(self, key, callback=None, args=None, lane=0, lanes=1,
+                    ours=None, theirs=None):
+        assert len(key) == self.key_size, "Invalid key size"
+        assert 0 <= lane < lanes, "Invalid lane"
+        send, recv = _sides(ours, theirs)
+        self.callback = callback
+        self.args = args or ()
+        span = (1 << 8*self.nonce_size) // lanes
+        self.pos = span * lane
+        self.max_pos = self.pos + span - 1
+        self.__fmt = '%%0.%dx'%(self.nonce_size*2)
+        self._seal = self._cipher(derive(key, self.name + send))[0]
+        self._open = self._cipher(derive(key, self.name + recv))[1]
+
+    def _cipher(self, key):
+        '''seal(nonce, data, ad) -> ciphertext + tag, and open(nonce,
+        ciphertext + tag, ad) -> data, raising on a bad tag'''
+        raise NotImplementedError
+
+    def encrypt(self, string, ad=''):
+        if self.pos > self.max_pos:
+            self._reset()
+        nonce = unhexlify(self.__fmt%self.pos)
+        self.pos += 1
+        return self._seal(nonce, string, ad) + nonce
+
+    def encrypt_many(self, packets, ads=None):
+        if self.pos + len(packets) > self.max_pos:
+            self._reset()
+        if ads is None:
+            ads = [''] * len(packets)
+        fmt, seal = self.__fmt, self._seal
+        pos = self.pos
+        self.pos += len(packets)
+        out = []
+        for i, p in enumerate(packets):
+            nonce = unhexlify(fmt%(pos+i))
+            out.append(seal(nonce, p, ads[i]) + nonce)
+        return out
+
+    def decrypt(self, string, ad=''):
+        n = len(string) - self.nonce_size
+        if n < self.tag_size:
+            raise AuthenticationError('message too short')
+        try:
+            return self._open(string[n:], string[:n], ad)
+        except Exception:
+            raise AuthenticationError('message authentication failed')
+
+    def _reset(self):
+        # a 96 bit counter won't really run out
+        if self.callback is None:
+            raise ValueError, 'nonce counter rolled over'
+        self.max_pos = self.max_pos << 1
+        self.callback(*self.args)
+
+
+def _cryptography(cls):
+    def cipher(self, key):
+        c = cls(key)
+        return (lambda nonce, data, ad: c.encrypt(nonce, data, ad),
+                lambda nonce, data, ad: c.decrypt(nonce, data, ad))
+    return cipher
+
+def _pycryptodome(new):
+    def cipher(self, key):
+        def seal(nonce, data, ad):
+            c = new(key, nonce)
+            c.update(ad)
+            return ''.join(c.encrypt_and_digest(data))
+        def open(nonce, data, ad):
+            c = new(key, nonce)
+            c.update(ad)
+            return c.decrypt_and_verify(data[:-16], data[-16:])
+        return seal, open
+    return cipher
+
+if _aead is not None:
+    @register
+    class _GCM(_AEAD):
+        '''aes 256 gcm (cryptography)'''
+        name = 'aes256-gcm'
+        _cipher = _cryptography(_aead.AESGCM)
+
+    @register
+    class _ChaCha20(_AEAD):
+        '''chacha20-poly1305 (cryptography)'''
+        name = 'chacha20-poly1305'
+        _cipher = _cryptography(_aead.ChaCha20Poly1305)
+
+elif _AES is not None:
+    @register
+    class _GCM(_AEAD):
+        '''aes 256 gcm (pycryptodome)'''
+        name = 'aes256-gcm'
+        _cipher = _pycryptodome(lambda key, nonce:
+                                _AES.new(key, _AES.MODE_GCM, nonce=nonce))
+
+    @register
+    class _ChaCha20(_AEAD):
+        '''chacha20-poly1305 (pycryptodome)'''
+        name = 'chacha20-poly1305'
+        _cipher = _pycryptodome(lambda key, nonce:
+                                _ChaCha.new(key=key, nonce=nonce))
+
+register(_CTR)
+register(_Crypter1)
+
+# most any suite adds to a packet
+MAX_OVERHEAD = max(cls.overhead for cls in suites.values())
+
+
+###### Picking one
+
+def pair(name, key=None):
+    '''Both ends of a session with suite name: (ours, theirs)'''
+    cls = suites[name]
+    if key is None:
+        key = os.urandom(cls.key_size)
+    return (cls(key, ours='a' * 16, theirs='b' * 16),
+            cls(key, ours='b' * 16, theirs='a' * 16))
+
+def selftest(name):
+    '''Whether suite name works here: packets go both ways (and back
+    through encrypt_many and decrypt_many), and an authenticated one turns
+    down one that was tampered with (or its header), or that it sent
+    itself'''
+    try:
+        a, b = pair(name)
+        packets = ['', 'x', os.urandom(1400)]
+        ads = ['', 'head', os.urandom(34)]
+        for x, y in ((a, b), (b, a)):
+            if [y.decrypt(p, ad) for p, ad in zip(x.encrypt_many(packets,
+                                                    ads), ads)] != packets \
+                    or y.decrypt_many([x.encrypt(p, ad) for p, ad in
+                                    zip(packets, ads)], ads) != packets:
+                return False
+        if suites[name].authenticated:
+            p = a.encrypt('tamper', 'head')
+            bad = p[:3] + chr(ord(p[3]) ^ 1) + p[4:]
+            if b.decrypt_many([bad, p, p], ['head', 'head', 'dead']) \
+                                            != ['', 'tamper', ''] \
+                                or a.decrypt_many([p], ['head']) != ['']:
+                return False
+    except Exception:
+        logger.warning('cipher suite {0} failed', name, exc_info=True)
+        return False
+    return True
+
+def benchmark(names=None, size=1400, count=256, repeat=3):
+    '''Seconds to encrypt and decrypt a size byte packet, for each suite (by
+    name), best of repeat batches of count'''
+    times = {}
+    packets = [os.urandom(size) for i in xrange(count)]
+    # a packet header's worth
+    ad = os.urandom(34)
+    ads = [ad] * count
+    for name in names or suites:
+        # one end, talking to itself
+        cls = suites[name]
+        suite = cls(os.urandom(cls.key_size), ours='', theirs='')
+        best = None
+        for i in xrange(repeat):
+            t = time()
+            for p in suite.encrypt_many(packets, ads):
+                suite.decrypt(p, ad)
+            t = time() - t
+            best = t if best is None else min(best, t)
+        times[name] = best / count
+    return times
+
+_preference = None
+
+def preference(names=None):
+    '''Suite names, best first.  Given names (the cipher_suites option),
+    the ones of those we have, in that order.'''
+    global _preference
+    if names:
+        return [n for n in names if n in suites]
+    if _preference is None:
+        working = [n for n in suites if selftest(n)]
+        times = benchmark(working)
+        _preference = sorted(working, key=lambda n:
+                                    (not suites[n].authenticated, times[n]))
+        logger.info('cipher suites: {0}', ', '.join('{0} ({1:.1f}us)'
+                        .format(n, times[n] * 1e6) for n in _preference))
+    return list(_preference)
+
+def advertise(signerid, names):
+    '''A handshake signer id that also lists the suites we take.  Old peers
+    take it as any other id.'''
+    return '{0}:{1}'.format(signerid, ','.join(names))
+
+def advertised(signerid):
+    '''The suites a peer's handshake signer id lists, or None for peers that
+    don't say (they only do aes256-ctr)'''
+    if ':' not in signerid:
+        return None
+    return signerid.split(':', 1)[1].split(',')
+
+def negotiate(ours, theirs, ours_first):
+    '''The suite to use with a peer, from our list and theirs (None if they
+    didn't say), or None if there's none we both take.  Both sides have to
+    get the same answer, so one side's order goes, ours if ours_first.'''
+    if theirs is None:
+        return LEGACY if LEGACY in ours else None
+    first, second = (ours, theirs) if ours_first else (theirs, ours)
+    for name in first:
+        if name in second and name in suites:
+            return name
+    return None
@@ -0,0 +1,61 @@
+
+import unittest
+import resume
+from resume import Resume, ResumeError
+
+class Basic(unittest.TestCase):
+    def test_success(self):
+        ticket = resume.secret("session key")
+        jA, jB = Resume(ticket), Resume(ticket)
+        m1A, m1B = jA.one(), jB.one()
+        kA, kB = jA.two(m1B), jB.two(m1A)
+        self.failUnlessEqual(kA, kB)
+        self.failUnlessEqual(len(kA), 32)
+        self.failIfEqual(kA, ticket)
+
+    def test_fresh(self):
+        # the same ticket makes a new key each time
+        ticket = resume.secret("session key")
+        keys = set()
+        for i in range(2):
+            jA, jB = Resume(ticket), Resume(ticket)
+            m1A, m1B = jA.one(), jB.one()
+            keys.add(jA.two(m1B))
+        self.failUnlessEqual(len(keys), 2)
+
+    def test_failure(self):
+        jA = Resume(resume.secret("session key"))
+        jB = Resume(resume.secret("another key"))
+        m1A, m1B = jA.one(), jB.one()
+        self.failUnlessRaises(ResumeError, jA.two, m1B)
+        self.failUnlessRaises(ResumeError, jB.two, m1A)
+
+    def test_pack(self):
+        ticket = resume.secret("session key")
+        jA = Resume(ticket, signerid="Alice")
+        jB = Resume(ticket, signerid="Bob")
+        m1A, m1B = jA.one(), jB.one()
+        packed = jA.pack_one(m1A)
+        self.failUnlessEqual(len(packed), 16 + 32 + len("Alice"))
+        self.failUnlessEqual(jB.unpack_one(packed), m1A)
+        self.failUnlessRaises(ResumeError, jB.unpack_one, packed[:47])
+        self.failUnlessEqual(jA.two(m1B), jB.two(jB.unpack_one(packed)))
+
+    def test_tampering(self):
+        # changing a signer id or a nonce on the way spoils the proof
+        ticket = resume.secret("session key")
+        jA = Resume(ticket, signerid="Alice:a,b")
+        jB = Resume(ticket, signerid="Bob:a,b")
+        m1A = jA.one()
+        jB.one()
+        self.failUnlessRaises(ResumeError, jB.two, dict(m1A, id="Alice:b"))
+        self.failUnlessRaises(ResumeError, jB.two,
+                              dict(m1A, nonce="\x00" * 16))
+
+    def test_reflection(self):
+        jA = Resume(resume.secret("session key"))
+        m1A = jA.one()
+        self.failUnlessRaises(ResumeError, jA.two, dict(m1A))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+
+import unittest
+from binascii import unhexlify
+from hashlib import sha512
+import spake2
+from spake2 import SPAKE2, SPAKE2Error
+
+class PRNG:
+    # N pseudorandom bytes per call, the same ones for the same seed
+    def __init__(self, seed):
+        self.generator = self.block_generator(seed)
+
+    def __call__(self, numbytes):
+        return "".join([self.generator.next() for i in range(numbytes)])
+
+    def block_generator(self, seed):
+        counter = 0
+        while True:
+            for byte in sha512("prng-%d-%s" % (counter, seed)).digest():
+                yield byte
+            counter += 1
+
+class Group(unittest.TestCase):
+    def test_public_key(self):
+        # RFC 8032 7.1, test 1: the public key for a secret key is the
+        # encoding of a*G, for a from the secret key's hash
+        sk = unhexlify("9d61b19deffd5a60ba844af492ec2cc4"
+                       "4449c5697b326919703bac031cae7f60")
+        h = sha512(sk).digest()
+        a = int(h[:32][::-1].encode("hex"), 16)
+        a = a & ((1 << 254) - 8) | (1 << 254)
+        pk = unhexlify("d75a980182b10ab7d54bfed3c964073a"
+                       "0ee172f3daa62325af021a68f707511a")
+        self.failUnlessEqual(spake2._encode(spake2._mul(spake2.G, a)), pk)
+        self.failUnlessEqual(spake2._encode(spake2.table(spake2.G).mul(a)),
+                             pk)
+
+    def test_order(self):
+        for B in [spake2.G, spake2.S]:
+            self.failUnless(spake2._is_zero(spake2._mul(B, spake2.L)))
+            self.failIf(spake2._is_zero(B))
+
+    def test_fixed_base(self):
+        entropy = PRNG("fixed")
+        ks = [0, 1, 2, 255, 256, 257, 65535, spake2.L - 1] + \
+             [spake2._scalar(entropy(64)) for i in range(10)]
+        for B in [spake2.G, spake2.S]:
+            for k in ks:
+                self.failUnlessEqual(spake2._encode(spake2.table(B).mul(k)),
+                                     spake2._encode(spake2._mul(B, k)))
+
+    def test_encoding(self):
+        P = spake2._mul(spake2.G, 12345)
+        s = spake2._encode(P)
+        self.failUnlessEqual(spake2._encode(spake2._decode(s)), s)
+        self.failUnlessRaises(SPAKE2Error, spake2._decode, s[:31])
+        # y = 2 isn't on the curve
+        self.failUnlessRaises(SPAKE2Error, spake2._decode,
+                              "\x02" + "\x00" * 31)
+
+class Basic(unittest.TestCase):
+    def test_success(self):
+        jA, jB = SPAKE2("password"), SPAKE2("password")
+        m1A, m1B = jA.one(), jB.one()
+        kA, kB = jA.two(m1B), jB.two(m1A)
+        self.failUnlessEqual(kA, kB)
+        self.failUnlessEqual(len(kA), 32)
+
+    def test_failure(self):
+        jA, jB = SPAKE2("password"), SPAKE2("passwerd")
+        m1A, m1B = jA.one(), jB.one()
+        self.failIfEqual(jA.two(m1B), jB.two(m1A))
+
+    def test_pack(self):
+        jA = SPAKE2("password", signerid="Alice")
+        jB = SPAKE2("password", signerid="Bob")
+        m1A, m1B = jA.one(), jB.one()
+        packed = jA.pack_one(m1A)
+        self.failUnlessEqual(len(packed), 32 + len("Alice"))
+        self.failUnlessEqual(jB.unpack_one(packed), m1A)
+        self.failUnlessRaises(SPAKE2Error, jB.unpack_one, packed[:31])
+        self.failUnlessEqual(jA.two(m1B), jB.two(jB.unpack_one(packed)))
+
+    def test_signerid_in_key(self):
+        # changing a signer id on the way changes the key
+        jA = SPAKE2("password", signerid="Alice:a,b")
+        jB = SPAKE2("password", signerid="Bob:a,b")
+        m1A, m1B = jA.one(), jB.one()
+        kA = jA.two(m1B)
+        m1A["id"] = "Alice:b"
+        self.failIfEqual(kA, jB.two(m1A))
+
+    def test_reflection(self):
+        jA = SPAKE2("password")
+        m1A = jA.one()
+        self.failUnlessRaises(SPAKE2Error, jA.two, dict(m1A))
+
+    def test_bad_point(self):
+        jA, jB = SPAKE2("password"), SPAKE2("password")
+        jA.one()
+        m1B = jB.one()
+        # the identity, and a point of order 8, are no good as Y - w*S
+        wS = spake2.table(spake2.S).mul(jA.w)
+        small = spake2._decode(unhexlify("26e8958fc2b227b045c3f489f2ef98f0"
+                                         "d5dfac05d3c63339b13802886d53fc05"))
+        self.failUnless(spake2._is_zero(spake2._mul(small, 8)))
+        for P in [wS, spake2._add(wS, small)]:
+            m = dict(m1B, element=spake2._encode(P))
+            self.failUnlessRaises(SPAKE2Error, jA.two, m)
+
+    def test_entropy(self):
+        def run():
+            entropy = PRNG("seed")
+            jA = SPAKE2("password", signerid="Alice", entropy=entropy)
+            jB = SPAKE2("password", signerid="Bob", entropy=entropy)
+            m1A, m1B = jA.one(), jB.one()
+            return m1A, m1B, jA.two(m1B)
+        self.failUnlessEqual(run(), run())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+
+import unittest
+from binascii import unhexlify
+from struct import pack
+from pylans.crypto import suites
+
+AUTHENTICATED = [n for n in suites.suites if suites.suites[n].authenticated]
+
+# data packet types (see router): DATA, AGGREGATE, MULTIPATH, FEC_DATA,
+# their compressed versions, and ENCODED
+TYPES = [1, 5, 7, 8, 0x41, 0x45, 0x47, 0x48, 0x80]
+
+def header(type, dst="d" * 16, src="s" * 16):
+    '''The associated data the router seals a packet of type under'''
+    return pack('!H', type) + dst + src
+
+def nonce(name, packet):
+    '''The iv (ctr) or nonce (aead) a packet from suite name went out with'''
+    cls = suites.suites[name]
+    if issubclass(cls, suites._AEAD):
+        return packet[-cls.nonce_size:]
+    return packet[-cls.overhead:-cls.tag_size]
+
+class Directions(unittest.TestCase):
+    def test_round_trip(self):
+        for name in suites.suites:
+            a, b = suites.pair(name)
+            for x, y in ((a, b), (b, a)):
+                self.failUnlessEqual(y.decrypt(x.encrypt("hello")), "hello")
+                self.failUnlessEqual(y.decrypt_many(x.encrypt_many(
+                                        ["", "a", "b" * 1400])),
+                                     ["", "a", "b" * 1400])
+                ads = [header(t) for t in TYPES[:3]]
+                self.failUnlessEqual(y.decrypt(x.encrypt("hi", ads[0]),
+                                               ads[0]), "hi")
+                self.failUnlessEqual(y.decrypt_many(x.encrypt_many(
+                                        ["", "a", "b" * 1400], ads), ads),
+                                     ["", "a", "b" * 1400])
+
+    def test_directions_differ(self):
+        # both ends start at the bottom of lane 0, so the first packet each
+        # way has the same nonce (or counter), under different keys
+        for name in AUTHENTICATED:
+            a, b = suites.pair(name)
+            pa, pb = a.encrypt("\x00" * 64), b.encrypt("\x00" * 64)
+            self.failUnlessEqual(nonce(name, pa), nonce(name, pb), name)
+            self.failIfEqual(pa, pb, name)
+            self.failIfEqual(pa[:64], pb[:64], name)
+
+    def test_own_packets(self):
+        # what we sent isn't something we'd take from the other side
+        for name in AUTHENTICATED:
+            a, b = suites.pair(name)
+            self.failUnlessRaises(suites.AuthenticationError, a.decrypt,
+                                  a.encrypt("hello"))
+
+    def test_tampering(self):
+        for name in AUTHENTICATED:
+            a, b = suites.pair(name)
+            p = a.encrypt("hello")
+            for i in range(len(p)):
+                bad = p[:i] + chr(ord(p[i]) ^ 1) + p[i+1:]
+                self.failUnlessRaises(suites.AuthenticationError, b.decrypt,
+                                      bad)
+
+    def test_header(self):
+        # a packet passed off as another type (or another peer's) on the way
+        for name in AUTHENTICATED:
+            a, b = suites.pair(name)
+            for t in TYPES:
+                p = a.encrypt("frame", header(t))
+                self.failUnlessEqual(b.decrypt(p, header(t)), "frame")
+                for u in TYPES:
+                    if u != t:
+                        self.failUnlessRaises(suites.AuthenticationError,
+                                              b.decrypt, p, header(u))
+                self.failUnlessRaises(suites.AuthenticationError, b.decrypt,
+                                      p, header(t, src="x" * 16))
+                self.failUnlessRaises(suites.AuthenticationError, b.decrypt,
+                                      p)
+                self.failUnlessEqual(b.decrypt_many([p, p],
+                                        [header(t), header(t ^ 0x40)]),
+                                     ["frame", ""])
+
+    def test_selftest(self):
+        for name in suites.suites:
+            self.failUnless(suites.selftest(name), name)
+        self.failUnless(set(suites.preference()) == set(suites.suites))
+
+    def test_needs_ids(self):
+        for name in AUTHENTICATED:
+            cls = suites.suites[name]
+            self.failUnlessRaises(AssertionError, cls, "k" * cls.key_size)
+
+class GCM(unittest.TestCase):
+    def test_known_answer(self):
+        # the GCM spec's test case 14: a zero key, iv and block
+        if 'aes256-gcm' not in suites.suites:
+            return
+        cipher = suites.suites['aes256-gcm'].__dict__['_cipher']
+        seal, open = cipher(None, "\x00" * 32)
+        sealed = unhexlify("cea7403d4d606b6e074ec5d3baf39d18"
+                           "d0d1c8a799996bf0265b98b5d48ab919")
+        self.failUnlessEqual(seal("\x00" * 12, "\x00" * 16, ""), sealed)
+        self.failUnlessEqual(open("\x00" * 12, sealed, ""), "\x00" * 16)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# bench_fec.py
+#
+# Loss emulation for FEC.  An inner TCP-like flow (one window of frames per
+# round trip, window + 1 each round with no loss, halved on a loss) goes
+# through a real TapRouter's send context, over a link that carries at most
+# link packets per round trip and loses each one with probability loss, and
+# into the same router's recv (it talks to itself).  Prints frames delivered
+# per round trip, what's left of the loss after FEC and the parity overhead,
+# for FEC off, and on with the group size mods.fec picks for that loss.
+#
+# usage: python -m pylans.mods.bench_fec [rounds] [link] [loss ...]
+
+import os
+import random
+import sys
+from time import time
+
+from ..bench_router import router
+from . import fec
+
+
+class _Network(object):
+    name = 'bench_fec'
+
+def run(rounds, link, loss, k):
+    sid = os.urandom(16)
+    r = router(sid)
+    r.network = _Network()
+    r.pm._self.id = sid # talk to ourselves
+    r.fec = fec.FEC(r)
+    if k:
+        r.fec.groups[sid] = k
+
+    wire = []
+    r.sm.send = lambda data, sid, address: wire.append(data)
+    delivered = []
+    r.recv_packet = lambda packet, src, address: delivered.append(packet)
+
+    mac = os.urandom(6)
+    route = (('127.0.0.1', 8015), sid)
+    r.addr_map[mac] = route
+    frame = mac + os.urandom(1200)
+
+    cwnd, total, sent, lost = 1, 0, 0, 0
+    t = time()
+    for i in xrange(rounds):
+        del wire[:], delivered[:]
+        for j in xrange(cwnd):
+            r.send_packet(frame)
+        if k:
+            # the flush timer, at the end of the round trip
+            r.fec.sender(sid, route[0], r.sm.send).flush()
+        sent += len(wire)
+        for j, data in enumerate(wire):
+            if j < link and random.random() >= loss:
+                r.recv(data, route[0])
+        total += len(delivered)
+        lost += cwnd - len(delivered)
+        if len(delivered) < cwnd:
+            cwnd = max(1, cwnd // 2)
+        else:
+            cwnd += 1
+    dt = time() - t
+    frames = total + lost
+    return (float(total) / rounds, float(lost) / frames,
+                float(sent) / frames - 1, dt * 1e6 / frames)
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    link = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    losses = [float(x) for x in sys.argv[3:]] or [0.005, 0.02, 0.05, 0.1]
+
+    print 'link %d packets per round trip, %d round trips' % (link, rounds)
+    for loss in losses:
+        k = fec.group_size(loss, 0)
+        print 'loss %.1f%%' % (loss * 100)
+        for name, group in (('fec off', 0), ('fec 1/%d' % k, k)):
+            throughput, left, overhead, us = run(rounds, link, loss, group)
+            print '  %-9s %6.1f frames/rtt  loss %5.2f%%  overhead %5.1f%%' \
+                  '  %6.2f us/frame' % (name, throughput, left * 100,
+                                        overhead * 100, us)
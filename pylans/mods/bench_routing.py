@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# bench_routing.py
+#
+# Time for one routing update over a full mesh of n peers, with every peer a
+# neighbour that has sent us its peer list:
+#   cold  - first update, reading ping times out of the peer lists
+#   join  - update after a peer joined, rows rebuilt from the cached times
+#   warm  - later updates, rows cached (nothing moved)
+#   paths - just best_paths, the min-plus product
+# Ping times come from random points on a plane, with a tenth of our direct
+# links made slow so some peers get routed through others.  Uses numpy if
+# it's installed.
+#
+# usage: python -m pylans.mods.bench_routing [peers ...]
+
+import os
+import random
+import sys
+from time import time
+
+from ..peers import PeerInfo
+from . import routing
+from .routing import Routing, best_paths
+
+
+class _Network(object):
+    name = 'bench_routing'
+
+class _PeerManager(object):
+    def __init__(self):
+        self._self = PeerInfo()
+        self._self.id = os.urandom(16)
+        self.peer_list = {}
+        self.peer_map = {}
+
+class _SessionManager(object):
+    def update_map(self, sid, address):
+        pass
+
+class _Router(object):
+    def __init__(self):
+        self.network = _Network()
+        self.pm = _PeerManager()
+        self.sm = _SessionManager()
+        self.addr_map = {}
+
+def mesh(r, n):
+    points = [(random.random(), random.random()) for i in range(n + 1)]
+    rtt = lambda a, b: 0.001 + 0.1 * ((points[a][0] - points[b][0]) ** 2
+                                + (points[a][1] - points[b][1]) ** 2) ** 0.5
+    ids = [os.urandom(16) for i in range(n)]
+    for i, id in enumerate(ids):
+        p = PeerInfo()
+        p.id, p.name, p.is_direct = id, str(i), True
+        p.address = ('10.0.%d.%d' % (i // 256, i % 256), 8015)
+        p.ping_time = rtt(n, i) * (3 if random.random() < 0.1 else 1)
+        r.pm.peer_list[id] = p
+    for i, id in enumerate(ids):
+        peer_list = {}
+        for j, jd in enumerate(ids):
+            if i != j:
+                q = PeerInfo()
+                q.id, q.is_direct, q.relays = jd, True, 1
+                q.ping_time = rtt(i, j)
+                peer_list[jd] = q
+        r.pm.peer_map[id] = peer_list
+
+def report(name, n, dt):
+    print '%-6s %5d peers %10.2f ms' % (name, n, dt * 1e3)
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [50, 200, 1000]
+    print 'numpy' if routing.numpy is not None else 'no numpy, pure python'
+    for n in sizes:
+        r = _Router()
+        mesh(r, n)
+        rt = Routing(r)
+        rt.running = True
+
+        t = time()
+        rt.update()
+        report('cold', n, time() - t)
+        rerouted = len(rt.pinned)
+
+        rt._columns = None
+        t = time()
+        rt.update()
+        report('join', n, time() - t)
+
+        t = time()
+        rt.update()
+        report('warm', n, time() - t)
+
+        weights = [r.pm.peer_list[id].ping_time for id in rt._rows]
+        rows = rt._rows.values()
+        t = time()
+        best_paths(weights, rows)
+        report('paths', n, time() - t)
+        print '%d of %d peers routed through a relay' % (rerouted, n)
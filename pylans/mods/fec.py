@@ -0,0 +1,344 @@
+# Copyright (C) 2010  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# fec.py
+#
+# Forward error correction for lossy links.  To a peer whose pings are
+# getting lost, data goes out as FEC_DATA packets (DATA with a sequence number
+# in the ack id field) in groups of k, and after each group a FEC_PARITY
+# packet with the XOR of the group's (encrypted) payloads.  If one packet of a
+# group goes missing the receiver rebuilds it from the parity and the rest,
+# so the frame gets to the tap without waiting on the inner TCP to notice
+# and resend it.  More than one lost in a group can't be fixed.
+#
+# k comes from the peer's ping loss rate (see Pinger.loss): lossier links
+# get smaller groups, more parity.  Peers with (nearly) no loss get none.
+#
+# Payloads are XORed as big numbers, right aligned, so packets of different
+# lengths needn't be padded out.  The parity packet carries the XOR of the
+# lengths to cut the rebuilt one back to size.
+
+from binascii import hexlify, unhexlify
+from struct import Struct
+import logging
+import random
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from .. import compress
+from .. import sessions
+from ..crypto import AuthenticationError
+from .. import settings
+from .. import util
+from ..packets import PacketType
+
+logger = logging.getLogger(__name__)
+
+PacketType.add(FEC_DATA=8, FEC_PARITY=9)
+
+_FEC_DATA = int(PacketType.FEC_DATA)
+# with a compressed payload
+_ZFEC_DATA = _FEC_DATA | int(PacketType.COMPRESSED)
+
+_head = Struct('!2H')
+_pack_type = Struct('!H').pack
+
+# parity payload: [first seq-2B][count-1B][compressed bits-2B][lengths xor-2B]
+# [payloads xor]
+_parity = Struct('!HBHH')
+
+MAX_GROUP = 16
+
+def to_long(payload):
+    return long(hexlify(payload), 16) if payload else 0L
+
+def from_long(x, size):
+    '''size bytes, or None if x doesn't fit'''
+    if x >> (8 * size):
+        return None
+    return unhexlify('%0*x' % (2 * size, x)) if size else ''
+
+def group_size(loss, min_loss=0.01):
+    '''Data packets per parity packet for a link losing loss of its packets
+    (0 for no FEC)'''
+    if loss < min_loss:
+        return 0
+    # keeps what's left after fixing single losses to about loss / 4
+    return max(2, min(MAX_GROUP, int(0.25 / loss)))
+
+
+class Sender(object):
+    '''
+    Sending side of FEC to one peer: its sequence numbers, and the XOR of the
+    group so far.  send_data sends a FEC_DATA packet, and the group's parity
+    once there are k of them (or once the first has waited delay seconds).
+    '''
+    __slots__ = ('k', 'sid', 'address', 'send', 'tail', 'parity_head', 'delay',
+                 'seq', 'first', 'count', 'bits', 'size', 'parity', 'timer')
+
+    def __init__(self, k, sid, my_id, address, send, delay=0.02):
+        self.k = k
+        self.sid = sid
+        self.address = address
+        self.send = send
+        self.tail = sid + my_id
+        self.parity_head = _head.pack(PacketType.FEC_PARITY, 0) + self.tail
+        self.delay = delay
+        self.seq = random.getrandbits(16)
+        self.first = self.count = self.bits = self.size = 0
+        self.parity = 0L
+        self.timer = None
+
+    def send_data(self, payload, compressed=False):
+        '''Send an encrypted data payload'''
+        seq = self.seq
+        self.seq = (seq + 1) & 0xFFFF
+        type = _ZFEC_DATA if compressed else _FEC_DATA
+        self.send(_head.pack(type, seq) + self.tail + payload, self.sid,
+                                                                self.address)
+        if not self.count:
+            self.first = seq
+            self.timer = reactor.callLater(self.delay, self.flush)
+        if compressed:
+            self.bits |= 1 << self.count
+        self.parity ^= to_long(payload)
+        self.size ^= len(payload)
+        self.count += 1
+        if self.count >= self.k:
+            self.flush()
+
+    def flush(self):
+        '''Send the parity for the group so far'''
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if not self.count:
+            return
+        self.send(self.parity_head + _parity.pack(self.first, self.count,
+                        self.bits, self.size) + from_long(self.parity, 
+                        (self.parity.bit_length() + 7) // 8), self.sid,
+                        self.address)
+        self.count = self.bits = self.size = 0
+        self.parity = 0L
+
+
+class _Received(object):
+    '''Recent FEC_DATA payloads from one peer'''
+    __slots__ = ('payloads', 'order', 'rebuilt')
+
+    def __init__(self):
+        # seq -> (payload, compressed), and seqs oldest first
+        self.payloads = {}
+        self.order = []
+        # seqs we rebuilt, in case the real one turns up late
+        self.rebuilt = set()
+
+
+class FEC(object):
+
+    HISTORY = 512   # payloads kept per peer for rebuilding
+
+    def __init__(self, router):
+        self.router = util.get_weakref_proxy(router)
+        self.running = False
+        # peer id -> group size we send it with, and its Sender
+        self.groups = {}
+        self._senders = {}
+        # src id -> _Received
+        self._received = {}
+        # frames rebuilt from parity, and groups lost too badly to
+        self.recovered = 0
+        self.unrecoverable = 0
+        self._lp = LoopingCall(self.update)
+
+        # always take these, peers can have it on when we don't
+        router.register_handler(PacketType.FEC_PARITY, self.handle_parity)
+
+    def _get(self, prop, default):
+        return settings.get_option(self.router.network.name+'/'+prop, default)
+
+    def _set(self, prop, value):
+        settings.set_option(self.router.network.name+'/'+prop, value)
+
+    enabled = property(lambda s: s._get('fec', False),
+                        lambda s,v: s._set('fec',v))
+
+    interval = property(lambda s: s._get('fec_interval', 10.0),
+                        lambda s,v: s._set('fec_interval',v))
+
+    # fixed group size, 0 to go by loss
+    group = property(lambda s: s._get('fec_group', 0),
+                        lambda s,v: s._set('fec_group',v))
+
+    # longest a group waits for more packets before its parity goes (s)
+    flush_delay = property(lambda s: s._get('fec_flush_delay', 0.02),
+                        lambda s,v: s._set('fec_flush_delay',v))
+
+    # links losing less than this get no FEC
+    min_loss = property(lambda s: s._get('fec_min_loss', 0.01),
+                        lambda s,v: s._set('fec_min_loss',v))
+
+    ###### Sending
+
+    def update(self):
+        '''Re-pick group sizes from the latest loss rates'''
+        if not self.running:
+            return
+        pm, loss = self.router.pm, self.router.pinger.loss
+        fixed, min_loss = self.group, self.min_loss
+        for id in set(self.groups).union(self._received):
+            if id not in pm.peer_list:
+                self.forget(id)
+        for peer in pm.peer_list.values():
+            if 'fec' not in peer.features:
+                continue
+            if fixed > 0:
+                k = min(fixed, MAX_GROUP)
+            else:
+                k = group_size(loss.get(peer.id, 0.0), min_loss)
+            if k != self.groups.get(peer.id, 0):
+                logger.info('fec for {0}: {1}', peer.name,
+                            '1 parity per {0}'.format(k) if k else 'off')
+                if k:
+                    self.groups[peer.id] = k
+                else:
+                    del self.groups[peer.id]
+                self._drop_sender(peer.id)
+                self.router.drop_send_contexts(peer.id)
+
+    def sender(self, sid, address, send):
+        '''The Sender for peer sid, shared by its send contexts'''
+        k = self.groups.get(sid, 0)
+        s = self._senders.get(sid)
+        if s is None or s.k != k or s.address != address:
+            self._drop_sender(sid)
+            s = self._senders[sid] = Sender(k, sid, self.router.pm._self.id,
+                                            address, send, self.flush_delay)
+        return s
+
+    def _drop_sender(self, sid):
+        s = self._senders.pop(sid, None)
+        if s is not None:
+            s.flush()
+
+    ###### Receiving
+
+    def recv_data(self, src, seq, payload, compressed, address):
+        '''A FEC_DATA packet came in'''
+        r = self._received.get(src)
+        if r is None:
+            r = self._received[src] = _Received()
+        if seq in r.rebuilt:
+            # already passed on
+            r.rebuilt.discard(seq)
+            return
+        # (raises if it doesn't authenticate, so it's never kept to rebuild
+        # others with)
+        packet = self._open(src, payload, compressed)
+        self._keep(r, seq, payload, compressed)
+        self._deliver(src, packet, compressed, address)
+
+    def _keep(self, r, seq, payload, compressed):
+        r.payloads[seq] = (payload, compressed)
+        r.order.append(seq)
+        if len(r.order) > 2 * self.HISTORY:
+            old, r.order = r.order[:-self.HISTORY], r.order[-self.HISTORY:]
+            for s in old:
+                r.payloads.pop(s, None)
+                r.rebuilt.discard(s)
+
+    def _open(self, src, payload, compressed):
+        '''Decrypt a FEC_DATA payload, sealed under its header (see
+        router._ad)'''
+        ad = _pack_type(_ZFEC_DATA if compressed else _FEC_DATA) \
+                                            + self.router.pm._self.id + src
+        return self.router.sm.decode(src, payload, ad)
+
+    def _deliver(self, src, packet, compressed, address):
+        if compressed:
+            packet = compress.decompress(packet)
+            if packet is None:
+                return
+        self.router.recv_packet(packet, src, address)
+
+    def handle_parity(self, type, packet, address, src):
+        if len(packet) < _parity.size:
+            logger.debug('short fec parity from {0}', src.encode('hex'))
+            return
+        r = self._received.get(src)
+        if r is None:
+            r = self._received[src] = _Received()
+        first, count, bits, size = _parity.unpack_from(packet)
+        seqs = [(first + i) & 0xFFFF for i in xrange(count)]
+        missing = [s for s in seqs if s not in r.payloads]
+        if len(missing) != 1:
+            if len(missing) > 1:
+                self.unrecoverable += 1
+            return
+
+        x = to_long(packet[_parity.size:])
+        for s in seqs:
+            if s != missing[0]:
+                payload = r.payloads[s][0]
+                x ^= to_long(payload)
+                size ^= len(payload)
+        payload = from_long(x, size)
+        if payload is None:
+            logger.debug('bad fec parity from {0}', src.encode('hex'))
+            return
+        seq = missing[0]
+        compressed = bool(bits >> seqs.index(seq) & 1)
+        # parity isn't authenticated, what it rebuilds is: only keep it (and
+        # stop waiting for the real one) once it opens
+        try:
+            packet = self._open(src, payload, compressed)
+        except AuthenticationError:
+            logger.debug('bad fec rebuild from {0}', src.encode('hex'))
+            return
+        self._keep(r, seq, payload, compressed)
+        r.rebuilt.add(seq)
+        self.recovered += 1
+        self._deliver(src, packet, compressed, address)
+
+    def forget(self, sid):
+        self.groups.pop(sid, None)
+        self._drop_sender(sid)
+        self._received.pop(sid, None)
+
+    ###### Start/Stop
+
+    def start(self):
+        if not self.enabled:
+            return
+        router = self.router
+        if router.crypto_workers > 0 \
+                or type(router.sm) is not sessions.SessionManager:
+            logger.warning('fec needs UDP sessions and no crypto workers, '
+                            +'not starting')
+            return
+        self.running = True
+        self._lp.start(self.interval)
+        logger.info('starting fec on {0}'.format(self.router.network.name))
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self._lp.stop()
+        for sid in self.groups.keys():
+            self._drop_sender(sid)
+            self.router.drop_send_contexts(sid)
+        self.groups.clear()
+        logger.info('stopping fec on {0}'.format(self.router.network.name))
@@ -0,0 +1,362 @@
+# Copyright (C) 2010  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# multipath.py
+#
+# Sending a peer's data over more than one path at once.  The paths to a peer
+# are its direct addresses and our direct peers that can relay to it.  Each
+# gets a PATH_PROBE every interval, answered straight back along the path it
+# came in on, which gives us its round trip time and loss rate.
+#
+# With two or more live paths the router uses a MultipathSendContext: big
+# frames are striped over the paths (weighted round robin, weight ~
+# (1 - loss) / rtt), small ones are sent down the best two.  Those packets are
+# MULTIPATH, a DATA packet with a sequence number in the ack id field, so the
+# receiver can drop duplicates and put them back in order.  It holds early
+# packets for up to reorder_delay waiting for the gap to fill, then gives up
+# on the missing ones.
+
+from struct import Struct, pack
+from time import time
+import itertools
+import logging
+import random
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from .. import sessions
+from .. import settings
+from .. import util
+from ..packets import PacketType
+
+logger = logging.getLogger(__name__)
+
+PacketType.add(PATH_PROBE=42, PATH_REPLY=43)
+
+# probe/reply payload: nonce
+_nonce = Struct('!I')
+
+# half the sequence space, anything further back than this is old
+_SEQ_HALF = 0x8000
+
+
+class Path(object):
+    '''One way to a peer: an address to send to, and relay id (None if
+    it's the peer's own)'''
+    __slots__ = ('address', 'relay', 'rtt', 'loss', 'last_reply', 'weight',
+                 'current')
+
+    def __init__(self, address, relay=None):
+        self.address = address
+        self.relay = relay
+        self.rtt = None
+        self.loss = 0.0
+        self.last_reply = 0
+        # for send contexts' weighted round robin
+        self.weight = 0.0
+        self.current = 0.0
+
+    def update(self, rtt=None, alpha=0.25):
+        '''Fold a probe result in, rtt None for a lost probe'''
+        if rtt is None:
+            self.loss += alpha * (1.0 - self.loss)
+        else:
+            self.loss -= alpha * self.loss
+            self.rtt = rtt if self.rtt is None else \
+                                self.rtt + alpha * (rtt - self.rtt)
+            self.last_reply = time()
+        if self.rtt:
+            self.weight = (1.0 - self.loss) / self.rtt
+
+    @property
+    def score(self):
+        '''lower is better'''
+        if self.rtt is None or self.loss >= 1.0:
+            return float('inf')
+        return self.rtt / (1.0 - self.loss)
+
+
+class _Reorder(object):
+    '''Receive side of one peer's MULTIPATH packets'''
+    __slots__ = ('expected', 'held', 'timer', 'stale', 'fresh')
+
+    def __init__(self):
+        self.expected = None
+        self.held = {}
+        self.timer = None
+        # old packets in a row, lots of them means the sender started over
+        self.stale = 0
+        # nothing passed on yet, so expected is only a guess
+        self.fresh = True
+
+
+class Multipath(object):
+
+    PROBE_TIMEOUT = 2.0
+    MAX_PATHS = 8       # candidates probed per peer
+    MAX_HELD = 128      # packets held per peer waiting for a gap
+    MAX_STALE = 64
+    START_WINDOW = 32   # how far out of order a peer's first packets can be
+
+    def __init__(self, router):
+        self.router = util.get_weakref_proxy(router)
+        self.running = False
+        # peer id -> {address: Path}, and the live ones, best first
+        self.paths = {}
+        self.live = {}
+        # peer id -> sequence numbers for its MULTIPATH packets
+        self.seqs = {}
+        # src id -> _Reorder
+        self._reorder = {}
+        # nonce -> (peer id, Path, time sent)
+        self._probes = {}
+        # dropped duplicates and packets given up on, for the curious
+        self.duplicates = 0
+        self.skipped = 0
+        self._lp = LoopingCall(self.do_probes)
+
+        # always answer and take these, peers can have it on when we don't
+        router.register_handler(PacketType.PATH_PROBE, self.handle_probe)
+        router.register_handler(PacketType.PATH_REPLY, self.handle_reply)
+
+    def _get(self, prop, default):
+        return settings.get_option(self.router.network.name+'/'+prop, default)
+
+    def _set(self, prop, value):
+        settings.set_option(self.router.network.name+'/'+prop, value)
+
+    enabled = property(lambda s: s._get('multipath', False),
+                        lambda s,v: s._set('multipath',v))
+
+    interval = property(lambda s: s._get('multipath_interval', 1.0),
+                        lambda s,v: s._set('multipath_interval',v))
+
+    # frames this small (or smaller) go down the best two paths
+    dup_size = property(lambda s: s._get('multipath_dup_size', 256),
+                        lambda s,v: s._set('multipath_dup_size',v))
+
+    # how long to hold a packet that came in early (s)
+    reorder_delay = property(lambda s: s._get('reorder_delay', 0.05),
+                        lambda s,v: s._set('reorder_delay',v))
+
+    ###### Paths
+
+    def candidates(self, peer):
+        '''[(address, relay id)] that might get to peer'''
+        pm = self.router.pm
+        out = []
+        if peer.is_direct:
+            out.append((peer.address, None))
+        direct = getattr(self.router.routing, 'direct', {}).get(peer.id)
+        if direct is not None:
+            out.append((direct[0], None))
+        out.extend((a, None) for a in peer.direct_addresses)
+        for n in pm.peer_list.values():
+            if n.id != peer.id and n.is_direct and peer.id in \
+                                                pm.peer_map.get(n.id, ()):
+                out.append((n.address, n.id))
+        seen = set()
+        ret = []
+        for address, relay in out:
+            if address not in seen:
+                seen.add(address)
+                ret.append((address, relay))
+        return ret[:self.MAX_PATHS]
+
+    def do_probes(self):
+        if not self.running:
+            return
+        now = time()
+        # probes that never came back
+        for nonce, (sid, path, sent) in self._probes.items():
+            if now - sent > self.PROBE_TIMEOUT:
+                del self._probes[nonce]
+                path.update(None)
+
+        pm = self.router.pm
+        for id in [id for id in self.paths if id not in pm.peer_list]:
+            self.forget(id)
+        for peer in pm.peer_list.values():
+            if 'multipath' not in peer.features:
+                continue
+            paths = self.paths.setdefault(peer.id, {})
+            wanted = self.candidates(peer)
+            for address in [a for a in paths if a not in dict(wanted)]:
+                del paths[address]
+            for address, relay in wanted:
+                path = paths.get(address)
+                if path is None:
+                    path = paths[address] = Path(address, relay)
+                path.relay = relay
+                self.probe(peer.id, path)
+            self._update_live(peer.id)
+
+    def probe(self, sid, path):
+        nonce = random.getrandbits(32)
+        self._probes[nonce] = (sid, path, time())
+        packet = pack('!2H', PacketType.PATH_PROBE, 0) + sid \
+                    + self.router.pm._self.id + _nonce.pack(nonce)
+        self.router.sm.send(packet, sid, path.address)
+
+    def handle_probe(self, type, packet, address, src_id):
+        '''Send it back the way it came'''
+        reply = pack('!2H', PacketType.PATH_REPLY, 0) + src_id \
+                    + self.router.pm._self.id + packet[:_nonce.size]
+        self.router.sm.send(reply, src_id, address)
+
+    def handle_reply(self, type, packet, address, src_id):
+        probe = self._probes.pop(_nonce.unpack_from(packet)[0], None)
+        if probe is not None and probe[0] == src_id:
+            probe[1].update(time() - probe[2])
+
+    def _update_live(self, sid):
+        '''Re-pick the live paths, new send contexts if they changed'''
+        stale = time() - 3 * max(self.interval, self.PROBE_TIMEOUT)
+        live = sorted((p for p in self.paths.get(sid, {}).values()
+                        if p.rtt is not None and p.loss < 0.5
+                        and p.last_reply > stale), key=lambda p: p.score)
+        old = self.live.get(sid, [])
+        if [p.address for p in live] != [p.address for p in old]:
+            if len(live) > 1 or len(old) > 1:
+                logger.info('{0} live paths to {1}: {2}', len(live),
+                                sid.encode('hex'), [p.address for p in live])
+            self.live[sid] = live
+            self.router.drop_send_contexts(sid)
+
+    def live_paths(self, sid):
+        '''The live paths to sid (best first), or [] if it isn't worth
+        multipathing'''
+        if not self.running:
+            return []
+        live = self.live.get(sid, [])
+        return live if len(live) > 1 else []
+
+    def seq(self, sid):
+        '''sid's MULTIPATH sequence numbers, a shared iterator'''
+        seq = self.seqs.get(sid)
+        if seq is None:
+            seq = self.seqs[sid] = itertools.count(random.getrandbits(16))
+        return seq
+
+    def forget(self, sid):
+        self.paths.pop(sid, None)
+        self.live.pop(sid, None)
+        self.seqs.pop(sid, None)
+        r = self._reorder.pop(sid, None)
+        if r is not None and r.timer is not None and r.timer.active():
+            r.timer.cancel()
+
+    ###### Receiving
+
+    def recv(self, src, seq, packet, address):
+        '''A MULTIPATH packet's frame came in, pass it (and any it was holding
+        up) on to the router in order.'''
+        r = self._reorder.get(src)
+        if r is None:
+            r = self._reorder[src] = _Reorder()
+        if r.expected is None:
+            # the first one in needn't be the first sent, leave room for the
+            # ones before it (costs one reorder_delay, once)
+            r.expected = (seq - self.START_WINDOW) & 0xFFFF
+
+        ahead = (seq - r.expected) & 0xFFFF
+        if ahead >= _SEQ_HALF or seq in r.held:
+            # already had it (or gave up on it)
+            r.stale += 1
+            if r.stale < self.MAX_STALE:
+                self.duplicates += 1
+                return
+            # sender must have started over
+            self._release(src, r, len(r.held))
+            r.expected = seq
+            ahead = 0
+        r.stale = 0
+
+        recv_packet = self.router.recv_packet
+        if ahead == 0:
+            recv_packet(packet, src, address)
+            r.fresh = False
+            r.expected = (seq + 1) & 0xFFFF
+            self._release(src, r, 0)
+        else:
+            r.held[seq] = (packet, address)
+            if len(r.held) > self.MAX_HELD:
+                self._release(src, r, 1)
+            elif r.timer is None:
+                r.timer = reactor.callLater(self.reorder_delay, self._timeout,
+                                                                        src)
+        if not r.held and r.timer is not None:
+            if r.timer.active():
+                r.timer.cancel()
+            r.timer = None
+
+    def _release(self, src, r, gaps):
+        '''Pass on held packets from expected on, skipping up to gaps missing
+        ones'''
+        recv_packet = self.router.recv_packet
+        held = r.held
+        while held:
+            seq = r.expected
+            if seq in held:
+                packet, address = held.pop(seq)
+                recv_packet(packet, src, address)
+                r.fresh = False
+            elif gaps > 0:
+                # jump to the next one we have
+                ahead = min((s - seq) & 0xFFFF for s in held)
+                if not r.fresh:
+                    self.skipped += ahead
+                r.expected = (seq + ahead) & 0xFFFF
+                gaps -= 1
+                continue
+            else:
+                break
+            r.expected = (seq + 1) & 0xFFFF
+
+    def _timeout(self, src):
+        r = self._reorder.get(src)
+        if r is None:
+            return
+        r.timer = None
+        # the oldest waited long enough, let everything through
+        self._release(src, r, len(r.held))
+
+    ###### Start/Stop
+
+    def start(self):
+        if not self.enabled:
+            return
+        router = self.router
+        if router.crypto_workers > 0 \
+                or type(router.sm) is not sessions.SessionManager:
+            logger.warning('multipath needs UDP sessions and no crypto'
+                            +' workers, not starting')
+            return
+        self.running = True
+        self._lp.start(self.interval)
+        logger.info('starting multipath on {0} with {1}s probe interval'
+                        .format(self.router.network.name, self.interval))
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self._lp.stop()
+        for sid in self.live.keys():
+            self.router.drop_send_contexts(sid)
+        self.live.clear()
+        self._probes.clear()
+        logger.info('stopping multipath on {0}'
+                        .format(self.router.network.name))
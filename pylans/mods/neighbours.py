@@ -0,0 +1,206 @@
+# Copyright (C) 2010  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# neighbours.py
+#
+# ARP and IPv6 neighbour discovery proxy for the tap router.  Requests for
+# a peer we already know get answered right here, with a reply written back
+# into the tap device, instead of being broadcast (and encrypted) once per
+# peer.  Targets we don't know still go out as a broadcast.
+#
+# IPv4 answers come from a vip -> mac map kept up to date from the peer
+# events.  For IPv6 we know each
+# peer's EUI-64 link-local address, and learn the rest from the solicitations
+# peers multicast to us from their own mac.  Those age out like learned routes
+# do.  Nothing is answered for a mac that isn't routable.
+
+from struct import Struct, pack
+from time import time
+from .. import util
+from ..util import event
+
+_ETH_ARP = '\x08\x06'
+_ETH_IP6 = '\x86\xdd'
+# htype ethernet, ptype ipv4, hlen 6, plen 4
+_ARP_HEAD = '\x00\x01\x08\x00\x06\x04'
+_ARP_REQUEST = '\x00\x01'
+_ARP_REPLY = '\x00\x02'
+_ICMP6 = '\x3a'
+_NS = '\x87'
+_NA = '\x88'
+_IP6_ANY = '\x00' * 16
+# solicited + override, no router flag
+_NA_FLAGS = '\x60\x00\x00\x00'
+
+_ARP_SIZE = 42              # eth + arp
+_NS_SIZE = 78               # eth + ipv6 + icmpv6 ns (without options)
+_MAX_LEARNED = 4096
+
+_words = Struct('!36H')     # ipv6 pseudo header + 32 byte na
+
+def _checksum6(src, dst, icmp):
+    '''ICMPv6 checksum of icmp (32 bytes, checksum zeroed) from src to dst'''
+    s = sum(_words.unpack(src + dst + pack('!I', len(icmp)) + '\x00\x00\x00'
+                                                        + _ICMP6 + icmp))
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+def link_local(mac):
+    '''EUI-64 link-local ipv6 address (16 bytes) for a mac
+
+    >>> link_local(util.encode_mac('02:00:5e:10:00:01')).encode('hex')
+    'fe8000000000000000005efffe100001'
+    '''
+    return ('\xfe\x80' + '\x00' * 6 + chr(ord(mac[0]) ^ 2) + mac[1:3]
+                + '\xff\xfe' + mac[3:6])
+
+
+class NeighbourProxy(object):
+    '''Answers ARP requests and neighbour solicitations for known peers.'''
+
+    def __init__(self, router, max_age=300.0, max_learned=_MAX_LEARNED):
+        self.router = util.get_weakref_proxy(router)
+        self.max_age = max_age
+        self.max_learned = max_learned
+        # ipv6 address -> [mac, last seen], learned from peers' solicitations
+        self.learned = {}
+        # vip -> (peer id, mac), and peer id -> vip to find a changed peer's
+        # old entry
+        self.by_vip = {}
+        self._vips = {}
+        pm = router.pm
+        for peer in pm.peer_list.values():
+            self._peer_changed(pm, peer)
+        event.register_handler('peer-added', pm, self._peer_changed)
+        event.register_handler('peer-changed', pm, self._peer_changed)
+        event.register_handler('peer-removed', pm, self._peer_removed)
+        # broadcasts we kept to ourselves, and ones we had to send
+        self.arp_suppressed = 0
+        self.nd_suppressed = 0
+        self.forwarded = 0
+
+    def _forget(self, id):
+        vip = self._vips.pop(id, None)
+        if vip is not None and self.by_vip.get(vip, (None,))[0] == id:
+            del self.by_vip[vip]
+
+    def _peer_changed(self, pm, peer):
+        self._forget(peer.id)
+        self._vips[peer.id] = peer.vip
+        self.by_vip[peer.vip] = (peer.id, peer.addr)
+
+    def _peer_removed(self, pm, peer):
+        self._forget(peer.id)
+        learned = self.learned
+        for ip in [a for a in learned if learned[a][0] == peer.addr]:
+            del learned[ip]
+
+    def answer(self, frame):
+        '''
+        Reply for a broadcast frame off the tap, or None if it has to go out.
+        Counts broadcasts either way.
+        '''
+        reply = None
+        ethertype = frame[12:14]
+        if ethertype == _ETH_ARP:
+            reply = self._arp(frame)
+            if reply is not None:
+                self.arp_suppressed += 1
+        elif ethertype == _ETH_IP6:
+            reply = self._nd(frame)
+            if reply is not None:
+                self.nd_suppressed += 1
+        if reply is None:
+            self.forwarded += 1
+        return reply
+
+    def _arp(self, frame):
+        if len(frame) < _ARP_SIZE or frame[14:20] != _ARP_HEAD \
+                or frame[20:22] != _ARP_REQUEST:
+            return None
+        sha, spa, tpa = frame[22:28], frame[28:32], frame[38:42]
+        # probes and announcements are for everyone to see
+        if spa == '\x00\x00\x00\x00' or spa == tpa:
+            return None
+        mac = self._mac_for_ip(tpa)
+        if mac is None:
+            return None
+        return (sha + mac + _ETH_ARP + _ARP_HEAD + _ARP_REPLY
+                    + mac + tpa + sha + spa)
+
+    def _mac_for_ip(self, ip):
+        entry = self.by_vip.get(ip)
+        if entry is not None and entry[1] in self.router.addr_map:
+            return entry[1]
+        return None
+
+    def _nd(self, frame):
+        if len(frame) < _NS_SIZE or frame[20] != _ICMP6 \
+                or frame[54] != _NS or frame[55] != '\x00':
+            return None
+        src, target = frame[22:38], frame[62:78]
+        # duplicate address detection, let the owner speak up
+        if src == _IP6_ANY:
+            return None
+        mac = self._mac_for_ip6(target)
+        if mac is None:
+            return None
+        icmp = _NA + '\x00' + '\x00\x00' + _NA_FLAGS + target + '\x02\x01' \
+                                                                    + mac
+        csum = pack('!H', _checksum6(target, src, icmp))
+        icmp = icmp[:2] + csum + icmp[4:]
+        return (frame[6:12] + mac + _ETH_IP6 + '\x60\x00\x00\x00'
+                    + pack('!H', len(icmp)) + _ICMP6 + '\xff'
+                    + target + src + icmp)
+
+    def _mac_for_ip6(self, ip):
+        addr_map = self.router.addr_map
+        entry = self.learned.get(ip)
+        if entry is not None:
+            if entry[1] >= time() - self.max_age:
+                return entry[0] if entry[0] in addr_map else None
+            del self.learned[ip]
+        if ip[:8] == '\xfe\x80' + '\x00' * 6:
+            for peer in self.router.pm.peer_list.values():
+                if link_local(peer.addr) == ip:
+                    return peer.addr if peer.addr in addr_map else None
+        return None
+
+    def learn(self, peer, frame):
+        '''Note the address of a peer soliciting for a neighbour (a broadcast
+        frame from peer).  Only frames from the peer's own mac count, so a
+        peer can't answer for anyone else's addresses.'''
+        if peer is None or frame[6:12] != peer.addr:
+            return
+        if len(frame) >= _NS_SIZE and frame[12:14] == _ETH_IP6 \
+                and frame[20] == _ICMP6 and frame[54] == _NS:
+            src = frame[22:38]
+            if src != _IP6_ANY:
+                learned = self.learned
+                if src not in learned and len(learned) >= self.max_learned:
+                    self.expire()
+                    if len(learned) >= self.max_learned:
+                        # still full, make room by dropping the stalest
+                        del learned[min(learned, key=lambda a: learned[a][1])]
+                learned[src] = [peer.addr, time()]
+
+    def expire(self):
+        '''Drop learned addresses that haven't been solicited for max_age'''
+        limit = time() - self.max_age
+        learned = self.learned
+        for ip in [a for a in learned if learned[a][1] < limit]:
+            del learned[ip]
@@ -41,6 +41,7 @@ class Pinger(object):
 
     MAX_PING_TIME = 10.0
     MAX_TIMEOUTS = 10
+    LOSS_ALPHA = 0.1    # weight of each ping in the loss rate average
 
 #    PING = 40
 #    PONG = 0x20 - 2
@@ -48,6 +49,8 @@ class Pinger(object):
     def __init__(self, router, interval=None):
         self.router = util.get_weakref_proxy(router)
         self.active_pings = {}
+        # peer id -> fraction of pings lost, moving average
+        self.loss = {}
         self._lp = LoopingCall(self.do_pings)
         if interval is not None:
             self.interval = interval
@@ -79,6 +82,7 @@ class Pinger(object):
         Called when we get an ACK from our ping
         '''
         dt = time() - ping_time
+        self._update_loss(peer, 0.0)
             
         logger.debug('received ping response from {0} with time {1}'
                     .format(self.router.pm.peer_list[peer.id].name, dt))
@@ -94,9 +98,16 @@ class Pinger(object):
         self.router.pm.peer_list[peer.id].timeouts = 0
 
 
+    def _update_loss(self, peer, lost):
+        loss = self.loss.get(peer.id, 0.0)
+        self.loss[peer.id] = loss + self.LOSS_ALPHA * (lost - loss)
+
     def do_pings(self):
         if self.running:
-            for peer in self.router.pm.peer_list.values():
+            peers = self.router.pm.peer_list
+            for id in [id for id in self.loss if id not in peers]:
+                del self.loss[id]
+            for peer in peers.values():
                 self.send_ping(peer)
 
     def _ping_timeout(self, peer):
@@ -104,6 +115,7 @@ class Pinger(object):
         Ping timed out.
         '''
         if peer.id in self.router.pm.peer_list:
+            self._update_loss(peer, 1.0)
             dt = (time() - self.router.sm.keep_alives.get(peer.id, 0))
             if(dt > self.interval):
                 peer.timeouts += 1
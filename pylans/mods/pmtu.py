@@ -0,0 +1,175 @@
+# Copyright (C) 2010  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# pmtu.py
+#
+# Path MTU discovery for direct peers.  Probes are padded packets sent with
+# the DF bit set, sized by binary search and acked through the router's usual
+# ACK machinery.  They go out from a socket of our own, so normal traffic to
+# peers that don't probe still gets fragmented by the kernel.  The result
+# ends up in PeerInfo.pmtu, and the router splits data packets that wouldn't
+# fit (see SendContext.fragment).
+
+from platform import system
+from struct import pack
+from time import time
+import errno
+import logging
+import socket
+from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+from .. import settings
+from .. import util
+from ..packets import PacketType
+
+logger = logging.getLogger(__name__)
+
+PacketType.add(PMTU_PROBE=41)
+
+# <linux/in.h>: always set DF, and ignore the kernel's pmtu cache so we can
+# probe past it
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_PROBE = getattr(socket, 'IP_PMTUDISC_PROBE', 3)
+
+# ipv4 + udp headers
+UDP_OVERHEAD = 28
+
+class PathMTU(object):
+
+    MIN_MTU = 576       # any ipv4 path has to take this
+    MAX_MTU = 1500
+    PRECISION = 8       # good enough when the search gets this close
+    PROBE_TIMEOUT = 1.0
+    PROBE_TRIES = 2     # so one lost probe doesn't look like a small mtu
+    CHECK_INTERVAL = 5.0 # how often to look for peers that need probing
+
+    def __init__(self, router):
+        self.router = util.get_weakref_proxy(router)
+        self.running = False
+        self.probing = set()
+        # peer id -> when we last probed it
+        self.last_probe = {}
+        self._sock = None
+        self._lp = LoopingCall(self.do_probes)
+
+        # nothing to do, the router acks them
+        router.register_handler(PacketType.PMTU_PROBE, lambda *x: None)
+
+    def _get(self, prop, default):
+        return settings.get_option(self.router.network.name+'/'+prop, default)
+
+    def _set(self, prop, value):
+        settings.set_option(self.router.network.name+'/'+prop, value)
+
+    interval = property(lambda s: s._get('pmtu_interval', 600.0),
+                        lambda s,v: s._set('pmtu_interval',v))
+
+    enabled = property(lambda s: s._get('pmtu_discovery', True),
+                        lambda s,v: s._set('pmtu_discovery',v))
+
+    def do_probes(self):
+        '''Probe the peers we haven't in a while (or ever)'''
+        if self.running:
+            now = time()
+            interval = self.interval
+            for peer in self.router.pm.peer_list.values():
+                if peer.is_direct and 'pmtu' in peer.features \
+                        and peer.id not in self.probing \
+                        and now - self.last_probe.get(peer.id, 0) > interval:
+                    self.last_probe[peer.id] = now
+                    self.probe(peer)
+
+    @defer.inlineCallbacks
+    def probe(self, peer):
+        '''
+        Find the path mtu to a peer and store it in peer.pmtu.  Stays 0
+        (unknown, let the kernel fragment) if even MIN_MTU doesn't get
+        through, ie: something drops our probes.
+        '''
+        self.probing.add(peer.id)
+        try:
+            mtu = 0
+            if (yield self.try_size(peer, self.MAX_MTU)):
+                mtu = self.MAX_MTU
+            elif (yield self.try_size(peer, self.MIN_MTU)):
+                lo, hi = self.MIN_MTU, self.MAX_MTU
+                while hi - lo > self.PRECISION:
+                    mid = (lo + hi) // 2
+                    if (yield self.try_size(peer, mid)):
+                        lo = mid
+                    else:
+                        hi = mid
+                mtu = lo
+        finally:
+            self.probing.discard(peer.id)
+
+        if mtu != peer.pmtu and self.running:
+            logger.info('path mtu to {0} is {1}', peer.name, mtu or 'unknown')
+            peer.pmtu = mtu
+            # data packets to it need (un)splitting now
+            self.router.drop_send_contexts(peer.id)
+
+    @defer.inlineCallbacks
+    def try_size(self, peer, size):
+        '''Send a probe of size bytes (ip packet), True if it got acked'''
+        for i in range(self.PROBE_TRIES):
+            if not self.running:
+                break
+            id, d = self.router.request_ack(timeout=self.PROBE_TIMEOUT)
+            packet = pack('!2H', PacketType.PMTU_PROBE, id) + peer.id \
+                                                + self.router.pm._self.id
+            packet += '\x00' * (size - UDP_OVERHEAD - len(packet))
+            try:
+                self._sock.sendto(packet, peer.address)
+            except socket.error, e:
+                # EMSGSIZE: bigger than our own interface takes
+                logger.debug('pmtu probe to {0} failed: {1}', peer.name, e)
+                if e.errno == errno.EMSGSIZE:
+                    d.addErrback(lambda f: None) # no one's waiting on it
+                    break
+            acked = True
+            try:
+                yield d
+            except Exception:
+                acked = False
+            if acked:
+                defer.returnValue(True)
+        defer.returnValue(False)
+
+    def start(self):
+        if not self.enabled:
+            return
+        if system() != 'Linux':
+            logger.info('path mtu discovery needs linux, not probing')
+            return
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER,
+                                                    IP_PMTUDISC_PROBE)
+        self._sock.setblocking(False)
+        self.running = True
+        self._lp.start(self.CHECK_INTERVAL, now=False)
+        logger.info('starting path mtu discovery on {0} with {1}s interval'
+                        .format(self.router.network.name, self.interval))
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self._lp.stop()
+        self._sock.close()
+        self._sock = None
+        logger.info('stopping path mtu discovery on {0}'
+                        .format(self.router.network.name))
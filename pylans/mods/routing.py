@@ -0,0 +1,256 @@
+# Copyright (C) 2010  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# routing.py
+#
+# Latency based next hop selection.  Packets are relayed hop by hop, each
+# relay forwarding on its own route, so all we get to pick is the first hop:
+# a peer directly, or one of our direct peers relaying for it.  The cost of
+# going through neighbour n to peer t is our ping time to n plus n's ping time
+# to t, from the peer list n sent us in its last peer exchange (ping times
+# there are n's end to end times, along n's own route).  That's one step of
+# distance vector, done for every peer at once as a min-plus product of our
+# ping times with the (neighbours x peers) matrix of theirs.
+#
+# Routes only change when the new one is a good deal faster than what we
+# measure now, and not again until the new route has been pinged for a while,
+# so they don't flap.  Peers we route through a relay are 'pinned', the
+# PeerManager leaves their address alone when announces come in.
+
+from time import time
+import logging
+from twisted.internet.task import LoopingCall
+from .. import settings
+from .. import util
+from ..util import event
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+INF = float('inf')
+
+def best_paths(weights, rows):
+    '''
+    weights[i] is the cost to neighbour i, rows[i][j] its cost on to peer j
+    (INF if it has no route).  Returns (cost, via) lists, the best total cost
+    to each peer and which neighbour it goes through (-1 if none).
+    '''
+    if not rows:
+        return [], []
+    if numpy is not None:
+        m = numpy.array(rows) + numpy.array(weights)[:, None]
+        via = m.argmin(axis=0)
+        cost = m[via, numpy.arange(m.shape[1])]
+        via[numpy.isinf(cost)] = -1
+        return cost.tolist(), via.tolist()
+
+    cost = list(rows[0])
+    w = weights[0]
+    cost = [c + w for c in cost]
+    via = [0] * len(cost)
+    for i in xrange(1, len(rows)):
+        w = weights[i]
+        for j, c in enumerate(rows[i]):
+            c += w
+            if c < cost[j]:
+                cost[j] = c
+                via[j] = i
+    for j, c in enumerate(cost):
+        if c == INF:
+            via[j] = -1
+    return cost, via
+
+
+class Routing(object):
+
+    # don't touch a route again for this long after changing it, so its
+    # ping time has caught up (s)
+    HOLD_DOWN = 30.0
+
+    def __init__(self, router):
+        self.router = util.get_weakref_proxy(router)
+        self.running = False
+        # peers we route through a relay -> that relay's id
+        self.pinned = {}
+        # peer id -> (address, ping time) from when it was last direct
+        self.direct = {}
+        # peer id -> when we last changed its route
+        self.switched = {}
+        # neighbour id -> (its peer list, {peer id: ping time}), and
+        # neighbour id -> row of those ping times for the peer ids in _columns
+        self._times = {}
+        self._rows = {}
+        self._columns = None
+        self._lp = LoopingCall(self.update)
+        self._px_lp = LoopingCall(self.refresh)
+
+    def _get(self, prop, default):
+        return settings.get_option(self.router.network.name+'/'+prop, default)
+
+    def _set(self, prop, value):
+        settings.set_option(self.router.network.name+'/'+prop, value)
+
+    enabled = property(lambda s: s._get('latency_routing', True),
+                        lambda s,v: s._set('latency_routing',v))
+
+    interval = property(lambda s: s._get('route_interval', 30.0),
+                        lambda s,v: s._set('route_interval',v))
+
+    # how often to swap peer lists with direct peers, for fresh ping times
+    refresh_interval = property(lambda s: s._get('route_refresh', 300.0),
+                        lambda s,v: s._set('route_refresh',v))
+
+    # a new route has to be this much faster, as a fraction and in seconds
+    hysteresis = property(lambda s: s._get('route_hysteresis', 0.2),
+                        lambda s,v: s._set('route_hysteresis',v))
+
+    min_gain = property(lambda s: s._get('route_min_gain', 0.005),
+                        lambda s,v: s._set('route_min_gain',v))
+
+    def _ping_times(self, peer_list):
+        '''A neighbour's ping times to its peers'''
+        my_id = self.router.pm._self.id
+        # skip routes it has through us, they'd just loop
+        return dict((q.id, q.ping_time) for q in peer_list.values()
+                        if q.ping_time > 0 and q.timeouts == 0
+                        and (q.is_direct or q.relay_id != my_id))
+
+    def update(self):
+        '''Look for faster routes to our peers and switch to them'''
+        if not self.running:
+            return
+        pm = self.router.pm
+        peers = pm.peer_list
+        now = time()
+
+        for d in (self.pinned, self.direct, self.switched):
+            for id in [id for id in d if id not in peers]:
+                del d[id]
+
+        for p in peers.values():
+            if p.is_direct and p.ping_time > 0 and p.timeouts == 0:
+                self.direct[p.id] = (p.address, p.ping_time)
+
+        neighbours = [p for p in peers.values() if p.is_direct
+                        and p.ping_time > 0 and p.timeouts == 0
+                        and p.id in pm.peer_map]
+        columns = sorted(peers)
+        if columns != self._columns:
+            self._columns = columns
+            self._rows.clear()
+        rows = []
+        for n in neighbours:
+            peer_list = pm.peer_map[n.id]
+            cached = self._times.get(n.id)
+            if cached is None or cached[0] is not peer_list:
+                cached = self._times[n.id] = (peer_list,
+                                                self._ping_times(peer_list))
+                self._rows.pop(n.id, None)
+            row = self._rows.get(n.id)
+            if row is None:
+                times = cached[1]
+                row = self._rows[n.id] = [times.get(id, INF) for id in columns]
+            rows.append(row)
+        for id in [id for id in self._times if id not in pm.peer_map]:
+            del self._times[id]
+            self._rows.pop(id, None)
+
+        cost, via = best_paths([n.ping_time for n in neighbours], rows)
+
+        hysteresis, min_gain = self.hysteresis, self.min_gain
+        for j, id in enumerate(columns):
+            t = peers[id]
+            relay = self.pinned.get(id)
+            broken = relay is not None and not (relay in peers
+                                and peers[relay].is_direct
+                                and peers[relay].timeouts == 0)
+            if not broken and (now - self.switched.get(id, 0) < self.HOLD_DOWN
+                                or t.ping_time <= 0):
+                continue
+            current = INF if broken else t.ping_time
+
+            best, hop = INF, None
+            if via and via[j] >= 0 and neighbours[via[j]].id != id:
+                best, hop = cost[j], neighbours[via[j]]
+            if not t.is_direct and id in self.direct \
+                    and self.direct[id][1] <= best:
+                best, hop = self.direct[id][1], None
+
+            if best == INF or (hop.id if hop is not None else None) \
+                                == (None if t.is_direct else t.relay_id):
+                continue
+            if best < current * (1 - hysteresis) and current - best > min_gain:
+                self.switch(t, hop, best, current)
+            elif broken:
+                # nowhere better to go, back to how the peer manager routes
+                del self.pinned[id]
+
+    def switch(self, peer, hop, cost, current):
+        '''Route peer through hop (a direct peer), or directly if None'''
+        pm = self.router.pm
+        if hop is None:
+            address, relays, relay_id = self.direct[peer.id][0], 0, None
+            self.pinned.pop(peer.id, None)
+        else:
+            address, relays = hop.address, pm.peer_map[hop.id][peer.id].relays
+            relay_id = hop.id
+            self.pinned[peer.id] = hop.id
+        logger.info('routing {0} via {1} ({2:.1f}ms, was {3:.1f}ms)',
+                        peer.name, hop.name if hop is not None else 'direct',
+                        cost * 1e3, current * 1e3)
+
+        if peer.addr in self.router.addr_map:
+            self.router.addr_map[peer.addr] = (address, peer.id)
+        self.router.sm.update_map(peer.id, address)
+        peer.address = address
+        peer.relays = relays
+        peer.is_direct = (relays == 0)
+        peer.relay_id = relay_id
+        self.switched[peer.id] = time()
+        event.emit('peer-changed', pm, peer)
+
+    def refresh(self):
+        '''Swap peer lists with direct peers, for their latest ping times'''
+        if self.running:
+            pm = self.router.pm
+            for p in pm.peer_list.values():
+                if p.is_direct:
+                    pm.try_px(p)
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.running = True
+        self._lp.start(self.interval, now=False)
+        if self.refresh_interval > 0:
+            self._px_lp.start(self.refresh_interval, now=False)
+        logger.info('starting latency routing on {0} with {1}s interval'
+                        .format(self.router.network.name, self.interval))
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self._lp.stop()
+        if self._px_lp.running:
+            self._px_lp.stop()
+        self.pinned.clear()
+        logger.info('stopping latency routing on {0}'
+                        .format(self.router.network.name))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# bench_mmsg.py
+#
+# Datagrams/sec over loopback with one sendto/recvfrom per datagram vs.
+# sendmmsg/recvmmsg batches.
+#
+# usage: python -m pylans.net.bench_mmsg [datagrams] [size] [batch ...]
+
+import socket
+import sys
+from time import time
+
+from . import mmsg
+
+def pair():
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8*1024*1024)
+    rx.bind(('127.0.0.1', 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return rx, tx
+
+def run(n, size, batch):
+    rx, tx = pair()
+    addr = rx.getsockname()
+    data = 'x' * size
+    rx.setblocking(False)
+    got = 0
+
+    # interleave sending and draining so the receive buffer never overflows
+    chunk = 256
+    t_send = t_recv = 0
+    if batch > 0:
+        receiver = mmsg.Receiver(batch, size)
+        sender = mmsg.Sender(batch)
+        datagrams = [(data, addr)] * batch
+    for i in xrange(0, n, chunk):
+        t1 = time()
+        if batch > 0:
+            for j in xrange(0, chunk, batch):
+                sender.send(tx.fileno(), datagrams)
+        else:
+            for j in xrange(chunk):
+                tx.sendto(data, addr)
+        t2 = time()
+        try:
+            while True:
+                if batch > 0:
+                    got += len(receiver.recv(rx.fileno()))
+                else:
+                    rx.recvfrom(size)
+                    got += 1
+        except socket.error:
+            pass
+        t3 = time()
+        t_send += t2 - t1
+        t_recv += t3 - t2
+    return got, t_send, t_recv
+
+if __name__ == '__main__':
+    if not mmsg.available:
+        print 'recvmmsg/sendmmsg not available'
+        sys.exit(1)
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 256000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1400
+    batches = [int(x) for x in sys.argv[3:]] or [0, 8, 32, 64]
+
+    for batch in batches:
+        got, t_send, t_recv = run(n, size, batch)
+        name = 'batch %d' % batch if batch > 0 else 'single'
+        print '%-10s send %9.0f dgrams/s   recv %9.0f dgrams/s  (%d/%d)' % (
+                name, n / t_send, got / t_recv, got, n)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# mmsg.py
+#
+# ctypes bindings for linux's recvmmsg/sendmmsg, so we can move a whole batch
+# of (IPv4) UDP datagrams with one syscall.  'available' is False if libc
+# doesn't have them (not linux, old glibc), callers should fall back to
+# recvfrom/sendto.
+
+from ctypes import (
+    Structure, POINTER, pointer, get_errno, cast, addressof,
+    create_string_buffer, sizeof, memmove,
+    c_ushort, c_void_p, c_uint, c_int, c_uint16, c_uint32, c_size_t
+)
+from struct import Struct
+import ctypes.util
+import ctypes
+import errno
+import socket
+import platform
+
+MSG_DONTWAIT = 0x40
+
+sa_family_t = c_ushort
+socklen_t = c_uint32
+
+# <netinet/in.h>
+class struct_sockaddr_in(Structure):
+    _fields_ = [
+        ('sin_family', sa_family_t),
+        ('sin_port', c_uint16),
+        ('sin_addr', ctypes.c_ubyte * 4),
+        ('sin_zero', ctypes.c_ubyte * 8)]
+
+# <sys/uio.h>
+class struct_iovec(Structure):
+    _fields_ = [
+        ('iov_base', c_void_p),
+        ('iov_len', c_size_t)]
+
+# <sys/socket.h>
+class struct_msghdr(Structure):
+    _fields_ = [
+        ('msg_name', c_void_p),
+        ('msg_namelen', socklen_t),
+        ('msg_iov', POINTER(struct_iovec)),
+        ('msg_iovlen', c_size_t),
+        ('msg_control', c_void_p),
+        ('msg_controllen', c_size_t),
+        ('msg_flags', c_int)]
+
+class struct_mmsghdr(Structure):
+    _fields_ = [
+        ('msg_hdr', struct_msghdr),
+        ('msg_len', c_uint)]
+
+available = False
+if platform.system() == 'Linux':
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _recvmmsg = libc.recvmmsg
+        _sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        pass
+    else:
+        _recvmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint, c_int,
+                              c_void_p]
+        _recvmmsg.restype = c_int
+        _sendmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint, c_int]
+        _sendmmsg.restype = c_int
+        available = True
+
+def _error():
+    e = get_errno()
+    return socket.error(e, errno.errorcode.get(e, str(e)))
+
+
+class Receiver(object):
+    '''
+        Preallocated buffers for receiving up to n datagrams of up to size
+        bytes per recvmmsg call.
+    '''
+    def __init__(self, n=32, size=1024*10):
+        self.n = n
+        self.size = size
+        self._buf = create_string_buffer(n*size)
+        self._names = (struct_sockaddr_in * n)()
+        self._iovs = (struct_iovec * n)()
+        self._msgs = (struct_mmsghdr * n)()
+        base = addressof(self._buf)
+        for i in range(n):
+            self._iovs[i].iov_base = base + i*size
+            self._iovs[i].iov_len = size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_iov = pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+            # for AF_INET the kernel always hands back a full sockaddr_in,
+            # so these never need resetting
+            hdr.msg_name = addressof(self._names[i])
+            hdr.msg_namelen = sizeof(struct_sockaddr_in)
+
+        # read through plain buffer views, poking at the ctypes structs field
+        # by field costs more than the syscalls we save
+        self._bufv = buffer(self._buf)
+        self._namesv = buffer(self._names)
+        self._msgsv = buffer(self._msgs)
+        # raw sockaddr port+ip -> (ip, port)
+        self._addrs = {}
+
+    def _address(self, raw):
+        addr = self._addrs.get(raw)
+        if addr is None:
+            addr = (socket.inet_ntoa(raw[2:]), _port.unpack_from(raw)[0])
+            if len(self._addrs) > 1024:
+                self._addrs.clear()
+            self._addrs[raw] = addr
+        return addr
+
+    def recv(self, fd):
+        '''
+            Read what's waiting on fd (without blocking), return a list of
+            (data, (ip, port)).  Raises socket.error like recvfrom would
+            (EAGAIN when there's nothing to read).
+        '''
+        got = _recvmmsg(fd, self._msgs, self.n, MSG_DONTWAIT, None)
+        if got < 0:
+            raise _error()
+
+        bufv = self._bufv
+        namesv = self._namesv
+        msgsv = self._msgsv
+        size = self.size
+        unpack_len = _msg_len.unpack_from
+        addrs = self._addrs
+        address = self._address
+        ret = []
+        ap = ret.append
+        for i in range(got):
+            o = i*size
+            raw = namesv[i*_NAME_SIZE+2:i*_NAME_SIZE+8]
+            ap((bufv[o:o+unpack_len(msgsv, i*_MSG_SIZE+_MSG_LEN_OFFSET)[0]],
+                addrs.get(raw) or address(raw)))
+        return ret
+
+
+class Sender(object):
+    '''
+        Preallocated headers for sending up to n datagrams per sendmmsg call.
+    '''
+    def __init__(self, n=32):
+        self.n = n
+        self._names = (struct_sockaddr_in * n)()
+        self._iovs = (struct_iovec * n)()
+        self._msgs = (struct_mmsghdr * n)()
+        for i in range(n):
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_iov = pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_name = addressof(self._names[i])
+            hdr.msg_namelen = sizeof(struct_sockaddr_in)
+        self._names_addr = addressof(self._names)
+        self._iovs_addr = addressof(self._iovs)
+        # (ip, port) -> packed sockaddr_in
+        self._sockaddrs = {}
+
+    def _sockaddr(self, address):
+        sa = self._sockaddrs.get(address)
+        if sa is None:
+            ip, port = address
+            try:
+                sa = (_family.pack(socket.AF_INET) + _port.pack(port) 
+                        + socket.inet_aton(ip) + '\x00'*8)
+            except socket.error:
+                raise ValueError('not an IPv4 address: {0}'.format(ip))
+            if len(self._sockaddrs) > 1024:
+                self._sockaddrs.clear()
+            self._sockaddrs[address] = sa
+        return sa
+
+    def send(self, fd, datagrams):
+        '''
+            Send up to n (data, (ip, port)) on fd (without blocking).  Returns
+            how many were sent, which can be less than asked for if the
+            socket buffer filled up.  Raises socket.error if none were sent,
+            or ValueError if an address isn't IPv4.
+        '''
+        n = min(len(datagrams), self.n)
+        if n == 0:
+            return 0
+        names = []
+        iovs = []
+        sockaddr = self._sockaddr
+        for data, address in datagrams[:n]:
+            names.append(sockaddr(address))
+            # str's buffer is used in place, datagrams keeps it alive
+            iovs.append(_iovec.pack(cast(data, c_void_p).value, len(data)))
+        memmove(self._names_addr, ''.join(names), _NAME_SIZE*n)
+        memmove(self._iovs_addr, ''.join(iovs), _IOV_SIZE*n)
+
+        sent = _sendmmsg(fd, self._msgs, n, MSG_DONTWAIT)
+        if sent < 0:
+            raise _error()
+        return sent
+
+_MSG_SIZE = sizeof(struct_mmsghdr)
+_MSG_LEN_OFFSET = struct_mmsghdr.msg_len.offset
+_NAME_SIZE = sizeof(struct_sockaddr_in)
+_IOV_SIZE = sizeof(struct_iovec)
+_msg_len = Struct('=I')
+_family = Struct('=H')
+_port = Struct('!H')
+_iovec = Struct('PL') # void*, size_t (long sized on linux)
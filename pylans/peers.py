@@ -48,6 +48,12 @@ REGISTER_ACK        = 22)
 
 class PeerInfo(object):
     '''Represents a peer connection'''
+    # what the peer's router can do (see Router.features), peers from older
+    # versions don't send any
+    features = ()
+    # path mtu found by mods.pmtu (0 = unknown)
+    pmtu = 0
+
     def __init__(self, peer=None):
         self.id = 0                     # unique peer id
         self.name = 'wop'
@@ -62,6 +68,7 @@ class PeerInfo(object):
         self.relay_id = 0               # if not, who is the relay
         self.ping_time = 0              #
         self.timeouts = 0               # tracking ping timeouts
+        self.pmtu = 0                   # path mtu, 0 if unknown
 
 
     @property
@@ -107,6 +114,7 @@ class PeerManager(object):
         self._self.vip = util.encode_ip(router.network.ip)
         self._self.addr = '\x00'*router.addr_size # temp fake mac?
         self._self.port = router.network.wan_port
+        self._self.features = router.features
         self._my_pickle = pickle.dumps(self._self,-1)
 
         self.router = util.get_weakref_proxy(router)
@@ -175,7 +183,7 @@ class PeerManager(object):
                 peer.is_direct = False
                 peer.relay_id = self[peer.address].id
                 #try to DC
-                reactor.callLater(1, self.sm.try_greet, peer.direct_addresses)
+                reactor.callLater(1, self.sm.try_greet, peer)
             else:
                 peer.is_direct = True
                 peer.relay_id = None
@@ -222,7 +230,9 @@ class PeerManager(object):
 
     def update_peer(self, opi, npi):
         changed = False
-        if (opi.relays >= npi.relays and opi.address != npi.address):
+        # routes picked for latency (mods.routing) aren't ours to change
+        if (opi.relays >= npi.relays and opi.address != npi.address
+                and opi.id not in self.router.routing.pinned):
 
             logger.info('peer {0} relay changed: {1}->{2}, {3}->{4}'
                               .format(opi.name, opi.relays,npi.relays,
@@ -272,7 +282,7 @@ class PeerManager(object):
             logger.info('peer {0} good addresses changed: ({1})'
                 .format(opi.name, opi.direct_addresses))
             # try to DC
-            reactor.callLater(1, self.sm.try_greet, opi.direct_addresses)
+            reactor.callLater(1, self.sm.try_greet, opi)
 
         if changed:
             # fire event
@@ -454,6 +464,22 @@ class PeerManager(object):
                               util.get_weakref_proxy(self.try_old_peers))
 
 
+    def greet_peers(self):
+        '''Race greets to our peers' addresses again, in case a faster (or
+        direct) one answers now.'''
+        interval = settings.get_option(self.router.network.name + 
+                                        '/greet_interval', 60*5)
+        if self.router.network.is_running:
+            for peer in self.peer_list.values():
+                if not peer.is_direct or len(peer.direct_addresses) > 1:
+                    self.sm.try_greet(peer)
+
+        # re-schedule
+        if interval > 0:
+            reactor.callLater(interval, 
+                              util.get_weakref_proxy(self.greet_peers))
+
+
     def handle_reg(self, type, packet, address, src_id):
         '''Handle incoming reg packet by adding new peer and sending ack.'''
 
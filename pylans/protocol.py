@@ -1,31 +1,66 @@
 from twisted.internet import reactor, defer
 from twisted.internet import protocol
+from twisted.internet import udp
 from twisted.protocols import basic
+from twisted.python import log
+import errno
 import logging
+import socket
 import struct
 
 from . import util
+from .net import mmsg
 
 logger = logging.getLogger(__name__)
 
+# errnos for a full socket buffer
+_FULL = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
 
 class UDPPeerProtocol(protocol.DatagramProtocol):
     '''Protocol or sending/receiving data to peers'''
 
-    def __init__(self, recv_cb):
+    def __init__(self, recv_cb, recv_many_cb=None):
         self.recv = recv_cb
+        self.recv_many = recv_many_cb
 
     def send(self, data, address):
-        '''Send data to address'''
+        '''Send data to address.  False if the socket buffer is full, so it
+        can be tried again later (anything else that goes wrong just drops
+        it, it's UDP).'''
         try:
             logger.trace('sending {1} bytes on UDP port to {0}',
                             address, len(data))
             self.transport.write(data, address)
             
+        except socket.error, e:
+            if e.args[0] in _FULL:
+                return False
+            logger.warning('UDP send threw exception:\n  {0}', e)
         except Exception, e:
             logger.warning('UDP send threw exception:\n  {0}', e)
             ##TODO this is here because UDP socket fills up and just dies
             # but it's UDP so we can drop packets
+        return True
+
+    def send_many(self, datagrams):
+        '''Send a list of (data, address), returns how many went (the rest
+        didn't fit in the socket buffer)'''
+        write_many = getattr(self.transport, 'write_many', None)
+        if write_many is not None:
+            try:
+                logger.trace('sending {0} datagrams on UDP port', 
+                                len(datagrams))
+                return write_many(datagrams)
+            except Exception, e:
+                logger.warning('UDP batch send threw exception:\n  {0}', e)
+                # fall through and try them one at a time
+
+        send = self.send
+        for i, (data, address) in enumerate(datagrams):
+            if not send(data, address):
+                return i
+        return len(datagrams)
 
     def datagramReceived(self, data, address):
         '''Called by twisted when data is received from address'''
@@ -33,10 +68,81 @@ class UDPPeerProtocol(protocol.DatagramProtocol):
         logger.trace('received {1} bytes on UDP port from {0}',
                         address, len(data))
 
+    def datagramsReceived(self, datagrams):
+        '''Called by MMsgPort with a list of (data, address)'''
+        logger.trace('received {0} datagrams on UDP port', len(datagrams))
+        if self.recv_many is not None:
+            self.recv_many(datagrams)
+        else:
+            recv = self.recv
+            for data, address in datagrams:
+                recv(data, address)
+
     def connectionRefused(self):
         logger.warning('connectionRefused on UDP port')
 
 
+class MMsgPort(udp.Port):
+    '''UDP port that reads and writes batches of datagrams with
+    recvmmsg/sendmmsg.  Only use it if mmsg.available.'''
+
+    def __init__(self, port, proto, batch=32, interface='', maxPacketSize=8192,
+                    reactor=None):
+        udp.Port.__init__(self, port, proto, interface, maxPacketSize, reactor)
+        self._receiver = mmsg.Receiver(batch, maxPacketSize)
+        self._sender = mmsg.Sender(batch)
+
+    def doRead(self):
+        '''Called by twisted when the socket is readable'''
+        read = 0
+        recv = self._receiver.recv
+        n = self._receiver.n
+        fd = self.socket.fileno()
+        while read < self.maxThroughput:
+            try:
+                datagrams = recv(fd)
+            except socket.error, se:
+                no = se.args[0]
+                if no in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                if no == errno.ECONNREFUSED:
+                    self.protocol.connectionRefused()
+                    return
+                raise
+
+            for data, address in datagrams:
+                read += len(data)
+            try:
+                self.protocol.datagramsReceived(datagrams)
+            except:
+                log.err()
+
+            if len(datagrams) < n:
+                return # drained
+
+    def write_many(self, datagrams):
+        '''Write a list of (data, address), dropping whatever doesn't fit in
+        the socket buffer (it's UDP anyway).  Returns how many got sent.'''
+        fd = self.socket.fileno()
+        send = self._sender.send
+        sent = 0
+        while sent < len(datagrams):
+            try:
+                sent += send(fd, datagrams[sent:] if sent else datagrams)
+            except socket.error, se:
+                no = se.args[0]
+                if no == errno.EINTR:
+                    continue
+                if no in _FULL:
+                    logger.debug('UDP socket full, dropped {0} datagrams',
+                                    len(datagrams) - sent)
+                    break
+                # the first one failed (like sendto would have), drop it
+                logger.warning('UDP send threw exception:\n  {0}', se)
+                sent += 1
+        return sent
+
+
 class TCPPeerProtocol(basic.Int32StringReceiver):
     _type = 'TCP'
     def __init__(self, deferred, recv_cb, factory):
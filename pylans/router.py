@@ -23,19 +23,32 @@
 #     * clear peer list when going offline, if we go back online other peer things we are still connected
 #     * should we keep the peer list and just refresh/let it timeout, or clear it?
 
+from collections import OrderedDict
+import itertools
 import logging
 import random
-from struct import pack, unpack
+import sys
+from struct import pack, unpack, Struct
+from time import time
 import tuntap
 from tuntap.twisted import TwistedTunTap
 from twisted.internet import reactor, defer
+from twisted.internet.task import LoopingCall
 
 from . import util
 from .util.event import Event
 from .packets import PacketType
 from .peers import PeerManager
 from .mods.pinger import Pinger
+from .mods.pmtu import PathMTU, UDP_OVERHEAD
+from .mods.neighbours import NeighbourProxy
+from .mods.routing import Routing
+from .mods.multipath import Multipath
+from .mods.fec import FEC
 from . import sessions
+from . import compress
+from .crypto import AuthenticationError, suites
+from .crypto import pool as crypto_pool
 from .import settings
 
 logger = logging.getLogger(__name__)
@@ -45,8 +58,460 @@ PacketType.add(
     DATA_RELAY  =   2,
     ACK         =   3,
     RELAY       =   4,
+    AGGREGATE   =   5,
+    FRAGMENT    =   6,
+    MULTIPATH   =   7,
     ENCODED     =   0x80 )
 
+# [type-2B][id-2B][dst-16B][src-16B][data]
+_unpack_head = Struct('!2H').unpack_from
+_unpack_type = Struct('!H').unpack_from
+_SRC = 20
+_HEADER_SIZE = 36
+_NO_ID = '\x00'*16
+_DATA = int(PacketType.DATA)
+_AGGREGATE = int(PacketType.AGGREGATE)
+_FRAGMENT = int(PacketType.FRAGMENT)
+_MULTIPATH = int(PacketType.MULTIPATH)
+# DATA, AGGREGATE and MULTIPATH packets with this bit set in their type have
+# a compressed payload (see compress.py), FRAGMENTs have it in their id.
+# Either way the session's suite authenticates it with the header (see _ad),
+# so nobody on the way can make a frame out of compressed bytes, or the
+# other way round
+_COMPRESSED = int(PacketType.COMPRESSED)
+_ZDATA = _DATA | _COMPRESSED
+_ZAGGREGATE = _AGGREGATE | _COMPRESSED
+_ZMULTIPATH = _MULTIPATH | _COMPRESSED
+# DATA packets with a sequence number, for FEC (see mods.fec)
+_FEC_DATA = int(PacketType.FEC_DATA)
+_ZFEC_DATA = _FEC_DATA | _COMPRESSED
+# data packet types, packed.  Everything else is control, and goes first
+_BULK_HEADS = frozenset(pack('!H', t) for t in (_DATA, PacketType.DATA_RELAY,
+                                    _AGGREGATE, _FRAGMENT, _MULTIPATH,
+                                    _ZDATA, _ZAGGREGATE, _ZMULTIPATH,
+                                    _FEC_DATA, _ZFEC_DATA,
+                                    PacketType.FEC_PARITY))
+_ENCODED = int(PacketType.ENCODED)
+
+# AGGREGATE packets carry several data frames: ([len-2B][frame])*
+_frame_len = Struct('!H')
+
+def _frames(data):
+    '''Split an AGGREGATE packet back into frames'''
+    unpack_len = _frame_len.unpack_from
+    i, n = 0, len(data)
+    while i < n:
+        l = unpack_len(data, i)[0]
+        i += 2
+        yield data[i:i+l]
+        i += l
+
+# FRAGMENT packets carry a piece of a DATA packet's payload, too big for the
+# path mtu: [fragment id-4B][index-1B][count-1B][piece]
+_fragment = Struct('!IBB')
+
+# MULTIPATH packets are DATA packets with a sequence number for an id
+_pack_head = Struct('!2H').pack
+
+def _ad(head):
+    '''What a session's suite authenticates of a packet's header (see
+    crypto._Suite): all of it but the ack id, which FEC_DATA and MULTIPATH
+    packets use for a sequence number'''
+    return head[:2] + head[4:_HEADER_SIZE]
+
+# a FRAGMENT's payload is sealed under the header of the DATA packet it was
+# cut from, which its id says was compressed or not
+_DATA_TYPE = pack('!H', _DATA)
+_ZDATA_TYPE = pack('!H', _ZDATA)
+
+# most encryption adds to a packet (iv/nonce and tag, see crypto.suites)
+_CRYPTO_OVERHEAD = suites.MAX_OVERHEAD
+
+class SendContext(object):
+    '''Everything needed to send a DATA packet down one route (address, sid),
+    built once per route instead of once per packet: the packed header (and
+    the part of it the session's suite authenticates), the session's
+    encoders (one per tap queue), the session manager's send,
+    the biggest packet the path takes (from PeerInfo.pmtu) and the route's
+    Compressors (one per tap queue), if we compress for it.
+
+    Contexts are only made, and only send, on the reactor thread.  Tap queue
+    workers seal packets with their own lane's encoder and compressor, for
+    contexts that take lanes, and hand the result to the reactor.'''
+    __slots__ = ('address', 'sid', 'head', 'encoders', 'send', 'limit',
+                 'frag_head', 'frag_ids', 'compressor', 'compressors',
+                 'zhead', 'ad', 'zad')
+
+    # whether tap queue workers can seal packets for it (the subclasses
+    # that keep per route state for their own sending don't)
+    lanes = True
+
+    def __init__(self, router, route):
+        self.address, self.sid = route
+        self.head = pack('!2H', PacketType.DATA, 0) + self.sid \
+                                                    + router.pm._self.id
+        self.encoders = router.sm.encoders(self.sid)
+        self.send = router.sm.send
+
+        pmtu = getattr(router.pm.get(self.sid), 'pmtu', 0)
+        self.limit = pmtu - UDP_OVERHEAD if pmtu else sys.maxint
+        self.frag_head = pack('!2H', PacketType.FRAGMENT, 0) + self.sid \
+                                                    + router.pm._self.id
+        self.frag_ids = router.fragment_ids
+        self.compressors = [router.compressor(self.sid)
+                                                for e in self.encoders]
+        self.compressor = self.compressors[0]
+        self.zhead = _pack_head(_ZDATA, 0) + self.sid + router.pm._self.id
+        self.ad = _ad(self.head)
+        self.zad = _ad(self.zhead)
+
+    def __call__(self, packet, lane=0):
+        if self.compressor is not None:
+            z = self.compressor(packet)
+            if z is not None:
+                data = self.zhead + self.encoders[lane](z, self.zad)
+                if len(data) > self.limit:
+                    return self.fragment(data, True)
+                return self.send(data, self.sid, self.address)
+        data = self.head + self.encoders[lane](packet, self.ad)
+        if len(data) > self.limit:
+            return self.fragment(data)
+        return self.send(data, self.sid, self.address)
+
+    def seal(self, packet, lane):
+        '''The datagrams to send for packet, encrypted (and compressed) on
+        lane, for a tap queue worker to hand to the reactor'''
+        compressor = self.compressors[lane]
+        if compressor is not None:
+            z = compressor(packet)
+            if z is not None:
+                return self.seal_payload(z, True, lane)
+        return self.seal_payload(packet, False, lane)
+
+    def seal_payload(self, payload, compressed, lane=0):
+        '''The datagrams to send for a (compressed) payload as DATA,
+        encrypted on lane'''
+        if compressed:
+            data = self.zhead + self.encoders[lane](payload, self.zad)
+        else:
+            data = self.head + self.encoders[lane](payload, self.ad)
+        if len(data) > self.limit:
+            return self.pieces(data, compressed)
+        return [data]
+
+    def fragment(self, data, compressed=False):
+        '''Send a DATA packet that's too big for the path in pieces'''
+        for piece in self.pieces(data, compressed):
+            self.send(piece, self.sid, self.address)
+
+    def pieces(self, data, compressed=False):
+        '''The FRAGMENT packets for a DATA packet that's too big for the
+        path'''
+        payload = buffer(data, _HEADER_SIZE)
+        step = self.limit - _HEADER_SIZE - _fragment.size
+        count = -(-len(payload) // step)
+        # (count's next() is one call into C, safe from the workers too)
+        id = self.frag_ids.next() & 0xFFFFFFFF
+        head = self.frag_head
+        if compressed:
+            head = _pack_head(_FRAGMENT, _COMPRESSED) + head[4:]
+        return [head + _fragment.pack(id, i, count)
+                    + payload[i*step:(i+1)*step] for i in xrange(count)]
+
+class PooledSendContext(SendContext):
+    '''SendContext for when the crypto pool is on: packets are held until the
+    end of the reactor iteration and encrypted as one batch.'''
+    __slots__ = ('pending', 'sm', 'schedule')
+    lanes = False
+
+    def __init__(self, router, route):
+        SendContext.__init__(self, router, route)
+        self.pending = []
+        self.sm = router.sm
+        self.schedule = router.call_after_batch
+
+    def __call__(self, packet, lane=0):
+        if not self.pending:
+            self.schedule(self.flush)
+        self.pending.append(packet)
+
+    def flush(self):
+        packets, self.pending = self.pending, []
+        compressed = None
+        ads = [self.ad] * len(packets)
+        if self.compressor is not None:
+            compressed = []
+            for i, packet in enumerate(packets):
+                z = self.compressor(packet)
+                if z is not None:
+                    packets[i] = z
+                    ads[i] = self.zad
+                compressed.append(z is not None)
+        self.sm.encode_many(self.sid, packets, 
+                            lambda encoded: self.sent(encoded, compressed),
+                            ads)
+
+    def sent(self, encoded, compressed=None):
+        head, send, sid, address = self.head, self.send, self.sid, self.address
+        limit = self.limit
+        self.sm.cork()
+        try:
+            for i, data in enumerate(encoded):
+                if data:
+                    z = compressed is not None and compressed[i]
+                    data = (self.zhead if z else head) + data
+                    if len(data) > limit:
+                        self.fragment(data, z)
+                    else:
+                        send(data, sid, address)
+        finally:
+            self.sm.uncork()
+
+class AggregatingSendContext(SendContext):
+    '''SendContext for peers that take AGGREGATE packets: small frames are 
+    held until the flush delay is up (or enough of them pile up) and go out
+    together, encrypted once, as one packet.  Only the reactor thread
+    aggregates, tap queue workers (lane > 0) send straight through.'''
+    __slots__ = ('agg_head', 'agg_zhead', 'agg_ad', 'agg_zad', 'held',
+                 'held_size', 'max_size', 'small', 'delay', 'timer',
+                 'schedule')
+
+    def __init__(self, router, route):
+        SendContext.__init__(self, router, route)
+        self.agg_head = pack('!2H', PacketType.AGGREGATE, 0) + self.sid \
+                                                    + router.pm._self.id
+        self.agg_zhead = _pack_head(_ZAGGREGATE, 0) + self.agg_head[4:]
+        self.agg_ad = _ad(self.agg_head)
+        self.agg_zad = _ad(self.agg_zhead)
+        self.held = []
+        self.held_size = 0
+        # has to fit the path too
+        self.max_size = min(router.aggregate_size, 
+                            self.limit - _HEADER_SIZE - _CRYPTO_OVERHEAD)
+        # bigger frames don't gain much, send them alone
+        self.small = self.max_size // 2
+        self.delay = router.aggregate_delay
+        self.timer = None
+        self.schedule = router.call_after_batch
+
+    def __call__(self, packet, lane=0):
+        size = len(packet) + _frame_len.size
+        if lane:
+            return SendContext.__call__(self, packet, lane)
+        if size > self.small:
+            # keep frames in order
+            if self.held:
+                self.flush()
+            return SendContext.__call__(self, packet)
+
+        if self.held_size + size > self.max_size:
+            self.flush()
+        if not self.held:
+            if self.delay > 0:
+                self.timer = reactor.callLater(self.delay, self.flush)
+            else:
+                self.schedule(self.flush)
+        self.held.append(_frame_len.pack(len(packet)) + packet)
+        self.held_size += size
+
+    def flush(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        held, self.held, self.held_size = self.held, [], 0
+        if len(held) > 1:
+            payload, head, ad = ''.join(held), self.agg_head, self.agg_ad
+            if self.compressor is not None:
+                z = self.compressor(payload)
+                if z is not None:
+                    payload, head, ad = z, self.agg_zhead, self.agg_zad
+            self.send(head + self.encoders[0](payload, ad), self.sid, 
+                                                            self.address)
+        elif held:
+            SendContext.__call__(self, held[0][_frame_len.size:])
+
+class MultipathSendContext(SendContext):
+    '''SendContext for a peer with more than one live path (see
+    mods.multipath): frames go out as MULTIPATH packets, small ones down the
+    best two paths, the rest spread over all of them by weight.  Frames that
+    might not fit the path mtu go down the main route as plain DATA (in
+    pieces if they don't), sealed under that header.  The paths' weights
+    are shared, so only the reactor thread sends here.'''
+    __slots__ = ('paths', 'seq', 'tail', 'dup_size', 'mp_ad', 'mp_zad')
+    lanes = False
+
+    def __init__(self, router, route, paths):
+        SendContext.__init__(self, router, route)
+        self.paths = paths
+        self.seq = router.multipath.seq(self.sid)
+        self.tail = self.sid + router.pm._self.id
+        self.dup_size = router.multipath.dup_size
+        self.mp_ad = _ad(_pack_head(_MULTIPATH, 0) + self.tail)
+        self.mp_zad = _ad(_pack_head(_ZMULTIPATH, 0) + self.tail)
+
+    def __call__(self, packet, lane=0):
+        payload, type, ad = packet, _MULTIPATH, self.mp_ad
+        if self.compressor is not None:
+            z = self.compressor(packet)
+            if z is not None:
+                payload, type, ad = z, _ZMULTIPATH, self.mp_zad
+        if len(payload) + _HEADER_SIZE + _CRYPTO_OVERHEAD > self.limit:
+            for data in self.seal_payload(payload, type == _ZMULTIPATH,
+                                                                    lane):
+                self.send(data, self.sid, self.address)
+            return
+        data = _pack_head(type, self.seq.next() & 0xFFFF) + self.tail \
+                                        + self.encoders[lane](payload, ad)
+        paths = self.paths
+        if len(packet) <= self.dup_size:
+            self.send(data, self.sid, paths[0].address)
+            self.send(data, self.sid, paths[1].address)
+            return
+
+        # smooth weighted round robin
+        best, total = None, 0.0
+        for p in paths:
+            p.current += p.weight
+            total += p.weight
+            if best is None or p.current > best.current:
+                best = p
+        best.current -= total
+        self.send(data, self.sid, best.address)
+
+class FecSendContext(SendContext):
+    '''SendContext for a lossy peer (see mods.fec): frames go out as FEC_DATA
+    packets through the peer's fec Sender, which follows each group of them
+    with a parity packet.  Only the reactor thread does FEC, tap queue
+    workers (lane > 0) send plain DATA, and so do frames that might not fit
+    the path mtu (in pieces if they don't).'''
+    __slots__ = ('sender', 'fec_ad', 'fec_zad')
+
+    def __init__(self, router, route):
+        SendContext.__init__(self, router, route)
+        self.sender = router.fec.sender(self.sid, self.address, self.send)
+        self.fec_ad = _ad(_pack_head(_FEC_DATA, 0) + self.head[4:])
+        self.fec_zad = _ad(_pack_head(_ZFEC_DATA, 0) + self.head[4:])
+
+    def __call__(self, packet, lane=0):
+        if lane:
+            return SendContext.__call__(self, packet, lane)
+        payload, compressed = packet, False
+        if self.compressor is not None:
+            z = self.compressor(packet)
+            if z is not None:
+                payload, compressed = z, True
+        if len(payload) + _HEADER_SIZE + _CRYPTO_OVERHEAD > self.limit:
+            for data in self.seal_payload(payload, compressed):
+                self.send(data, self.sid, self.address)
+            return
+        ad = self.fec_zad if compressed else self.fec_ad
+        self.sender.send_data(self.encoders[0](payload, ad), compressed)
+
+class RouteMap(dict):
+    '''
+        Forwarding table, addr -> (address, sid).  Changing or removing a route
+        drops its cached SendContext.
+
+        Routes set directly (peers' own macs) stay until they're removed.
+        Routes learned from frames off the wire age out after max_age seconds
+        without a frame from that addr, and there are never more than
+        max_learned of them.  Keeps when each addr was last seen and how many
+        frames came from it, and which addrs each sid is the route for.
+    '''
+    def __init__(self, contexts, max_age=300.0, max_learned=4096):
+        dict.__init__(self)
+        self._contexts = contexts
+        self.max_age = max_age
+        self.max_learned = max_learned
+        # addr -> [last seen, hits], sid -> set of addrs, learned addrs
+        self.stats = {}
+        self.by_sid = {}
+        self.learned = set()
+
+    def _unindex(self, addr):
+        route = dict.get(self, addr)
+        if route is not None:
+            addrs = self.by_sid.get(route[-1])
+            if addrs is not None:
+                addrs.discard(addr)
+                if not addrs:
+                    del self.by_sid[route[-1]]
+
+    def __setitem__(self, addr, route):
+        self._contexts.pop(addr, None)
+        self._unindex(addr)
+        dict.__setitem__(self, addr, route)
+        self.by_sid.setdefault(route[-1], set()).add(addr)
+        self.stats.setdefault(addr, [time(), 0])
+        self.learned.discard(addr)
+
+    def __delitem__(self, addr):
+        self._contexts.pop(addr, None)
+        self._unindex(addr)
+        dict.__delitem__(self, addr)
+        self.stats.pop(addr, None)
+        self.learned.discard(addr)
+
+    def pop(self, addr, *default):
+        if addr in self:
+            route = self[addr]
+            del self[addr]
+            return route
+        return dict.pop(self, addr, *default)
+
+    def clear(self):
+        self._contexts.clear()
+        dict.clear(self)
+        self.stats.clear()
+        self.by_sid.clear()
+        self.learned.clear()
+
+    def seen(self, addr, route):
+        '''A frame from addr came in over route, learn it if it's new (or
+        moved, for a learned addr).'''
+        stats = self.stats.get(addr)
+        if stats is not None:
+            stats[0] = time()
+            stats[1] += 1
+            if addr in self.learned and dict.__getitem__(self, addr) != route:
+                self.learn(addr, route)
+            return False
+        self.learn(addr, route)
+        self.stats[addr][1] = 1
+        return True
+
+    def learn(self, addr, route):
+        '''Add a route that ages out'''
+        if addr not in self.learned and len(self.learned) >= self.max_learned:
+            self.expire()
+            if len(self.learned) >= self.max_learned:
+                # still full, make room by dropping the stalest
+                stats = self.stats
+                del self[min(self.learned, key=lambda a: stats[a][0])]
+        self[addr] = route
+        self.learned.add(addr)
+
+    def expire(self):
+        '''Drop learned routes that have been idle for max_age'''
+        limit = time() - self.max_age
+        stats = self.stats
+        for addr in [a for a in self.learned if stats[a][0] < limit]:
+            logger.debug('aging out addr map {0}', addr.encode('hex'))
+            del self[addr]
+
+    def drop_session(self, sid):
+        '''Remove every route through sid, returns their addrs'''
+        addrs = list(self.by_sid.get(sid, ()))
+        for addr in addrs:
+            del self[addr]
+        return addrs
+
+    def dump(self):
+        '''[(addr, route, learned, idle seconds, hits)] sorted by addr'''
+        now = time()
+        return [(addr, route, addr in self.learned, now - self.stats[addr][0],
+                    self.stats[addr][1]) for addr, route in sorted(self.items())]
+
 class Router(object):
     '''The router object handles all the traffic between the virtual tun/tap
     device and the peers.  All traffic flows through the router, where it is
@@ -56,34 +521,122 @@ class Router(object):
     Packet format: TBD'''
     __version__ = pack('!H', 2)
 
+    # advertised to peers in our PeerInfo
+    features = ('aggregate', 'pmtu', 'multipath', 'fec', 'spake2',
+                                                'resume') + compress.features
+
+    # packed types of data packets, control ones get priority over these
+    bulk_heads = _BULK_HEADS
+
+    # FRAGMENT reassembly: how many packets to hold, and for how long (s),
+    # the most bytes to hold in all, and in one packet
+    MAX_REASSEMBLY = 256
+    REASSEMBLY_TIMEOUT = 2.0
+    MAX_REASSEMBLY_BYTES = 4 << 20
+    MAX_FRAGMENTED = 65536
+
     TIMEOUT = 5 # 5s
 
     #USER = 0x80
 
     def __init__(self, network, tuntap=None):
+        use_ssl = settings.get_option(network.name + '/' + 'use_ssl', False)
+        use_tcp = settings.get_option(network.name + '/' + 'use_tcp', False)
+
+        # worker processes to do data packet crypto in
+        self.crypto_workers = settings.get_option(network.name + '/'
+                                                    + 'crypto_workers', 0)
+        if self.crypto_workers > 0 and (use_ssl or use_tcp):
+            logger.warning('crypto_workers only works with UDP sessions')
+            self.crypto_workers = 0
+        elif self.crypto_workers > 0 and not crypto_pool.available:
+            logger.warning('crypto_workers not supported on this platform')
+            self.crypto_workers = 0
+
+        # hold small data frames for up to this many seconds (0 = until the
+        # end of the reactor iteration, None = don't) and send them together
+        # in packets of up to aggregate_size bytes, to peers that can take it
+        self.aggregate_delay = settings.get_option(network.name + '/'
+                                                    + 'aggregate_delay', None)
+        self.aggregate_size = settings.get_option(network.name + '/'
+                                                    + 'aggregate_size', 1400)
+        if self.aggregate_delay is not None and self.crypto_workers > 0:
+            logger.warning('aggregate_delay doesn\'t work with crypto_workers'
+                            +', not aggregating')
+            self.aggregate_delay = None
+
+        # compress data for peers that take it (compress_codec 'auto' picks
+        # the best one we both have), frames smaller than compress_min_size
+        # aren't worth it
+        self.compression = settings.get_option(network.name + '/'
+                                                    + 'compression', False)
+        self.compress_codec = settings.get_option(network.name + '/'
+                                                + 'compress_codec', 'auto')
+        self.compress_min_size = settings.get_option(network.name + '/'
+                                                + 'compress_min_size', 128)
+
+        # tap queues, each one besides the first gets its own worker thread
+        self.tap_queues = settings.get_option(network.name + '/' 
+                                                    + 'tap_queues', 1)
+        if self.tap_queues > 1 and self.crypto_workers > 0:
+            logger.warning('tap_queues and crypto_workers don\'t mix, using'
+                            +' 1 queue')
+            self.tap_queues = 1
+        if self.tap_queues > 1 and (use_ssl or use_tcp or tuntap is not None):
+            logger.warning('tap_queues only works with UDP sessions and our'
+                            +' own tun/tap device, using 1 queue')
+            self.tap_queues = 1
+
         if tuntap is None and settings.tap_access:
             mode = network.adapter_mode
+            # frames to drain from the device per reactor wakeup (0 = one)
+            batch = settings.get_option(network.name + '/' + 'tap_batch', 0)
+            kw = {}
+            if self.tap_queues > 1:
+                kw = dict(queues=self.tap_queues, 
+                          queue_callback=self.send_packets_on)
             try:
-                tuntap = TwistedTunTap(self.send_packet, mode=mode)
+                tuntap = TwistedTunTap(self.send_packet, mode=mode,
+                                        batch_callback=self.send_packets,
+                                        batch_size=batch, **kw)
 
                 logger.info('Initializing router in {0} mode.',
                             'TAP' if tuntap.is_tap else 'TUN')
             except Exception:
                 logger.error('Could not access tun/tap device.', exc_info=True)
                 settings.tap_access = False
+                self.tap_queues = 1
 
         self.handlers = {}
+        # int packet type -> (PacketType, handlers), for recv
+        self._dispatch = {}
         self._requested_acks = {}
-        self.addr_map = {}
+        # addr -> SendContext, filled in as packets go out
+        self._send_ctx = {}
+        # with crypto workers: things to run once this reactor iteration's
+        # packets are all in, and src -> (payloads, ads, addresses, kinds)
+        # to decode
+        self._after_batch = []
+        self._decoding = {}
+        # FRAGMENT ids for SendContexts, and (src, id) -> [time, count, 
+        # {index: piece}, bytes] for reassembly, oldest first, and the bytes
+        # in all of them
+        self.fragment_ids = itertools.count()
+        self._fragments = OrderedDict()
+        self._fragment_bytes = 0
+        self.addr_map = RouteMap(self._send_ctx,
+                settings.get_option(network.name + '/' + 'mac_age', 300.0),
+                settings.get_option(network.name + '/' + 'mac_table_size', 4096))
+        self._expire_lp = LoopingCall(self.addr_map.expire)
 
         # store weakref so we can be gc'd
         self.network = util.get_weakref_proxy(network)
 
         # check if we are using SSL
-        if settings.get_option(self.network.name + '/' + 'use_ssl', False):
+        if use_ssl:
             logger.info('network {0} using SSL mode', self.network.name)
             self.sm = sessions.SSLSessionManager(self)
-        elif settings.get_option(self.network.name + '/' + 'use_tcp', False):
+        elif use_tcp:
             logger.info('network {0} using TCP mode', self.network.name)
             self.sm = sessions.TCPSessionManager(self)
         else:
@@ -97,6 +650,10 @@ class Router(object):
 #        watcher.Watcher('addr_map',self.__dict__)
         # move this out of router?TODO
         self.pinger = Pinger(self)
+        self.pmtu = PathMTU(self)
+        self.routing = Routing(self)
+        self.multipath = Multipath(self)
+        self.fec = FEC(self)
 
         self._tuntap = tuntap
 
@@ -147,13 +704,29 @@ class Router(object):
 
         self._bootstrap.start()
         self.pinger.start()
+        self.pmtu.start()
+        self.routing.start()
+        self.multipath.start()
+        self.fec.start()
+        self._expire_lp.start(min(self.addr_map.max_age, 60), now=False)
         reactor.callLater(1, util.get_weakref_proxy(self.pm.try_old_peers))
+        interval = settings.get_option(self.network.name + '/greet_interval',
+                                            60*5)
+        if interval > 0:
+            reactor.callLater(interval,
+                                util.get_weakref_proxy(self.pm.greet_peers))
 
     @defer.inlineCallbacks
     def stop(self):
         '''Stop the router.  Stops the tun/tap device and stops listening on the
         UDP port.'''
         self.pinger.stop()
+        self.pmtu.stop()
+        self.routing.stop()
+        self.multipath.stop()
+        self.fec.stop()
+        if self._expire_lp.running:
+            self._expire_lp.stop()
         self._bootstrap.stop()
         
         if self._tuntap is not None:
@@ -174,7 +747,7 @@ class Router(object):
 
 
     def send(self, type, data, dst, ack=False, id=0, ack_timeout=None, 
-                clear=False, faddress=None):
+                clear=False, faddress=None, lane=0):
         '''Send a packet of type with data to address.  Address should be an id
         if the peer is known, since address tuples aren't unique with relaying
         
@@ -184,15 +757,16 @@ class Router(object):
         if type == PacketType.DATA:
             dst_id = dst[1]
             dst = dst[0]
+            head = pack('!2H', type, id) + dst_id + self.pm._self.id
             # encode
             try:
-                data = self.sm.encode(dst_id, data)
+                data = self.sm.encode(dst_id, data, lane, _ad(head))
             except KeyError, s:
                 logger.critical('failed to encode data packet: {0}', s)
                 return #TODO
                 
             # pack
-            data = pack('!2H', type, id) + dst_id + self.pm._self.id + data
+            data = head + data
             # send
             return self.sm.send(data, dst_id, dst)
 
@@ -232,20 +806,16 @@ class Router(object):
 
         # want ack?
         if ack or id > 0:
-            if id == 0:
-                id = random.randint(0, 0xFFFF)
-            d = defer.Deferred()
-            timeout = ack_timeout if ack_timeout is not None else self.TIMEOUT
-            timeout_call = reactor.callLater(timeout, util.get_weakref_proxy
-                                                (self._timeout), id)
-            self._requested_acks[id] = (d, timeout_call)
+            id, d = self.request_ack(id, ack_timeout)
         else:
             d = None
 
         # encode the data
         if data != '' and not clear:
             if dst_id in self.sm.session_map:
-                data = self.sm.encode(dst_id, pack('!H',type) + data)
+                data = self.sm.encode(dst_id, pack('!H',type) + data,
+                                ad=_ad(pack('!2H', PacketType.ENCODED, id)
+                                            + dst_id + self.pm._self.id))
             #logger.debug('encoding packet {0}', type)
                 type = PacketType.ENCODED
             else:
@@ -262,6 +832,19 @@ class Router(object):
 
         return d
 
+    def request_ack(self, id=0, timeout=None):
+        '''Get ready for an ACK to a packet we're about to send.  Returns the
+        id to send it with and a deferred that fires when the ACK gets here
+        (or errbacks on timeout).'''
+        if id == 0:
+            id = random.randint(1, 0xFFFF)
+        d = defer.Deferred()
+        timeout = timeout if timeout is not None else self.TIMEOUT
+        timeout_call = reactor.callLater(timeout, util.get_weakref_proxy
+                                            (self._timeout), id)
+        self._requested_acks[id] = (d, timeout_call)
+        return id, d
+
     def handle_ack(self, type, data, address, src):
         '''called when we get an ack packet'''
         id = unpack('!H', data)[0]
@@ -283,45 +866,190 @@ class Router(object):
         else:
             logger.info('timeout called with bad id??!!?')
 
+    def send_context(self, addr):
+        '''Get the SendContext for the route to addr, or None if there is no
+        route (or no session for it yet).'''
+        ctx = self._send_ctx.get(addr)
+        if ctx is None:
+            route = self.addr_map.get(addr)
+            if route is None:
+                return None
+            try:
+                paths = self.multipath.live_paths(route[1])
+                if self.crypto_workers > 0:
+                    ctx = PooledSendContext(self, route)
+                elif paths:
+                    ctx = MultipathSendContext(self, route, paths)
+                elif route[1] in self.fec.groups:
+                    ctx = FecSendContext(self, route)
+                elif self.aggregate_delay is not None and 'aggregate' in \
+                            getattr(self.pm.get(route[1]), 'features', ()):
+                    ctx = AggregatingSendContext(self, route)
+                else:
+                    ctx = SendContext(self, route)
+            except (KeyError, sessions.UnknownSessionError), s:
+                logger.critical('failed to encode data packet: {0}', s)
+                return None
+            self._send_ctx[addr] = ctx
+        return ctx
+
+    def compressor(self, sid):
+        '''A Compressor for data to peer sid, or None if we don't compress
+        for it (or it can't decompress)'''
+        if not self.compression:
+            return None
+        codec = compress.pick(getattr(self.pm.get(sid), 'features', ()),
+                                                        self.compress_codec)
+        if codec is None:
+            return None
+        return compress.Compressor(codec, self.compress_min_size)
+
+    def call_after_batch(self, f):
+        '''Call f once the packets read in this reactor iteration have all
+        been handled, so they can be worked on as a batch.'''
+        if not self._after_batch:
+            reactor.callLater(0, self._run_after_batch)
+        self._after_batch.append(f)
+
+    def _run_after_batch(self):
+        fs, self._after_batch = self._after_batch, []
+        for f in fs:
+            try:
+                f()
+            except Exception:
+                logger.error('batch callback failed', exc_info=True)
+
+    def drop_send_contexts(self, sid):
+        '''Forget the SendContexts going through session sid, called when its
+        address or keys change.'''
+        for addr in [k for k, ctx in self._send_ctx.items() if ctx.sid == sid]:
+            del self._send_ctx[addr]
+
     def send_packet(self, packet):
         '''Got a packet from the tun/tap device that needs to be sent out'''
         pass
 
+    def send_packets(self, packets):
+        '''Got a batch of packets from the tun/tap device that need to be
+        sent out'''
+        send_packet = self.send_packet
+        # send them as a batch too
+        self.sm.cork()
+        try:
+            for packet in packets:
+                send_packet(packet)
+        finally:
+            self.sm.uncork()
+
+    def send_packets_on(self, packets, queue):
+        '''Got a batch of packets from tun/tap queue that need to be sent out.
+        Called from that queue's worker thread.'''
+        pass
+
     def recv(self, data, address):
         '''Received a packet from the protocol port.
         Parse it and send it on its way.
         Data types get special treatment to reduce overhead.'''
 
-        # get dst and src 128-bit ids
-        dst = data[4:20]
+        if len(data) < _HEADER_SIZE:
+            logger.warning('dropping runt packet ({0} bytes) from {1}',
+                                                        len(data), address)
+            return
+
+        # get dst 128-bit id
+        dst = data[4:_SRC]
 
         # ours?
-        if dst == self.pm._self.id or dst == '\x00'*16:
-            # packet type
-            pt = unpack('!H', data[:2])[0]
-            # get dst and src 128-bit ids
-            src = data[20:36]
+        if dst == self.pm._self.id or dst == _NO_ID:
+            # packet type, ack id and src 128-bit id
+            pt, id = _unpack_head(data)
+            src = data[_SRC:_HEADER_SIZE]
 
-            if pt == PacketType.DATA:
+            if pt == _DATA:
                 # data packets are always encrypted
-                packet = self.sm.decode(src, data[36:])
+                if self.crypto_workers > 0:
+                    return self._decode_later(src, data[_HEADER_SIZE:],
+                                                _ad(data), address, False)
+
+                packet = self.sm.decode(src, data[_HEADER_SIZE:], _ad(data))
                 self.recv_packet(packet, src, address)
 
+            elif pt == _FRAGMENT:
+                # piece of a data packet that didn't fit the path
+                payload = self.reassemble(src, data)
+                if payload is None:
+                    return
+                ad = (_ZDATA_TYPE if id != 0 else _DATA_TYPE) \
+                                                + data[4:_HEADER_SIZE]
+                if self.crypto_workers > 0:
+                    return self._decode_later(src, payload, ad, address,
+                                                            False, id != 0)
+
+                packet = self.sm.decode(src, payload, ad)
+                if id != 0:
+                    packet = compress.decompress(packet)
+                    if packet is None:
+                        return self._bad_compressed(src)
+                self.recv_packet(packet, src, address)
+
+            elif pt == _MULTIPATH:
+                # data frame that may come in out of order, or twice
+                packet = self.sm.decode(src, data[_HEADER_SIZE:], _ad(data))
+                self.multipath.recv(src, id, packet, address)
+
+            elif pt == _AGGREGATE:
+                # several data frames in one
+                if self.crypto_workers > 0:
+                    return self._decode_later(src, data[_HEADER_SIZE:], 
+                                                _ad(data), address, True)
+
+                packet = self.sm.decode(src, data[_HEADER_SIZE:], _ad(data))
+                for frame in _frames(packet):
+                    self.recv_packet(frame, src, address)
+
+            elif pt == _FEC_DATA or pt == _ZFEC_DATA:
+                # data packet in a group with a parity packet
+                self.fec.recv_data(src, id, data[_HEADER_SIZE:],
+                                            pt == _ZFEC_DATA, address)
+
+            elif pt == _ZDATA or pt == _ZAGGREGATE or pt == _ZMULTIPATH:
+                # data packets with compressed payloads
+                if self.crypto_workers > 0 and pt != _ZMULTIPATH:
+                    return self._decode_later(src, data[_HEADER_SIZE:],
+                                _ad(data), address, pt == _ZAGGREGATE, True)
+
+                packet = compress.decompress(self.sm.decode(src,
+                                            data[_HEADER_SIZE:], _ad(data)))
+                if packet is None:
+                    return self._bad_compressed(src)
+                if pt == _ZDATA:
+                    self.recv_packet(packet, src, address)
+                elif pt == _ZAGGREGATE:
+                    for frame in _frames(packet):
+                        self.recv_packet(frame, src, address)
+                else:
+                    self.multipath.recv(src, id, packet, address)
+
             else:
-                if pt == PacketType.ENCODED:
-                    packet = self.sm.decode(src, data[36:])
-                    pt, packet = unpack('!H',packet[:2])[0], packet[2:]
+                if pt == _ENCODED:
+                    packet = self.sm.decode(src, data[_HEADER_SIZE:],
+                                                                _ad(data))
+                    pt, packet = _unpack_type(packet)[0], packet[2:]
                 else:
-                    packet = data[36:]
+                    packet = data[_HEADER_SIZE:]
 
-                id = unpack('!H', data[2:4])[0]
-                pt = PacketType(pt)
+                # int -> PacketType (and handlers) without the enum metaclass
+                entry = self._dispatch.get(pt)
+                if entry is not None:
+                    pt, handler = entry
+                else:
+                    pt, handler = PacketType(pt), None
 
                 logger.trace('handling {0} packet from {1}', pt, 
                                                         src.encode('hex'))
-                if pt in self.handlers:
+                if handler is not None:
                     try:
-                        self.handlers[pt](pt, packet, address, src)
+                        handler(pt, packet, address, src)
                     except Exception, e:
                         logger.error('packet handler for packet type {1} raised\
                             exception: {0}', e, pt, exc_info=True)
@@ -343,6 +1071,126 @@ class Router(object):
             return self.relay(data, dst)
 
 
+    def reassemble(self, src, data):
+        '''Add a FRAGMENT packet to the reassembly table, return the whole
+        DATA payload once all its pieces are in.  FRAGMENTs aren't
+        authenticated (the payload is, once it's whole), so pieces that don't
+        agree with the first one's count are dropped, and so are packets that
+        would hold more than MAX_FRAGMENTED bytes.'''
+        if len(data) < _HEADER_SIZE + _fragment.size:
+            return None
+        id, index, count = _fragment.unpack_from(data, _HEADER_SIZE)
+        if index >= count:
+            return None
+        piece = data[_HEADER_SIZE + _fragment.size:]
+        key = (src, id)
+        fragments = self._fragments
+        entry = fragments.get(key)
+        if entry is None:
+            # make room, dropping what's too old to finish
+            now = time()
+            expired = now - self.REASSEMBLY_TIMEOUT
+            while fragments and (len(fragments) >= self.MAX_REASSEMBLY or
+                            fragments[next(iter(fragments))][0] < expired):
+                logger.debug('dropping incomplete fragmented packet')
+                self._drop_fragments(next(iter(fragments)))
+            entry = fragments[key] = [now, count, {}, 0]
+        elif count != entry[1]:
+            logger.debug('dropping fragment {0}/{1} of a packet in {2}',
+                                                    index, count, entry[1])
+            return None
+
+        pieces = entry[2]
+        grow = len(piece) - len(pieces.get(index, ''))
+        if entry[3] + grow > self.MAX_FRAGMENTED:
+            logger.debug('dropping fragmented packet over {0} bytes',
+                                                    self.MAX_FRAGMENTED)
+            self._drop_fragments(key)
+            return None
+        # and the oldest ones (maybe this one) for its bytes
+        while self._fragment_bytes + grow > self.MAX_REASSEMBLY_BYTES:
+            oldest = next(iter(fragments))
+            logger.debug('dropping incomplete fragmented packet')
+            self._drop_fragments(oldest)
+            if oldest == key:
+                return None
+        pieces[index] = piece
+        entry[3] += grow
+        self._fragment_bytes += grow
+        if len(pieces) < count:
+            return None
+        self._drop_fragments(key)
+        return ''.join([pieces[i] for i in xrange(count)])
+
+    def _drop_fragments(self, key):
+        self._fragment_bytes -= self._fragments.pop(key)[3]
+
+    def _decode_later(self, src, payload, ad, address, aggregated, 
+                                                            compressed=False):
+        '''Hold a data packet (sealed under ad) to decode with the rest of
+        this batch'''
+        if not self._decoding:
+            self.call_after_batch(self._decode_batch)
+        payloads, ads, addresses, kinds = self._decoding.setdefault(src, 
+                                                            ([], [], [], []))
+        payloads.append(payload)
+        ads.append(ad)
+        addresses.append(address)
+        kinds.append((aggregated, compressed))
+
+    def _bad_compressed(self, src):
+        logger.warning('dropping data packet from {0} that didn\'t '
+                                    + 'decompress', src.encode('hex'))
+
+    def _decode_batch(self):
+        '''Hand the data packets collected by recv to the crypto workers'''
+        decoding, self._decoding = self._decoding, {}
+        for src, (payloads, ads, addresses, kinds) in decoding.iteritems():
+            def decoded(packets, src=src, addresses=addresses, kinds=kinds):
+                recv_packet = self.recv_packet
+                for packet, address, (aggregated, compressed) in zip(packets,
+                                                            addresses, kinds):
+                    if not packet:
+                        continue
+                    if compressed:
+                        packet = compress.decompress(packet)
+                        if packet is None:
+                            self._bad_compressed(src)
+                            continue
+                    if aggregated:
+                        for frame in _frames(packet):
+                            recv_packet(frame, src, address)
+                    else:
+                        recv_packet(packet, src, address)
+            try:
+                self.sm.decode_many(src, payloads, decoded, ads)
+            except sessions.UnknownSessionError, e:
+                logger.warning('dropping {0} data packets: {1}', 
+                                                    len(payloads), e)
+
+    def recv_many(self, datagrams):
+        '''Received a batch of (data, address) from the protocol port.'''
+        recv = self.recv
+        # control packets first, so pings and handshakes don't wait on data
+        bulk_heads = _BULK_HEADS
+        control = [d for d in datagrams if d[0][:2] not in bulk_heads]
+        if control and len(control) < len(datagrams):
+            datagrams = control + [d for d in datagrams 
+                                        if d[0][:2] in bulk_heads]
+        self.sm.cork() # acks and relays go out as a batch
+        try:
+            for data, address in datagrams:
+                try:
+                    recv(data, address)
+                except AuthenticationError:
+                    logger.debug('dropping packet from {0} that failed '
+                                        +'authentication', address)
+                except Exception:
+                    logger.error('dropping packet from {0}', address, 
+                                                        exc_info=True)
+        finally:
+            self.sm.uncork()
+
     def recv_packet(self, packet, address):
         '''Got a data packet from a peer, need to inject it into tun/tap'''
         pass
@@ -355,6 +1203,7 @@ class Router(object):
 
         handlers = self.handlers.setdefault(type, Event())
         handlers += callback
+        self._dispatch[int(type)] = (type, handlers)
 
     def unregister_handler(self, type, callback):
         '''Remove a registered handler for a specific packet type.'''
@@ -370,6 +1219,15 @@ class TapRouter(Router):
 
     __signature__ = 'PVA'+Router.__version__
 
+    def __init__(self, network, tuntap=None):
+        Router.__init__(self, network, tuntap)
+
+        # answer arp/neighbour solicitations for peers we know locally
+        self.neighbours = None
+        if settings.get_option(network.name + '/' + 'neighbour_proxy', True):
+            self.neighbours = NeighbourProxy(self, self.addr_map.max_age,
+                                             self.addr_map.max_learned)
+
     def get_my_address(self, *x): #TODO redo this
         '''Get interface address (IP/MAC)'''
 
@@ -416,16 +1274,25 @@ class TapRouter(Router):
         dst = packet[0:self.addr_size]
 
         # if ip in peer list
-        if dst in self.addr_map:
-            self.send(PacketType.DATA, packet, self.addr_map[dst])
+        ctx = self._send_ctx.get(dst) or self.send_context(dst)
+        if ctx is not None:
+            ctx(packet)
             logger.trace('got a {0} byte packet on the TUN/TAP wire'
                             , len(packet))
 
         # or if it's a broadcast
         elif self._tuntap.is_broadcast(dst):
             #logger.debug('sending broadcast packet')
-            for addr in self.addr_map.values():
-                self.send(PacketType.DATA, packet, addr)
+            if self.neighbours is not None:
+                reply = self.neighbours.answer(packet)
+                if reply is not None:
+                    self._tuntap.doWrite(reply)
+                    logger.trace('answered a neighbour request locally')
+                    return
+            for addr in self.addr_map.keys():
+                ctx = self.send_context(addr)
+                if ctx is not None:
+                    ctx(packet)
             logger.trace('got a bcast packet on the TUN/TAP wire')
             
         # if we don't have a direct connection...
@@ -435,6 +1302,41 @@ class TapRouter(Router):
             logger.debug('got packet on wire to unknown destination: \
                          {0}', dst.encode('hex'))
 
+    def send_packets_on(self, packets, queue):
+        '''Got a batch of packets from tun/tap queue that need to be sent out.
+        Called from that queue's worker thread, which only reads the
+        contexts map: packets for routes with a context that takes lanes are
+        sealed here with the queue's own lane, and those and the rest
+        (broadcasts, routes without a context yet) go to the reactor thread
+        in one call.'''
+        contexts = self._send_ctx
+        addr_size = self.addr_size
+        sealed, rest = [], []
+        for packet in packets:
+            dst = packet[0:addr_size]
+            ctx = contexts.get(dst)
+            if ctx is not None and ctx.lanes:
+                sealed.append((dst, ctx, ctx.seal(packet, queue)))
+            else:
+                rest.append(packet)
+        if sealed or rest:
+            reactor.callFromThread(self._send_sealed, sealed, rest)
+
+    def _send_sealed(self, sealed, packets):
+        '''Send what a tap queue worker sealed (unless its route changed
+        meanwhile), and the packets it left for us, as one batch'''
+        contexts, send_packet = self._send_ctx, self.send_packet
+        self.sm.cork()
+        try:
+            for dst, ctx, datagrams in sealed:
+                if contexts.get(dst) is ctx:
+                    for data in datagrams:
+                        ctx.send(data, ctx.sid, ctx.address)
+            for packet in packets:
+                send_packet(packet)
+        finally:
+            self.sm.uncork()
+
     def recv_packet(self, packet, src, address):
         '''Got a data packet from a peer, need to inject it into tun/tap'''
 
@@ -449,10 +1351,12 @@ class TapRouter(Router):
             else:
                 logger.trace( 'got a tun/tap back but have no tun/tap, dropping')
 
+            if self.neighbours is not None and ord(dst[0]) & 1:
+                self.neighbours.learn(self.pm.peer_list.get(src), packet)
+
 # todo what to do about this
             src_addr = packet[self.addr_size:self.addr_size*2]
-            if src_addr not in self.addr_map: # negligible speed hit
-                self.addr_map[src_addr] = (address, src)
+            if self.addr_map.seen(src_addr, (address, src)):
                 logger.warning('got new addr from packet!: {0} (for {1})'
                             , src_addr.encode('hex'), src.encode('hex'))
         else:
@@ -18,7 +18,12 @@
 # TODO: what is the difference between a session and a peer?
 # TODO: reconnect with relayed peers?
 # TODO: periodic px?
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
+from twisted.internet.interfaces import IWriteDescriptor
+from twisted.python import failure
+from zope.interface import implements
+from collections import deque
+import copy
 import hashlib, hmac
 from struct import pack, unpack
 import os
@@ -31,10 +36,16 @@ else:
     from time import time
 
 from .. import util
-from ..crypto import Crypter, jpake
+from .. import settings
+from ..crypto import jpake, spake2, suites, resume
+from ..crypto.pool import CryptoPool
 from ..peers import PeerInfo
 from .. import protocol
+from ..net import mmsg
 from ..packets import PacketType
+from .fair import FairQueue, TokenBucket
+from .shaker import Shaker, Stock
+from .tickets import Tickets
 
 logger = logging.getLogger(__name__)
 
@@ -45,27 +56,121 @@ HANDSHAKE2  = 16,
 HANDSHAKE3  = 17,
 CLOSE       = 13)
 
+INF = float('inf')
+
+# the version at the end of a handshake1's signature says which PAKE it
+# carries: jpake as ever (the router's version, all older peers know),
+# spake2 for peers whose features say they take it, or resume (proof of a
+# ticket from our last session) for ones that take that and we have one for
+PAKE_VERSIONS = {'jpake': pack('!H', 2), 'spake2': pack('!H', 3),
+                 'resume': pack('!H', 4)}
+# when both sides start a handshake at once with different ones, the one
+# later in here goes (more peers take it)
+PAKE_ORDER = ('resume', 'spake2', 'jpake')
+
 class UnknownSessionError(Exception): pass
 
 class ArgumentError(Exception): pass
 
+class _Writable(object):
+    '''Tells the session manager when its (UDP) port can be written to.'''
+
+    implements(IWriteDescriptor)
+
+    def __init__(self, sm):
+        self.sm = util.get_weakref_proxy(sm)
+
+    def fileno(self):
+        return self.sm.port.fileno()
+
+    def doWrite(self):
+        self.sm._drain()
+
+    def logPrefix(self):
+        return 'SessionManager'
+
+    def connectionLost(self, reason):
+        pass
+
+
 class SessionManager(object):
     HANDSHAKE_TIMEOUT = 3 #seconds
+    GREET_TRIES = 3
+    GREET_STAGGER = 0.05 # between greets to a peer's addresses (s)
+    GREET_GRACE = 0.5    # how long to wait for more after the first answers
+    GREET_HYSTERESIS = 0.2 # how much faster a new address has to be
     def __init__(self, router, proto=None):
 
         if proto is None:
-            proto = protocol.UDPPeerProtocol(util.get_weakref_proxy(router.recv))
+            proto = protocol.UDPPeerProtocol(
+                                util.get_weakref_proxy(router.recv),
+                                util.get_weakref_proxy(router.recv_many))
     
         self.proto = proto
         self.port = None
 
+        # datagrams per recvmmsg/sendmmsg call (0 = plain recvfrom/sendto)
+        self.udp_batch = settings.get_option(router.network.name + '/' 
+                                                    + 'udp_batch', 0)
+        # outgoing (data, address) list while corked
+        self._corked = None
+        # (data, address)s waiting to go out: control packets, and data in a
+        # fair queue per peer (relayed packets apart from our own)
+        self._control = deque()
+        self._writing = False
+        self._timer = None
+        self._writer = _Writable(self)
+        get = lambda opt, default: settings.get_option(router.network.name
+                                                    + '/' + opt, default)
+        self.send_queue = get('send_queue', 512)
+        self.dropped = 0
+        # packet types (packed) that are data, the rest is control
+        self.bulk_heads = router.bulk_heads
+        # data rate caps in bytes/s (0 for none): all of it, each peer's,
+        # and some peers' own (by name or hex id)
+        self.rate_limit = get('rate_limit', 0)
+        self.peer_rate_limit = get('peer_rate_limit', 0)
+        self.peer_rate_limits = get('peer_rate_limits', {})
+        # peer name (or hex id) -> share of the link, and relayed traffic's
+        # share next to our own
+        self.peer_weights = get('peer_weights', {})
+        self.relay_weight = get('relay_weight', 1.0)
+        # cipher suites to take, best first (None for all, fastest first)
+        self.cipher_suites = get('cipher_suites', None)
+        # data waits its turn even when the socket has room
+        self.shaping = bool(self.rate_limit or self.peer_rate_limit
+                                                or self.peer_rate_limits)
+        self._net_bucket = TokenBucket(self.rate_limit, now=time()) \
+                                            if self.rate_limit else None
+        # sid -> TokenBucket, shared by its relayed and own flows
+        self._buckets = {}
+        self.fair = FairQueue(self.send_queue, self._flow_weight, 
+                                                    self._flow_bucket)
+
         self.router = util.get_weakref_proxy(router)
-        # sid -> encryption object
+        # sid -> encryption object, and the name of its suite
         self.session_objs = {}
+        self.session_suites = {}
+        # sid -> encryption object per tap queue (only with tap_queues > 1)
+        self.lanes = router.tap_queues
+        self.lane_objs = {}
+        # worker processes for encode_many/decode_many (0 = do it here)
+        self.crypto_workers = router.crypto_workers
+        self.pool = None
         # sid -> address
         self.session_map = {}
         # sid -> (nonce, relays, address) for handshake
         self.shaking = {}
+        # runs the handshakes' number crunching (0 workers to do it here)
+        self.shaker = Shaker(get('handshake_workers', 2))
+        # handshakes that have done round one, ready to go
+        self.stock = Stock(self.shaker, self._jpake,
+                            get('handshake_stock', 4),
+                            get('handshake_stock_rate', 2.0))
+        # tickets for resuming sessions (good for resume_ttl s after they
+        # close, 0 for none), kept in resume_file if there is one
+        self.tickets = Tickets(get('resume_ttl', 3600), 
+                                get('resume_file', None))
         self.keep_alives = {}
 
         self.id = self.router.network.id
@@ -84,31 +189,228 @@ class SessionManager(object):
         Update Session Map with new session id -> address
         '''
         self.session_map[sid] = address
+        self.router.drop_send_contexts(sid)
 
     def send(self, data, sid, address):
         '''
-        Send data to address
+        Send data to address.  Reactor thread only (tap queue workers hand
+        theirs over, see Router.send_packets_on).
+        '''
+        if self._corked is not None:
+            self._corked.append((data, address))
+        elif self._writing or (self.shaping and data[:2] in self.bulk_heads):
+            self._queue([(data, address)])
+        elif not self.proto.send(data, address):
+            self._queue([(data, address)])
+
+    def cork(self):
+        '''
+        Hold outgoing packets until uncork, so they can go out in one batch.
         '''
-        self.proto.send(data, address)
+        if self._corked is None:
+            self._corked = []
+
+    def uncork(self):
+        '''
+        Send everything held since cork, control packets first
+        '''
+        datagrams, self._corked = self._corked, None
+        if not datagrams:
+            return
+        if self._writing:
+            self._queue(datagrams)
+            return
+        bulk_heads = self.bulk_heads
+        control = [d for d in datagrams if d[0][:2] not in bulk_heads]
+        if self.shaping:
+            if len(control) < len(datagrams):
+                self._queue([d for d in datagrams if d[0][:2] in bulk_heads])
+            datagrams = control
+        elif control and len(control) < len(datagrams):
+            datagrams = control + [d for d in datagrams 
+                                        if d[0][:2] in bulk_heads]
+        if datagrams:
+            sent = self.proto.send_many(datagrams)
+            if sent < len(datagrams):
+                self._queue(datagrams[sent:])
+
+    ###### Outgoing queues, for a full socket and rate caps
+
+    def _flow_weight(self, key):
+        sid, relayed = key
+        peer = self.router.pm.get(sid)
+        weights = self.peer_weights
+        weight = weights.get(peer.name if peer is not None else None,
+                                    weights.get(sid.encode('hex'), 1.0))
+        return weight * self.relay_weight if relayed else weight
+
+    def _flow_bucket(self, key):
+        sid = key[0]
+        bucket = self._buckets.get(sid)
+        if bucket is None:
+            peer = self.router.pm.get(sid)
+            limits = self.peer_rate_limits
+            rate = limits.get(peer.name if peer is not None else None,
+                        limits.get(sid.encode('hex'), self.peer_rate_limit))
+            if rate:
+                bucket = self._buckets[sid] = TokenBucket(rate, now=time())
+        return bucket
+
+    def _queue(self, datagrams):
+        '''
+        Hold (data, address)s until the socket takes more (or their peer is
+        back under its rate cap), control packets ahead of data.  Past
+        send_queue datagrams, data goes first (from the longest queues),
+        control only if there's no data left to drop.
+        '''
+        bulk_heads, control, fair = self.bulk_heads, self._control, self.fair
+        me = self.router.pm._self.id
+        for d in datagrams:
+            data = d[0]
+            if data[:2] in bulk_heads:
+                # (dst, relayed)
+                fair.push((data[4:20], data[20:36] != me), d)
+            else:
+                control.append(d)
+        over = len(control) + len(fair) - self.send_queue
+        if over > 0:
+            n = min(over, len(fair))
+            fair.drop(n)
+            for i in xrange(over - n):
+                control.popleft()
+            self.dropped += over
+            logger.debug('send queue full, dropped {0} datagrams', over)
+        if not self._writing:
+            self._drain()
+
+    def _drain(self):
+        '''Send what's queued, as much as the socket and rate caps take'''
+        send = self.proto.send
+        control = self._control
+        while control:
+            data, address = control[0]
+            if not send(data, address):
+                return self._wait_writable()
+            control.popleft()
+
+        fair, net = self.fair, self._net_bucket
+        now = time()
+        wait = None
+        while fair.size:
+            if net is not None and not net.ready(now):
+                wait = net.delay()
+                break
+            flow = fair.next(now)
+            if flow is None:
+                wait = fair.wait
+                break
+            data, address = flow.queue[0]
+            if not send(data, address):
+                return self._wait_writable()
+            fair.sent(flow)
+            if net is not None:
+                net.take(len(data))
+
+        if self._writing:
+            self._writing = False
+            reactor.removeWriter(self._writer)
+        if wait is not None and self._timer is None:
+            self._timer = reactor.callLater(wait, self._wake)
+
+    def _wait_writable(self):
+        if not self._writing:
+            self._writing = True
+            reactor.addWriter(self._writer)
+
+    def _wake(self):
+        self._timer = None
+        if not self._writing:
+            self._drain()
+
+    def queue_stats(self):
+        '''
+        [(sid, relayed, queued, queued bytes, sent, dropped)] for each data 
+        flow, and the control packets waiting as (None, False, queued, ...)
+        '''
+        stats = [(None, False, len(self._control), 
+                    sum(len(d) for d, a in self._control), 0, 0)]
+        for (sid, relayed), f in sorted(self.fair.flows.items()):
+            stats.append((sid, relayed, len(f.queue), f.bytes, f.sent,
+                                                                f.dropped))
+        return stats
 
     def start(self, port):
         '''
         Start listening on port
         '''
-        self.port = reactor.listenUDP(port, self.proto)
+        # times the cipher suites, if they haven't been yet
+        names = suites.preference(self.cipher_suites)
+        if not names:
+            logger.error('none of the cipher suites {0} are available, '
+                            +'handshakes will fail', self.cipher_suites)
+        self.build_tables()
+        self.shaker.start()
+        self.stock.start()
+        if self.crypto_workers > 0:
+            logger.info('starting {0} crypto workers', self.crypto_workers)
+            # pool workers encrypt on the counter lanes after the tap queues'
+            self.pool = CryptoPool(self.crypto_workers, first_lane=self.lanes)
+            self.pool.start()
+
+        if self.udp_batch > 1 and mmsg.available:
+            logger.info('using recvmmsg/sendmmsg with batches of {0}',
+                            self.udp_batch)
+            self.port = protocol.MMsgPort(port, self.proto, 
+                                    batch=self.udp_batch, reactor=reactor)
+            self.port.startListening()
+        else:
+            if self.udp_batch > 1:
+                logger.warning('recvmmsg/sendmmsg not available, '
+                                +'sending one datagram at a time')
+            self.port = reactor.listenUDP(port, self.proto)
         return self.port
         
+    def build_tables(self):
+        '''
+        Build the handshakes' fixed-base tables (or read jpake's from the
+        jpake_table_dir), before the shaker's workers fork so they have them
+        '''
+        jpake_dir = settings.get_option('settings/jpake_table_dir', None)
+        if jpake_dir is not None:
+            jpake.jpake.table_dir = jpake_dir
+        jpake.table(jpake.params_80)
+        spake2.table(spake2.G)
+        spake2.table(spake2.S)
+
     def stop(self):
         '''
         Stop listening
         '''
+        if self._writing:
+            reactor.removeWriter(self._writer)
+            self._writing = False
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self._control.clear()
+        self.fair.clear()
         if self.port is not None:
             self.port.stopListening()
             self.port = None
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+        self.stock.stop()
+        self.shaker.stop()
+        # a restart is as good as a close for the tickets' clocks
+        for sid in self.session_objs:
+            self.tickets.closed(sid, self._resumable(sid))
+        self.tickets.save()
 
-    def open(self, sid, session_key, relays=0):
+    def open(self, sid, session_key, relays=0, suite=suites.LEGACY):
         '''
-        Open a new session with id, key, and # of relays routed through.
+        Open a new session with id, key, # of relays routed through and
+        cipher suite.
         '''
         if sid in self.shaking:
             address = self.shaking[sid][2]
@@ -116,15 +418,35 @@ class SessionManager(object):
             # use a weakref so the closure doesn't leak memory
             pself = util.get_weakref_proxy(self)
             
-            # session reset
+            # session reset (tap queue workers' lanes run out on their
+            # threads)
             def do_reset():
                 logger.warning('doing session reset for {0}'
                                             , sid.encode('hex'))
-                pself.send_handshake(sid, address, relays)
+                reactor.callFromThread(pself.send_handshake, sid, address,
+                                                                    relays)
                 
             # create encryption option TODO: does this prevent GC
-            obj = Crypter(session_key, callback=do_reset)
+            # each tap queue worker and crypto worker encrypts on its own 
+            # counter slice
+            lanes = self.lanes + self.crypto_workers
+            cls = suites.suites[suite]
+            # (the suites key each direction apart by who's sending)
+            if self.lanes > 1:
+                objs = [cls(session_key, callback=do_reset, 
+                                    lane=i, lanes=lanes, 
+                                    ours=self.id, theirs=sid)
+                                            for i in range(self.lanes)]
+                self.lane_objs[sid] = objs
+                obj = objs[0]
+            else:
+                obj = cls(session_key, callback=do_reset, lanes=lanes,
+                                    ours=self.id, theirs=sid)
             self.session_objs[sid] = obj
+            self.session_suites[sid] = suite
+            if self.pool is not None:
+                self.pool.open(sid, session_key, suite, self.id)
+            logger.info('session with {0} uses {1}', sid.encode('hex'), suite)
             
             # update sid -> address map
             self.update_map(sid, address)
@@ -156,6 +478,15 @@ class SessionManager(object):
         # remove encryption object
         if sid in self.session_objs:
             del self.session_objs[sid]
+            # keep the ticket, while we still know if they take it
+            self.tickets.closed(sid, self._resumable(sid))
+        if sid in self.lane_objs:
+            del self.lane_objs[sid]
+        self.session_suites.pop(sid, None)
+        if self.pool is not None:
+            self.pool.close(sid)
+        self.fair.forget(lambda key: key[0] == sid)
+        self._buckets.pop(sid, None)
         
         # remove address map
         if sid in self.session_map:
@@ -168,19 +499,16 @@ class SessionManager(object):
             del self.shaking[sid]
          
         # clear unreachable routes
-        # addr map uses mac addresses as keys, not sids
-        # gen a list incase there are multiple addresses for an sid
-        aslist = [k for k in self.router.addr_map 
-                            if self.router.addr_map[k][-1] == sid]
-        for x in aslist:
+        for x in self.router.addr_map.drop_session(sid):
             logger.debug('removing addr map {0}->{1}', 
                                 util.decode_mac(x),sid.encode('hex'))
-            del self.router.addr_map[x]
         util.emit_async('session-closed', self, sid)
 
-    def encode(self, sid, data):
+    def encode(self, sid, data, lane=0, ad=''):
         '''
-        Encode data with session key associated with an id
+        Encode data with session key associated with an id.  Tap queue
+        workers pass their queue as lane.  ad is the packet header, for
+        the suites that authenticate it (see crypto._Suite).
         '''
         if isinstance(sid, PeerInfo):
             sid = sid.id
@@ -189,11 +517,58 @@ class SessionManager(object):
             logger.warning('unknown session id: {0}', sid.encode('hex'))
             raise UnknownSessionError("unknown session id: {0}"
                                             .format(sid.encode('hex')))
-        return self.session_objs[sid].encrypt(data)
+        if lane:
+            return self.lane_objs[sid][lane].encrypt(data, ad)
+        return self.session_objs[sid].encrypt(data, ad)
+
+    def encoders(self, sid):
+        '''
+        Get the encode functions for a session id, one per tap queue (lane),
+        called with data and ad like encode.
+        '''
+        if sid not in self.session_objs:
+            logger.warning('unknown session id: {0}', sid.encode('hex'))
+            raise UnknownSessionError("unknown session id: {0}"
+                                            .format(sid.encode('hex')))
+        if sid in self.lane_objs:
+            return [obj.encrypt for obj in self.lane_objs[sid]]
+        return [self.session_objs[sid].encrypt]
+
+    def encode_many(self, sid, packets, callback, ads=None):
+        '''
+        Encode a list of packets (with a list of their ads) for a session
+        id, callback(list) gets the results, in order.  With crypto workers
+        this happens later (on the reactor thread), packets that fail come
+        back empty.
+        '''
+        if sid not in self.session_objs:
+            logger.warning('unknown session id: {0}', sid.encode('hex'))
+            raise UnknownSessionError("unknown session id: {0}"
+                                            .format(sid.encode('hex')))
+        if self.pool is not None:
+            self.pool.encrypt(sid, packets, callback, ads)
+        else:
+            callback(self.session_objs[sid].encrypt_many(packets, ads))
+
+    def decode_many(self, sid, packets, callback, ads=None):
+        '''
+        Decode a list of packets from a session id, like encode_many
+        '''
+        if sid not in self.session_objs:
+            logger.warning('unknown session id: {0}', sid.encode('hex'))
+            raise UnknownSessionError("unknown session id: {0}"
+                                            .format(sid.encode('hex')))
+
+        self.keep_alives[sid] = time()
+        if self.pool is not None:
+            self.pool.decrypt(sid, packets, callback, ads)
+        else:
+            callback(self.session_objs[sid].decrypt_many(packets, ads))
 
-    def decode(self, sid, data):
+    def decode(self, sid, data, ad=''):
         '''
-        Decode data with session key associated with an id
+        Decode data with session key associated with an id, ad is the
+        header it came with (like encode)
         '''
         if isinstance(sid, PeerInfo):
             sid = sid.id
@@ -204,7 +579,7 @@ class SessionManager(object):
                                             .format(sid.encode('hex')))
 
         self.keep_alives[sid] = time()
-        return self.session_objs[sid].decrypt(data)
+        return self.session_objs[sid].decrypt(data, ad)
 
 
 
@@ -216,27 +591,31 @@ class SessionManager(object):
 
     @defer.inlineCallbacks
     def try_greet(self, addrs):
-        '''Try and send 'greet' packets to given address.'''
+        '''
+        Greet the given addresses all at once (happy eyeballs style), and
+        return the one that answered fastest, or None.  Given a peer, also
+        switch it to that address if it beats the one it has.
+        '''
+        peer = None
         if isinstance(addrs, tuple):
             # It's an (address,port) pair
             addrs = [addrs]
 
         elif isinstance(addrs, PeerInfo):
-            if addrs.is_direct:
-                # don't need to...
-                return
-                #yield defer.succeed(None)
+            peer = addrs
 
             # it's a peer, try direct_addresses
             # if a NAT scrambled the port, re-add it to the list for each IP
             # list(set()) to eliminate duplicates
             try:
                 addrs = \
-                    list(set([ (x[0], addrs.port) for x in addrs.direct_addresses
-                                                        if x[1] != addrs.port])) \
-                        + addrs.direct_addresses
+                    list(set([ (x[0], peer.port) for x in peer.direct_addresses
+                                                        if x[1] != peer.port])) \
+                        + peer.direct_addresses
             except AttributeError: # if .port undefined (pre bzr rev 61)
-                addrs = addrs.direct_addresses
+                addrs = list(peer.direct_addresses)
+            if peer.is_direct:
+                addrs.append(peer.address)
 
         elif not isinstance(addrs, list):
             logger.error('try_greet called with incorrect parameter: {0}'
@@ -245,21 +624,75 @@ class SessionManager(object):
             raise ArgumentError('try_greet called with incorrect parameter: {0}'
                                             .format(addrs))
 
-        for address in addrs:
+        # dupes out, LAN addresses first so they get a head start
+        addrs = sorted(set(addrs), key=lambda a: not util.is_private_ip(a[0]))
+        rtts = yield self.race_greets(addrs)
+        if not rtts:
+            logger.info('Could not establish connection with addresses.')
+            return # same as defer.returnValue(None)
+
+        best = min(rtts, key=rtts.get)
+        logger.info('greet: fastest address is {0} ({1:.1f}ms of {2})', best,
+                        rtts[best] * 1e3, len(rtts))
+
+        if peer is not None and peer.id in self.router.pm.peer_list \
+                and (not peer.is_direct or (best != peer.address and
+                        rtts[best] < rtts.get(peer.address, INF)
+                                        * (1 - self.GREET_HYSTERESIS))):
+            logger.info('switching {0} to {1}', peer.name, best)
+            pn = copy.copy(peer)
+            pn.relays = 0
+            pn.address = best
+            self.router.pm.update_peer(peer, pn)
+
+        defer.returnValue(best)
+
+    def race_greets(self, addrs):
+        '''
+        Greet each address, GREET_STAGGER apart, retrying each up to
+        GREET_TRIES times.  Returns a deferred {address: rtt} of the ones
+        that answered, fired when they're all done or GREET_GRACE after the
+        first answer (later ones get picked up next time).
+        '''
+        rtts = {}
+        done = defer.Deferred()
+        left = [len(addrs)]
+
+        def finish(*x):
+            if not done.called:
+                done.callback(rtts)
+
+        def answered(rtt, address):
+            if rtt is not None:
+                if not rtts:
+                    reactor.callLater(self.GREET_GRACE, finish)
+                rtts[address] = rtt
+            left[0] -= 1
+            if left[0] == 0:
+                finish()
+
+        if not addrs:
+            finish()
+        for i, address in enumerate(addrs):
             logger.info('sending greet to {0}', address)
-            for i in range(3):
-                logger.debug('sending greet packet #{0}', i)
-                try:
-                    ret = yield self.send_greet(address, ack=True)
-                    return # stop trying if successful TODO: return address? 
-                except Exception, e:
-                    logger.info('(greet) address {0} failed: {1}'
-                                    , address, e)
-                    # just keep trying...
-
-        logger.info('Could not establish connection with addresses.')
-        return # same as defer.returnValue(None)
-        #raise Exception('Could not establish connection with addresses.')
+            d = task.deferLater(reactor, i * self.GREET_STAGGER,
+                                    self._greet_rtt, address)
+            d.addCallback(answered, address)
+        return done
+
+    @defer.inlineCallbacks
+    def _greet_rtt(self, address):
+        '''Greet address until it acks, returns the round trip time or None'''
+        for i in range(self.GREET_TRIES):
+            logger.debug('sending greet packet #{0} to {1}', i, address)
+            st = time()
+            try:
+                yield self.send_greet(address, ack=True)
+            except Exception, e:
+                logger.info('(greet) address {0} failed: {1}', address, e)
+                continue
+            defer.returnValue(time() - st)
+        defer.returnValue(None)
 
     def connect(self, address, ack=False):
         self.send_greet(address, ack)
@@ -287,7 +720,6 @@ class SessionManager(object):
             if src_id in self.router.pm:
                 pi = self.router.pm[src_id]
                 if pi.relays > 0:
-                    import copy
                     logger.info('direct connection established with {0}'
                                 , src_id.encode('hex'))
 
@@ -300,31 +732,127 @@ class SessionManager(object):
                     # return the favor
                     self.send_greet(address)
 
-    def send_handshake(self, sid, address, relays=0):
+    def send_handshake(self, sid, address, relays=0, pake=None):
         '''Send handshake packet to session id or address'''
         # todo make retry for fails
         if sid not in self.shaking:
             logger.info('sending handshake to {0}', sid.encode('hex'))
 
-            j = jpake.JPAKE(self.router.network.key)
-            send1 = j.pack_one(j.one())
-            j._one = True
-            j._two = False
-            self.shaking[sid] = [j, relays, address]
+            if pake is None:
+                pake = self._pake_for(sid)
+            self.shaking[sid] = [None, relays, address]
 
             # timeout handshake
             reactor.callLater(self.HANDSHAKE_TIMEOUT, 
                               self.handshake_timeout, sid)
- 
+
+            return self._send_handshake1(sid, pake)
+
+        else:
+            logger.info('send_handshake called on {0} while already shaking'
+                        , sid.encode('hex'))
+
+    def _send_handshake1(self, sid, pake):
+        '''Start sid's handshake (or start it over) with pake, and send
+        handshake1'''
+        ready = None
+        if pake == 'resume':
+            j = self._resume(sid)
+            if j is not None:
+                # a couple of hashes, not worth a worker
+                ready = j, j.one()
+            else:
+                # the ticket ran out
+                pake = self._pake_for(sid, tickets=False)
+        if ready is None:
+            if pake == 'spake2':
+                j = self._spake2()
+            else:
+                ready = self.stock.take()
+                if ready is None:
+                    j = self._jpake()
+        if ready is not None:
+            j, m1 = ready
+        j._pake = pake
+        j._one = True
+        j._two = False
+        self.shaking[sid][0] = j
+        del self.shaking[sid][3:]
+
+        def send1(m1):
+            if not self._still_shaking(sid, j):
+                return
             # don't need ack, should get handshake-ack or timeout
-            data = self.router.__signature__+pack('!B',relays)+send1
+            data = self._signature(pake) \
+                            + pack('!B',self.shaking[sid][1]) \
+                            + j.pack_one(m1)
             return self.router.send(PacketType.HANDSHAKE1, 
                                     data, 
                                     sid, clear=True)
-
+        if ready is not None:
+            d = defer.succeed(m1)
         else:
-            logger.info('send_handshake called on {0} while already shaking'
-                        , sid.encode('hex'))
+            d = self.shaker.run(sid, j, 'one')
+        d.addCallback(send1)
+        d.addErrback(self._shake_failed, sid, j)
+        return d
+
+    def _jpake(self):
+        '''A new handshake's JPAKE'''
+        # the signer id carries the cipher suites we take
+        return jpake.JPAKE(self.router.network.key, 
+                    signerid=suites.advertise(os.urandom(16).encode('hex'),
+                                    suites.preference(self.cipher_suites)))
+
+    def _pake_for(self, sid, tickets=True):
+        '''Which PAKE to start a handshake with sid with: resume if we have a
+        ticket for it and it takes them, spake2 if it's said it takes that,
+        jpake if it hasn't (or we haven't heard)'''
+        peer = self.router.pm.get(sid)
+        features = getattr(peer, 'features', ())
+        if tickets:
+            ticket = self.tickets.get(sid)
+            # a peer that's gone has gone from the peer manager too, the
+            # ticket remembers
+            if ticket is not None and ('resume' in features 
+                                            if peer is not None else ticket[1]):
+                return 'resume'
+        return 'spake2' if 'spake2' in features else 'jpake'
+
+    def _resumable(self, sid):
+        '''Whether sid's peer has said it takes resumed handshakes'''
+        return 'resume' in getattr(self.router.pm.get(sid), 'features', ())
+
+    def _resume(self, sid):
+        '''A new handshake's Resume, from our ticket for sid (None if we don't
+        have one)'''
+        ticket = self.tickets.get(sid)
+        if ticket is None:
+            return None
+        return resume.Resume(ticket[0],
+                    signerid=suites.advertise(os.urandom(16).encode('hex'),
+                                    suites.preference(self.cipher_suites)))
+
+    def _spake2(self):
+        '''A new handshake's SPAKE2'''
+        return spake2.SPAKE2(self.router.network.key, 
+                    signerid=suites.advertise(os.urandom(16).encode('hex'),
+                                    suites.preference(self.cipher_suites)))
+
+    def _signature(self, pake):
+        '''What handshake1 starts with: our router's signature, with the
+        version that says which PAKE follows'''
+        return self.router.__signature__[:3] + PAKE_VERSIONS[pake]
+
+    def _pake(self, sig):
+        '''The PAKE a handshake1 signature says follows, or None if it's not
+        one of ours'''
+        if sig[:3] != self.router.__signature__[:3]:
+            return None
+        for pake, version in PAKE_VERSIONS.iteritems():
+            if sig[3:] == version:
+                return pake
+        return None
 
     def handle_handshake1(self, type, packet, address, src_id):
         '''Handle first handshake packet'''
@@ -332,7 +860,8 @@ class SessionManager(object):
         
         sig, r, recv1 = packet[:5], packet[5], packet[6:]
         
-        if sig != self.router.__signature__:
+        pake = self._pake(sig)
+        if pake is None:
             logger.warning(('got a handshake1 from peer {0} using an '+
                 'incompatible version'), src_id.encode('hex'))
             return self.handshake_fail(src_id)
@@ -340,7 +869,7 @@ class SessionManager(object):
         r = unpack('!B', r)[0]
 
         if src_id in self.shaking:
-            j, relays, addr = self.shaking[src_id]
+            j, relays, addr = self.shaking[src_id][:3]
             if relays < r:
                 # incoming hs1 came over more hops
                 r = relays
@@ -348,16 +877,96 @@ class SessionManager(object):
             elif addr != address:
                 # incoming hs1 came over less (or equal) hops
                 self.shaking[src_id][2] = address
+
+            if j._pake != pake:
+                # we both started at once, and one of us didn't know the other
+                # takes spake2 (or couldn't resume): go with the one more
+                # peers take
+                if PAKE_ORDER.index(pake) < PAKE_ORDER.index(j._pake):
+                    # they'll start over when they get ours
+                    logger.info('ignoring {0} handshake1 from {1}, sent '
+                                +'{2}', pake, src_id.encode('hex'), j._pake)
+                    return
+                logger.info('starting handshake with {0} over with {1}',
+                                src_id.encode('hex'), pake)
+                self._send_handshake1(src_id, pake)
+                j = self.shaking[src_id][0]
             
+        elif pake == 'resume' and self.tickets.get(src_id) is None:
+            # nothing to resume from, start a whole handshake and they'll
+            # start over when they get it
+            logger.info('no ticket to resume with {0} from', 
+                            src_id.encode('hex'))
+            return self.send_handshake(src_id, address, r)
         else:
-            self.send_handshake(src_id, address, r)
+            self.send_handshake(src_id, address, r, pake)
             j = self.shaking[src_id][0]
 
-        send2 = j.pack_two(j.two(j.unpack_one(recv1)))
+        try:
+            m1 = j.unpack_one(recv1)
+        except (spake2.SPAKE2Error, resume.ResumeError), e:
+            logger.warning('bad handshake1 from {0}: {1}',
+                                src_id.encode('hex'), e)
+            return self.handshake_fail(src_id)
+        if pake != 'jpake':
+            theirs = suites.advertised(m1['id'])
+        else:
+            theirs = suites.advertised(m1['zkp_x1']['id'])
+        # the side with the lower id gets its pick
+        j._suite = suites.negotiate(suites.preference(self.cipher_suites),
+                                    theirs, self.id < src_id)
+        j._legacy = theirs is None
+        if j._suite is None:
+            logger.warning('no cipher suite in common with {0} (it takes {1})',
+                            src_id.encode('hex'), theirs)
+            return self.handshake_fail(src_id)
+
+        # got hs1 (two, and then three, wait on one and on each other)
         j._two = True
-        logger.info('sending handshake2 to {0}', src_id.encode('hex'))
-        return self.router.send(PacketType.HANDSHAKE2, send2, src_id, clear=True)
-        
+
+        if pake == 'resume':
+            try:
+                session_key = j.two(m1)
+            except resume.ResumeError, e:
+                # our tickets differ (one of us missed the other's
+                # handshake3, say), do it the long way
+                logger.info('could not resume with {0} ({1}), starting over',
+                                src_id.encode('hex'), e)
+                return self._send_handshake1(src_id,
+                                        self._pake_for(src_id, tickets=False))
+            return self._confirm(src_id, j, session_key)
+
+        if pake == 'spake2':
+            # one message each way, their handshake1 is all we need for the
+            # key, on to handshake3
+            def confirm(session_key):
+                return self._confirm(src_id, j, session_key)
+            d = self.shaker.run(src_id, j, 'two', m1)
+            d.addCallback(confirm)
+            d.addErrback(self._shake_failed, src_id, j)
+            return d
+
+        def send2(m2):
+            if not self._still_shaking(src_id, j):
+                return
+            logger.info('sending handshake2 to {0}', src_id.encode('hex'))
+            return self.router.send(PacketType.HANDSHAKE2, j.pack_two(m2),
+                                                        src_id, clear=True)
+        d = self.shaker.run(src_id, j, 'two', m1)
+        d.addCallback(send2)
+        d.addErrback(self._shake_failed, src_id, j)
+        return d
+
+    def _still_shaking(self, sid, j):
+        '''Whether j is still sid's handshake (after a step in the shaker, it
+        may have timed out or started over)'''
+        return sid in self.shaking and self.shaking[sid][0] is j
+
+    def _shake_failed(self, f, sid, j):
+        if self._still_shaking(sid, j):
+            logger.warning('handshake with {0} failed: {1}', 
+                                sid.encode('hex'), f.getErrorMessage())
+            self.handshake_fail(sid)
 
     @defer.inlineCallbacks
     def handle_handshake2(self, type, packet, address, src_id):
@@ -373,34 +982,53 @@ class SessionManager(object):
                 self.handshake_fail(src_id)
                 return
                 
-            recv2 = j.unpack_two(packet)
-            session_key = j.three(recv2)
-            hsh = hashlib.sha256(session_key).digest()
-                        
-            for i in range(3): # 3 retrys
-                logger.info('sending handshake3 to {0}', src_id.encode('hex'))
-                try:
-                    yield self.router.send(PacketType.HANDSHAKE3, hsh, src_id, 
-                                                clear=True, ack=True)
-                    break
-                except Exception, e:
-                    logger.warning('handshake3 to {0} timed out'
-                                        , src_id.encode('hex'))
-                    # let it retry...
-            else:
-                # all hs3 packets timed out
-                self.handshake_fail(src_id)
+            if j._pake != 'jpake':
+                logger.warning('got handshake2 from {0}, but shaking with '
+                                +'{1}', src_id.encode('hex'), j._pake)
                 return
 
-            if len(self.shaking[src_id]) == 4: # if we already got handshake3 packet
-                packet = self.shaking[src_id][3]
-                self.shaking[src_id][3] = session_key
-                self.handle_handshake3(None, packet, None, src_id)
-            else:
-                self.shaking[src_id] += [session_key,]
+            recv2 = j.unpack_two(packet)
+            try:
+                session_key = yield self.shaker.run(src_id, j, 'three', recv2)
+            except Exception:
+                self._shake_failed(failure.Failure(), src_id, j)
+                return
+            yield self._confirm(src_id, j, session_key)
         else:
             logger.warning(('got handshake2 from {0}, but not currently'+
                                 ' shaking'), src_id.encode('hex'))
+
+    @defer.inlineCallbacks
+    def _confirm(self, src_id, j, session_key):
+        '''Send handshake3 for our session key, and check theirs if it came
+        already'''
+        if not self._still_shaking(src_id, j):
+            return
+        hsh = self._verifier(j, session_key)
+                    
+        for i in range(3): # 3 retrys
+            logger.info('sending handshake3 to {0}', src_id.encode('hex'))
+            try:
+                yield self.router.send(PacketType.HANDSHAKE3, hsh, src_id, 
+                                            clear=True, ack=True)
+                break
+            except Exception, e:
+                logger.warning('handshake3 to {0} timed out'
+                                    , src_id.encode('hex'))
+                # let it retry...
+        else:
+            # all hs3 packets timed out
+            self.handshake_fail(src_id)
+            return
+        if not self._still_shaking(src_id, j):
+            return
+
+        if len(self.shaking[src_id]) == 4: # if we already got handshake3 packet
+            packet = self.shaking[src_id][3]
+            self.shaking[src_id][3] = session_key
+            self.handle_handshake3(None, packet, None, src_id)
+        else:
+            self.shaking[src_id] += [session_key,]
         
     def handle_handshake3(self, type, packet, address, src_id):
         '''Handle third handshake packet'''
@@ -415,7 +1043,7 @@ class SessionManager(object):
             logger.info('got handshake3 from {0}', src_id.encode('hex'))
             session_key = self.shaking[src_id][3]
             
-            if packet == hashlib.sha256(session_key).digest():
+            if packet == self._verifier(self.shaking[src_id][0], session_key):
                 self.handshake_done(src_id)
             else:
                 logger.warning('handshake with {0} verification failed'
@@ -435,9 +1063,22 @@ class SessionManager(object):
             session_key = self.shaking[sid][3]
 #            session_key = hashlib.md5(session_key).digest()
             r = self.shaking[sid][1]
+            j = self.shaking[sid][0]
             
             # init encryption
-            self.open(sid, session_key, relays=r)
+            self.open(sid, session_key, relays=r, suite=j._suite)
+            # for next time (a peer that resumed takes them)
+            self.tickets.add(sid, resume.secret(session_key),
+                                        j._pake == 'resume')
+
+    def _verifier(self, j, session_key):
+        '''What handshake3 carries: a hash of the session key, and of the
+        suite picked so nobody can talk us down to a weaker one (the lists
+        themselves are vouched for by the handshake's proofs).  Peers that
+        don't list suites only know the plain hash.'''
+        if j._legacy:
+            return hashlib.sha256(session_key).digest()
+        return hashlib.sha256(session_key + j._suite).digest()
 
 
     def handshake_timeout(self, sid):
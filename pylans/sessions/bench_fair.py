@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# bench_fair.py
+#
+# Fair queueing under a network rate cap.  Three flows share a link capped at
+# rate bytes/s: a bulk transfer of our own to peer A (offered at twice the
+# cap), the same again relayed for someone else through us to peer A, and a
+# light flow to peer B (offered at a tenth of the cap).  With deficit round
+# robin B should get all it asks for and A's two flows split the rest.  Then
+# again with A capped at a fifth of the link, which its two flows share.
+#
+# usage: python -m pylans.sessions.bench_fair [seconds] [rate kB/s]
+
+import os
+import socket
+import sys
+from struct import pack
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from ..packets import PacketType
+from .bench_priority import _Router, _Transport, _Port
+from .fair import TokenBucket
+from . import SessionManager
+from . import time
+
+
+def run(seconds, rate, cap_a):
+    tx, rx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    for s in (tx, rx):
+        s.setblocking(False)
+
+    router = _Router() # sm only keeps a weak reference
+    sm = SessionManager(router)
+    sm.proto.transport = _Transport(tx)
+    sm.port = _Port(tx)
+    sm.shaping = True
+    sm._net_bucket = TokenBucket(rate, now=time())
+    a, b, other = os.urandom(16), os.urandom(16), os.urandom(16)
+    if cap_a:
+        sm.peer_rate_limits = {a.encode('hex'): rate // 5}
+
+    me = router.pm._self.id
+    head = pack('!2H', PacketType.DATA, 0)
+    flows = [('own to A', head + a + me + 'x' * 1364, 2.0),
+             ('relay to A', head + a + other + 'x' * 1364, 2.0),
+             ('own to B', head + b + me + 'x' * 200, 0.1)]
+    address = ('127.0.0.1', 8015)
+    tick = 0.005
+    got = dict((data[:36], 0) for name, data, share in flows)
+    owed = [0.0] * len(flows)
+
+    def offer():
+        for i, (name, data, share) in enumerate(flows):
+            owed[i] += share * rate * tick
+            while owed[i] >= len(data):
+                owed[i] -= len(data)
+                sm.send(data, data[4:20], address)
+
+    def drain():
+        while True:
+            try:
+                d = rx.recv(2048)
+            except socket.error:
+                return
+            got[d[:36]] += len(d)
+
+    lps = [LoopingCall(offer), LoopingCall(drain)]
+    for lp in lps:
+        lp.start(tick)
+
+    def done():
+        for lp in lps:
+            lp.stop()
+        sm.stop()
+        tx.close()
+        rx.close()
+        reactor.crash()
+    reactor.callLater(seconds, done)
+    reactor.run()
+    return [(name, share * rate, got[data[:36]] / seconds)
+                for name, data, share in flows], sm.dropped
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rate = int(float(sys.argv[2]) * 1024) if len(sys.argv) > 2 else 1024*1024
+
+    print 'link capped at %d kB/s' % (rate // 1024)
+    for cap_a in (False, True):
+        print 'A capped at %d kB/s' % (rate // 5120) if cap_a else 'no caps'
+        results, dropped = run(seconds, rate, cap_a)
+        for name, offered, got in results:
+            print '  %-10s offered %7.0f kB/s  got %7.0f kB/s  %5.1f%%' % (
+                    name, offered / 1024, got / 1024, 100.0 * got / rate)
+        print '  dropped %d datagrams' % dropped
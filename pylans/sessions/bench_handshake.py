@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#
+# bench_handshake.py
+#
+# A reconnect storm: n peers all start a handshake with us at once (like
+# after a restart), packets between the session managers handed over on the
+# reactor.  Shows how long the sessions took to open (from the peer's first
+# handshake to our open), and how long a datagram that another process sends
+# us every 2ms waited to be read, what forwarding would have waited.  Runs
+# with our handshake steps done on the reactor, in threads and in processes,
+# and in processes with a stock of handshakes that have done round one (every
+# peer has one ready too), with spake2 instead of jpake, and resuming from
+# tickets from an earlier session; the peers' steps always go to worker
+# processes so they don't muddy ours.  Once for a single peer, then for the
+# storm.
+#
+# usage: python -m pylans.sessions.bench_handshake [peers] [workers] [stock]
+
+import os
+import socket
+import sys
+from struct import pack, unpack
+from time import time, sleep
+
+from twisted.internet import reactor, defer
+from twisted.internet.protocol import DatagramProtocol
+
+from ..crypto import suites
+from .bench_priority import _Router
+from . import shaker
+from . import SessionManager
+
+
+class _Network(object):
+    key = 'bench_handshake'
+
+    def __init__(self):
+        self.name = 'bench_handshake'
+        self.id = os.urandom(16)
+
+class _AddrMap(object):
+    def drop_session(self, sid):
+        return []
+
+class _Peers(object):
+    '''Peer manager stand-in, every peer has the features given'''
+    def __init__(self, features):
+        self.info = _Network()
+        self.info.features = features
+
+    def get(self, id, default=None):
+        return self.info
+
+class _Node(_Router):
+    '''Router stand-in that hands packets to the other nodes' handlers'''
+    __signature__ = 'PVU\x00\x02'
+    addr_map = _AddrMap()
+
+    def __init__(self, nodes):
+        self.network = _Network()
+        self.id = self.network.id
+        self.address = ('127.0.0.1', len(nodes))
+        self.nodes = nodes
+        self.handlers = {}
+        nodes[self.id] = self
+
+    def register_handler(self, type, callback):
+        self.handlers[type] = callback
+
+    def drop_send_contexts(self, sid):
+        pass
+
+    def send(self, type, data, dst, clear=False, ack=False):
+        node = self.nodes.get(dst)
+        if node is not None:
+            reactor.callLater(0, node.handlers[type], type, data,
+                                                    self.address, self.id)
+        return defer.succeed(None)
+
+class _Probe(DatagramProtocol):
+    '''Gets a timestamp every 2ms from another process, keeps how late each
+    one was read'''
+    def __init__(self):
+        self.delays = []
+        self.pid = None
+        self.since = None
+
+    def datagramReceived(self, data, address):
+        sent = unpack('!d', data)[0]
+        if self.since is not None and sent >= self.since:
+            self.delays.append(time() - sent)
+
+    def start(self):
+        port = reactor.listenUDP(0, self, interface='127.0.0.1')
+        address = ('127.0.0.1', port.getHost().port)
+        self.pid = os.fork()
+        if self.pid == 0:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                while True:
+                    s.sendto(pack('!d', time()), address)
+                    sleep(0.002)
+            finally:
+                os._exit(0)
+        self.port = port
+
+    def stop(self):
+        os.kill(self.pid, 9)
+        os.waitpid(self.pid, 0)
+        self.port.stopListening()
+
+def run(n, workers, use_processes, stock=0, pake='jpake'):
+    suites.preference() # times the cipher suites the first time
+    # fork before there are any threads about
+    probe = _Probe()
+    probe.start()
+    nodes = {}
+    _Node.pm = _Peers((pake,) if pake != 'jpake' else ())
+    hub = _Node(nodes)
+    hub.sm = SessionManager(hub)
+    hub.sm.build_tables()
+    shaker.processes = use_processes
+    hub.sm.shaker = shaker.Shaker(workers)
+    shaker.processes = True
+    peer_shaker = shaker.Shaker(2)
+    hub.sm.stock = shaker.Stock(hub.sm.shaker, hub.sm._jpake, stock)
+    peers = []
+    for i in range(n):
+        p = _Node(nodes)
+        p.sm = SessionManager(p)
+        p.sm.shaker = peer_shaker
+        p.sm.stock = shaker.Stock(peer_shaker, p.sm._jpake, min(stock, 1))
+        if pake == 'resume':
+            # as if they'd had a session before
+            secret = os.urandom(32)
+            hub.sm.tickets.add(p.id, secret)
+            p.sm.tickets.add(hub.id, secret)
+        peers.append(p)
+    hub.sm.shaker.start()
+    peer_shaker.start()
+    stocks = [hub.sm.stock] + [p.sm.stock for p in peers]
+
+    started, opened = {}, {}
+    open = hub.sm.open
+    def record(sid, *args, **kw):
+        opened[sid] = time()
+        open(sid, *args, **kw)
+        if len(opened) == n:
+            reactor.callLater(0.05, finish)
+    hub.sm.open = record
+
+    def storm():
+        if any(len(s) < s.size for s in stocks):
+            reactor.callLater(0.01, storm)
+            return
+        # what queued up while setting up doesn't count
+        probe.since = time()
+        for p in peers:
+            started[p.id] = time()
+            p.sm.send_handshake(hub.id, hub.address)
+
+    def finish():
+        if probe.pid is not None:
+            probe.stop()
+            probe.pid = None
+            reactor.crash()
+
+    for s in stocks:
+        reactor.callWhenRunning(s.start)
+    reactor.callWhenRunning(storm)
+    reactor.callLater(60, finish)
+    reactor.run()
+    for s in stocks:
+        s.stop()
+    hub.sm.shaker.stop()
+    peer_shaker.stop()
+    setup = sorted(opened[sid] - started[sid] for sid in opened)
+    return setup, sorted(probe.delays)
+
+def report(name, n, setup, delays):
+    if not setup:
+        print '%-12s no sessions opened' % name
+        return
+    pc = lambda l, p: l[min(len(l) - 1, len(l) * p // 100)] * 1e3
+    print '%-12s %3d/%d open, setup p50 %6.1fms max %6.1fms,  probe ' \
+          'delay p99 %5.1fms max %5.1fms' % (name, len(setup), n,
+          pc(setup, 50), setup[-1] * 1e3, pc(delays, 99), delays[-1] * 1e3)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    stock = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    modes = [('reactor', 0, False, 0, 'jpake'),
+             ('%d threads' % workers, workers, False, 0, 'jpake')]
+    if shaker.processes:
+        modes += [('%d processes' % workers, workers, True, 0, 'jpake'),
+                  ('+ %d stock' % stock, workers, True, stock, 'jpake'),
+                  ('spake2', workers, True, 0, 'spake2'),
+                  ('resume', workers, True, 0, 'resume')]
+
+    for peers in (1, n):
+        print '%d peer(s) connecting at once' % peers
+        sys.stdout.flush()
+        # the reactor can only run once (and pools don't fork well from a
+        # process that has had threads), each mode gets its own process
+        for name, w, use_processes, s, pake in modes:
+            pid = os.fork()
+            if pid == 0:
+                report(name, peers, *run(peers, w, use_processes, s, pake))
+                sys.stdout.flush()
+                os._exit(0)
+            os.waitpid(pid, 0)
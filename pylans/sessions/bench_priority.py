@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# bench_priority.py
+#
+# Load test for the session manager's send queues.  A SessionManager writes
+# to one end of a unix datagram socketpair (which, unlike UDP over loopback,
+# pushes back with EAGAIN when the reader falls behind) while the other end
+# is drained at a fixed rate, like a saturated link.  DATA packets are offered
+# at twice that rate, with a PING every 20ms; the reader times how long each
+# ping took to get through.
+#
+# Runs once with control packets ahead of data and once with every packet in
+# one fifo (what sending without priorities amounts to), and says whether the
+# pings stayed under the target latency.
+#
+# usage: python -m pylans.sessions.bench_priority [seconds] [rate] [target ms]
+
+import os
+import socket
+import sys
+from struct import pack, unpack
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from ..packets import PacketType
+from .. import router # data packet types
+from . import SessionManager
+
+
+class _Network(object):
+    name = 'bench_priority'
+    id = os.urandom(16)
+
+class _Self(object):
+    id = os.urandom(16)
+
+class _PeerManager(object):
+    _self = _Self()
+
+    def get(self, id, default=None):
+        return default
+
+class _Router(object):
+    network = _Network()
+    pm = _PeerManager()
+    tap_queues = 1
+    crypto_workers = 0
+    bulk_heads = router.Router.bulk_heads
+
+    def recv(self, data, address):
+        pass
+
+    def recv_many(self, datagrams):
+        pass
+
+    def register_handler(self, type, callback):
+        pass
+
+class _Transport(object):
+    '''UDP transport stand-in, sends on a connected unix socket'''
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, data, address):
+        self.sock.send(data)
+
+class _Port(object):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def stopListening(self):
+        pass
+
+def run(seconds, rate, fifo):
+    tx, rx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    for s in (tx, rx):
+        s.setblocking(False)
+    tx.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64*1024)
+
+    router = _Router() # sm only keeps a weak reference
+    sm = SessionManager(router)
+    sm.proto.transport = _Transport(tx)
+    sm.port = _Port(tx)
+    if fifo:
+        sm.bulk_heads = frozenset()
+
+    sid = os.urandom(16)
+    address = ('127.0.0.1', 8015)
+    data = pack('!2H', PacketType.DATA, 0) + sid * 2 + 'x' * 1364
+    tick = 0.002
+    pings = []
+    latencies = []
+    got = [0]
+
+    def offer():
+        # twice what the reader takes
+        for i in xrange(int(2 * rate * tick)):
+            sm.send(data, sid, address)
+
+    def ping():
+        pings.append(time())
+        sm.send(pack('!2H', PacketType.PING, 0) + sid * 2
+                    + pack('!d', pings[-1]), sid, address)
+
+    def drain():
+        for i in xrange(int(rate * tick)):
+            try:
+                d = rx.recv(2048)
+            except socket.error:
+                return
+            got[0] += 1
+            if unpack('!H', d[:2])[0] == PacketType.PING:
+                latencies.append(time() - unpack('!d', d[36:44])[0])
+
+    lps = [LoopingCall(offer), LoopingCall(ping), LoopingCall(drain)]
+    for lp, interval in zip(lps, (tick, 0.02, tick)):
+        lp.start(interval)
+
+    def done():
+        for lp in lps:
+            lp.stop()
+        sm.stop()
+        tx.close()
+        rx.close()
+        reactor.crash()
+    reactor.callLater(seconds, done)
+    reactor.run()
+    return pings, sorted(latencies), got[0], sm.dropped
+
+def report(name, pings, lat, got, dropped, target):
+    if lat:
+        p50 = lat[len(lat) // 2] * 1e3
+        p99 = lat[min(len(lat) - 1, len(lat) * 99 // 100)] * 1e3
+    else:
+        p50 = p99 = float('inf')
+    print '%-9s pings %4d/%-4d  p50 %7.1fms  p99 %7.1fms  data %6d  ' \
+          'dropped %6d  %s' % (name, len(lat), len(pings), p50, p99, got,
+                                dropped, 'ok' if p99 < target else 'OVER')
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    target = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    print 'link drains %d datagrams/s, offered %d, ping target %gms' % (
+                                                    rate, 2 * rate, target)
+    report('priority', *(run(seconds, rate, False) + (target,)))
+    report('fifo', *(run(seconds, rate, True) + (target,)))
@@ -0,0 +1,185 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# fair.py
+#
+# Fair queueing for outgoing data.  Each flow (a peer, and whether we're
+# relaying the packets for someone else or sending our own) gets its own
+# queue, and they take turns by deficit round robin: a flow sends up to
+# weight * QUANTUM bytes per round, so one busy peer can't starve the rest.
+# Flows can also have a token bucket that caps their rate.
+
+from collections import deque
+
+
+class TokenBucket(object):
+    '''Rate cap of rate bytes/s, with bursts of up to burst bytes.  Tokens
+    can go negative, so a packet bigger than the burst still goes (and the
+    ones after it wait longer).'''
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst=None, now=0.0):
+        self.rate = float(rate)
+        # 50ms worth, at least a couple of big packets
+        self.burst = float(burst or max(self.rate * 0.05, 3000))
+        self.tokens = self.burst
+        self.stamp = now
+
+    def fill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst,
+                                self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def ready(self, now):
+        '''Can something go now?'''
+        if self.tokens <= 0:
+            self.fill(now)
+        return self.tokens > 0
+
+    def take(self, size):
+        self.tokens -= size
+
+    def delay(self):
+        '''How long until ready (s), after a ready() that said no'''
+        return -self.tokens / self.rate + 0.001
+
+
+class Flow(object):
+    '''One queue in a FairQueue, and what it's sent and dropped'''
+    __slots__ = ('key', 'queue', 'bytes', 'deficit', 'quantum', 'bucket',
+                 'sent', 'sent_bytes', 'dropped', 'active')
+
+    def __init__(self, key, quantum, bucket=None):
+        self.key = key
+        self.queue = deque()
+        self.bytes = 0
+        self.deficit = 0
+        self.quantum = quantum
+        self.bucket = bucket
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.active = False
+
+
+class FairQueue(object):
+    '''
+    Deficit round robin over flows of (data, address).  next() picks the flow
+    whose head should go now, sent() takes it off once it has.  Past limit
+    datagrams in all, drop() takes them from the longest flow.
+    '''
+
+    QUANTUM = 1500 # bytes per round at weight 1
+
+    def __init__(self, limit=512, weight=None, bucket=None):
+        self.limit = limit
+        # key -> weight, and key -> TokenBucket or None, for new flows
+        self.weight = weight or (lambda key: 1.0)
+        self.bucket = bucket or (lambda key: None)
+        self.flows = {}
+        self.active = deque()
+        self.size = 0
+        # when next() comes up empty because of rate caps, how long to wait
+        self.wait = None
+
+    def __len__(self):
+        return self.size
+
+    def flow(self, key):
+        flow = self.flows.get(key)
+        if flow is None:
+            quantum = max(64, int(self.QUANTUM * self.weight(key)))
+            flow = self.flows[key] = Flow(key, quantum, self.bucket(key))
+        return flow
+
+    def push(self, key, item):
+        flow = self.flow(key)
+        flow.queue.append(item)
+        flow.bytes += len(item[0])
+        self.size += 1
+        if not flow.active:
+            flow.active = True
+            flow.deficit = 0
+            self.active.append(flow)
+
+    def next(self, now):
+        '''The flow to send from, or None if there's nothing or every flow
+        with something queued is over its rate (see wait)'''
+        active = self.active
+        self.wait = None
+        blocked = 0
+        while active:
+            flow = active[0]
+            bucket = flow.bucket
+            if bucket is not None and not bucket.ready(now):
+                active.rotate(-1)
+                blocked += 1
+                if blocked >= len(active):
+                    self.wait = min(f.bucket.delay() for f in active)
+                    return None
+                continue
+            blocked = 0
+            if flow.deficit < len(flow.queue[0][0]):
+                # its turn is over, more next round
+                flow.deficit += flow.quantum
+                active.rotate(-1)
+                continue
+            return flow
+        return None
+
+    def sent(self, flow):
+        '''flow's head went out'''
+        data, address = flow.queue.popleft()
+        size = len(data)
+        flow.deficit -= size
+        flow.bytes -= size
+        flow.sent += 1
+        flow.sent_bytes += size
+        self.size -= 1
+        if flow.bucket is not None:
+            flow.bucket.take(size)
+        if not flow.queue:
+            flow.active = False
+            flow.deficit = 0
+            self.active.remove(flow)
+
+    def drop(self, count):
+        '''Drop count datagrams, oldest first from the longest flows'''
+        for i in xrange(min(count, self.size)):
+            flow = max(self.active, key=lambda f: f.bytes)
+            data, address = flow.queue.popleft()
+            flow.bytes -= len(data)
+            flow.dropped += 1
+            self.size -= 1
+            if not flow.queue:
+                flow.active = False
+                flow.deficit = 0
+                self.active.remove(flow)
+
+    def forget(self, match):
+        '''Drop the (idle) flows whose key match(key) is true'''
+        for key in [k for k, f in self.flows.items()
+                        if not f.active and match(k)]:
+            del self.flows[key]
+
+    def clear(self):
+        for flow in self.active:
+            flow.queue.clear()
+            flow.bytes = 0
+            flow.active = False
+        self.active.clear()
+        self.size = 0
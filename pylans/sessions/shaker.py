@@ -0,0 +1,252 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# shaker.py
+#
+# Runs the JPAKE steps of handshakes (one, two, three: tens of ms each with
+# params_80, most of a second with params_128) away from the reactor, so a
+# burst of peers reconnecting doesn't stall packet forwarding.
+#
+# Steps go to a pool of worker processes (big number pow() holds the GIL, so
+# threads would stall the reactor about as much), or threads where there's
+# no fork.  The worker gets a copy of the JPAKE object and sends back what
+# the step changed in it with the result, which is copied into the original
+# (the handshake keeps its own flags on it meanwhile).
+#
+# One peer's steps run one at a time, in the order they were asked for (two
+# needs what one made, three what two made), and no more steps run at once
+# than there are workers, the rest wait their turn.
+#
+# Round one doesn't depend on the peer, so a Stock keeps a few JPAKE objects
+# that have already done it, made when the shaker has nothing else to do, and
+# a handshake that starts with one of those sends its first packet right away.
+
+from collections import deque
+from twisted.internet import reactor, defer, threads
+from twisted.internet.task import LoopingCall
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+import logging
+import os
+import signal
+import traceback
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+logger = logging.getLogger(__name__)
+
+# worker processes need fork (and multiprocessing)
+processes = multiprocessing is not None and hasattr(os, 'fork')
+
+# how much nicer than us the worker processes are
+NICE = 10
+
+
+def _init():
+    '''Worker process setup'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # forwarding comes first when cores are short
+    try:
+        os.nice(NICE)
+    except OSError:
+        pass
+
+class StepError(Exception):
+    '''A step that failed in a worker (or never came back from one)'''
+    pass
+
+def _step(j, step, args):
+    '''Run in a worker process: j.step(*args), and the attributes of j it
+    set.  A failure comes back as its traceback, as a string (not every
+    exception pickles, and one that doesn't would break the pool's result
+    handler for good).'''
+    before = dict(vars(j))
+    try:
+        result = getattr(j, step)(*args)
+    except Exception:
+        return False, None, traceback.format_exc()
+    changed = dict((k, v) for k, v in vars(j).iteritems()
+                                if k not in before or before[k] is not v)
+    return True, changed, result
+
+
+class Shaker(object):
+    '''
+    Runs JPAKE steps for handshakes in workers (or right here, with none or
+    before start), one at a time per peer and at most workers at once.  A
+    step that hasn't come back from a worker process in STEP_TIMEOUT
+    seconds (it died, say) fails, so its peer's queue and its worker slot
+    move on.
+    '''
+    STEP_TIMEOUT = 10
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._pool = None
+        self._threads = None
+        self._sem = defer.DeferredSemaphore(max(1, workers))
+        # peer id -> deque of (j, step, args, deferred), the first running
+        self._queues = {}
+
+    def start(self):
+        if self.workers <= 0:
+            return
+        if processes:
+            self._pool = multiprocessing.Pool(self.workers, _init)
+        else:
+            self._threads = ThreadPool(self.workers, self.workers,
+                                                            'Shaker')
+            self._threads.start()
+        logger.info('running handshakes in {0} {1}', self.workers,
+                        'processes' if processes else 'threads')
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        if self._threads is not None:
+            self._threads.stop()
+            self._threads = None
+
+    def run(self, key, j, step, *args):
+        '''j.step(*args) for peer key's handshake.  Returns a deferred
+        result, j is up to date by then.'''
+        d = defer.Deferred()
+        q = self._queues.get(key)
+        if q is None:
+            q = self._queues[key] = deque()
+        q.append((j, step, args, d))
+        if len(q) == 1:
+            self._next(key)
+        return d
+
+    def pending(self, key=None):
+        '''Steps waiting or running, for a peer or all of them'''
+        if key is not None:
+            return len(self._queues.get(key, ()))
+        return sum(len(q) for q in self._queues.itervalues())
+
+    def _next(self, key):
+        j, step, args, d = self._queues[key][0]
+        self._sem.run(self._call, j, step, args).addBoth(self._done, key)
+
+    def _done(self, result, key):
+        q = self._queues[key]
+        d = q.popleft()[3]
+        if q:
+            self._next(key)
+        else:
+            del self._queues[key]
+        # a Failure goes down the errbacks
+        d.callback(result)
+
+    def _call(self, j, step, args):
+        if self._pool is not None:
+            d = defer.Deferred()
+            def done(result):
+                reactor.callFromThread(self._unpack, d, j, result)
+            timeout = reactor.callLater(self.STEP_TIMEOUT, self._timeout, d,
+                                                                    step)
+            d.addBoth(self._cancel, timeout)
+            self._pool.apply_async(_step, (j, step, args), callback=done)
+            return d
+        elif self._threads is not None:
+            return threads.deferToThreadPool(reactor, self._threads,
+                                                getattr(j, step), *args)
+        return defer.maybeDeferred(getattr(j, step), *args)
+
+    def _unpack(self, d, j, result):
+        if d.called:
+            # timed out already
+            return
+        ok, state, value = result
+        if ok:
+            j.__dict__.update(state)
+            d.callback(value)
+        else:
+            d.errback(failure.Failure(StepError(value)))
+
+    def _timeout(self, d, step):
+        if not d.called:
+            logger.warning('handshake step {0} timed out in a worker', step)
+            d.errback(failure.Failure(StepError('{0} timed out'
+                                                            .format(step))))
+
+    def _cancel(self, result, timeout):
+        if timeout.active():
+            timeout.cancel()
+        return result
+
+
+class Stock(object):
+    '''
+    Up to size JPAKE objects from make() that have done round one, with
+    what one() gave, made through a shaker at most rate a second while it
+    has nothing else to run.
+    '''
+    def __init__(self, shaker, make, size=4, rate=2.0):
+        self.shaker = shaker
+        self.make = make
+        self.size = size
+        self.rate = rate
+        self._ready = deque()
+        self._making = False
+        self._lp = None
+
+    def __len__(self):
+        return len(self._ready)
+
+    def start(self):
+        if self.size <= 0 or self.rate <= 0:
+            return
+        self._lp = LoopingCall(self._fill)
+        self._lp.start(1.0 / self.rate)
+
+    def stop(self):
+        if self._lp is not None and self._lp.running:
+            self._lp.stop()
+        self._lp = None
+        self._ready.clear()
+
+    def take(self):
+        '''(j, j.one()) for a new handshake, or None if there are none
+        ready.  Each is only given out once.'''
+        if self._ready:
+            return self._ready.popleft()
+        return None
+
+    def _fill(self):
+        if self._making or len(self._ready) >= self.size \
+                                        or self.shaker.pending() > 0:
+            return
+        self._making = True
+        j = self.make()
+        d = self.shaker.run(self, j, 'one')
+        d.addCallbacks(self._made, self._failed, callbackArgs=(j,))
+
+    def _made(self, m1, j):
+        self._making = False
+        # (unless stopped meanwhile)
+        if self._lp is not None:
+            self._ready.append((j, m1))
+
+    def _failed(self, f):
+        self._making = False
+        logger.warning('making a handshake round one failed: {0}',
+                            f.getErrorMessage())
@@ -35,6 +35,7 @@ class SSLSessionManager(TCPSessionManager):
     def update_map(self, sid, addr):
         if isinstance(addr, protocol.SSLPeerProtocol):
             self.session_map[sid] = addr
+            self.router.drop_send_contexts(sid)
         else:
             raise ValueError, "session map stores ssl connections, not {0}"\
                                     .format(addr)
@@ -63,7 +64,7 @@ class SSLSessionManager(TCPSessionManager):
                 ssl.DefaultOpenSSLContextFactory('key.pem','cert.pem'))
         return self.port
         
-    def open(self, sid, session_key, relays=0):
+    def open(self, sid, session_key, relays=0, suite=None):
         if sid in self.shaking:
             addr = self.shaking[sid][2]
             # shouldn't be in shaking if not in connecting
@@ -73,13 +74,20 @@ class SSLSessionManager(TCPSessionManager):
             del self.connecting[addr]
             util.emit_async('session-opened', self, sid, relays)
             
-    def encode(self, sid, data):
+    def encode(self, sid, data, lane=0):
         if sid in self.session_map:
             return data
         else:
             logger.error("encode: sid not in session map")
             raise KeyError, "encode: sid not in session map"
         
+    def encoders(self, sid):
+        if sid in self.session_map:
+            return [lambda data: data]
+        else:
+            logger.error("encoders: sid not in session map")
+            raise KeyError, "encoders: sid not in session map"
+
     def decode(self, sid, data):
         if sid in self.session_map:
             return data
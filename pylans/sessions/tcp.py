@@ -18,7 +18,7 @@ from twisted.internet import reactor, defer
 import logging
 import struct
 
-from ..crypto import Crypter
+from ..crypto import suites
 from ..packets import PacketType
 from ..peers import PeerInfo
 from .. import util
@@ -98,6 +98,7 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
     def update_map(self, sid, addr):
         if isinstance(addr, protocol.TCPPeerProtocol):
             self.session_map[sid] = addr
+            self.router.drop_send_contexts(sid)
         else:
             raise ValueError, "session map stores tcp connections, not {0}".format(addr)
 
@@ -124,7 +125,7 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
             logger.info('connection timed out')
             self.connecting[address][2].transport.loseConnection()
 
-    def open(self, sid, session_key, relays=0):
+    def open(self, sid, session_key, relays=0, suite=suites.LEGACY):
         if sid in self.shaking:
             addr = self.shaking[sid][2]
             
@@ -138,8 +139,10 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
                 pself.send_handshake(sid, address, relays)
                 
             # create encryption option
-            obj = Crypter(session_key, callback=do_reset)
+            obj = suites.suites[suite](session_key, callback=do_reset,
+                                                ours=self.id, theirs=sid)
             self.session_objs[sid] = obj
+            self.session_suites[sid] = suite
             
             # update sid -> address map
             self.update_map(sid, self.connecting[addr][2])
@@ -200,23 +203,24 @@ class TCPSessionManager(SessionManager, protocol.TCPPeerFactory):
             logger.error("cannot send to sid not in session map")
             raise KeyError, "cannot send to sid not in session map"
             
-    def encode(self, sid, data):
+    def encode(self, sid, data, lane=0, ad=''):
+        # tap queues are UDP only, lane is always 0 here
         if isinstance(sid, PeerInfo):
             sid = sid.id
 
         if sid not in self.session_objs:
             logger.error('unknown session id: {0}'.format(sid.encode('hex')))
             raise KeyError, "unknown session id: {0}".format(sid.encode('hex'))
-        return self.session_objs[sid].encrypt(data)
+        return self.session_objs[sid].encrypt(data, ad)
 
-    def decode(self, sid, data):
+    def decode(self, sid, data, ad=''):
         if isinstance(sid, PeerInfo):
             sid = sid.id
 
         if sid not in self.session_objs:
             logger.error('unknown session id: {0}'.format(sid.encode('hex')))
             raise KeyError, "unknown session id: {0}".format(sid.encode('hex'))
-        return self.session_objs[sid].decrypt(data)
+        return self.session_objs[sid].decrypt(data, ad)
 
     def _get_proto_by_addr(self, addr):
         d = dict(((x.getPeer().host,x.getPeer().port),x) 
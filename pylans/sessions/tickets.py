@@ -0,0 +1,138 @@
+# Copyright (C) 2011  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# tickets.py
+#
+# The resumption tickets (see crypto.resume) we hold, by peer id.  A ticket
+# is good while its session is open and for ttl seconds after it closes, by
+# the wall clock so they can be saved and read back after a restart.  With
+# a path they are, a second after they change (so a reconnect storm writes
+# the file once, not once a peer), and readable by us only.
+
+from twisted.internet import reactor
+from binascii import hexlify, unhexlify
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Tickets(object):
+    '''
+    Resumption secrets by peer id, with whether the peer takes resumed
+    handshakes (we find out from its features, which we may not have when
+    it comes back)
+    '''
+    SAVE_DELAY = 1.0
+
+    def __init__(self, ttl, path=None):
+        self.ttl = ttl
+        self.path = path
+        # sid -> [secret, expires (None while its session is open),
+        #         resumable]
+        self._tickets = {}
+        self._save = None
+        if path is not None and ttl > 0:
+            self.load()
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def add(self, sid, secret, resumable=False):
+        '''Keep secret for resuming sid's (just opened) session'''
+        if self.ttl <= 0:
+            return
+        old = self._tickets.get(sid)
+        resumable = resumable or (old is not None and old[2])
+        self._tickets[sid] = [secret, None, resumable]
+        self._changed()
+
+    def closed(self, sid, resumable=False):
+        '''sid's session closed, its ticket has ttl seconds left'''
+        ticket = self._tickets.get(sid)
+        if ticket is not None and ticket[1] is None:
+            ticket[1] = time.time() + self.ttl
+            ticket[2] = ticket[2] or resumable
+            self._changed()
+
+    def get(self, sid):
+        '''(secret, resumable) for sid, or None if we have no ticket (or it
+        has run out)'''
+        ticket = self._tickets.get(sid)
+        if ticket is None:
+            return None
+        if ticket[1] is not None and ticket[1] < time.time():
+            del self._tickets[sid]
+            self._changed()
+            return None
+        return ticket[0], ticket[2]
+
+    def _changed(self):
+        if self.path is not None and self._save is None:
+            self._save = reactor.callLater(self.SAVE_DELAY, self.save)
+
+    def save(self):
+        '''Write the tickets to path (if there is one) now'''
+        if self._save is not None:
+            if self._save.active():
+                self._save.cancel()
+            self._save = None
+        if self.path is None:
+            return
+        now = time.time()
+        lines = []
+        for sid, (secret, expires, resumable) in self._tickets.items():
+            if expires is None or expires > now:
+                lines.append('{0} {1} {2} {3}\n'.format(hexlify(sid),
+                                hexlify(secret),
+                                '-' if expires is None else repr(expires),
+                                int(resumable)))
+        # they're as good as the network key, nobody else gets to read them
+        new = self.path + '.new'
+        try:
+            fd = os.open(new, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as f:
+                f.writelines(lines)
+            os.rename(new, self.path)
+        except (IOError, OSError), e:
+            logger.warning('could not save resumption tickets to {0}: {1}',
+                                self.path, e)
+
+    def load(self):
+        '''Read the tickets saved in path'''
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except (IOError, OSError), e:
+            logger.info('no resumption tickets from {0}: {1}', self.path, e)
+            return
+        now = time.time()
+        for line in lines:
+            try:
+                sid, secret, expires, resumable = line.split()
+                sid, secret = unhexlify(sid), unhexlify(secret)
+                # one that was open when we went down closed then
+                expires = now + self.ttl if expires == '-' \
+                                        else min(float(expires), now + self.ttl)
+                resumable = bool(int(resumable))
+            except (ValueError, TypeError):
+                logger.warning('bad line in {0}: {1!r}', self.path, line)
+                continue
+            if expires > now:
+                self._tickets[sid] = [secret, expires, resumable]
+        logger.info('{0} resumption tickets from {1}', len(self._tickets),
+                                                                self.path)
@@ -0,0 +1,179 @@
+
+import unittest
+import os
+from collections import OrderedDict
+from struct import pack, unpack
+from pylans import bench_router
+from pylans import compress
+from pylans.router import SendContext, FecSendContext, _FRAGMENT, \
+     _COMPRESSED
+from pylans.crypto import suites, AuthenticationError
+from pylans.mods import fec, neighbours
+from pylans.util import event
+
+def router():
+    '''A bench router talking to itself over an authenticated suite, with
+    what it sends and delivers'''
+    sid = os.urandom(16)
+    r = bench_router.router(sid)
+    r.pm._self.id = sid
+    r._fragments = OrderedDict()
+    r._fragment_bytes = 0
+    cls = suites.suites['aes256-ctr-hmac']
+    r.sm.crypter = cls(os.urandom(cls.key_size), ours=sid, theirs=sid)
+    wire, delivered = [], []
+    r.sm.send = lambda data, sid, address: wire.append(data)
+    r.recv_packet = lambda packet, src, address: delivered.append(packet)
+    r.compressor = lambda sid: compress.Compressor('zlib', 16)
+    return r, SendContext(r, (('127.0.0.1', 8015), sid)), wire, delivered
+
+def retype(data, type=None, id=None):
+    '''data with its header's type or id changed'''
+    t, i = unpack('!2H', data[:4])
+    return pack('!2H', t if type is None else type,
+                       i if id is None else id) + data[4:]
+
+class Compressed(unittest.TestCase):
+    # whether a payload is compressed is in the header, which the suite
+    # authenticates, so it can't be flipped on the way
+    frame = 'm' * 6 + 'z' * 900
+    noise = 'm' * 6 + os.urandom(900)
+    # compresses to more than a piece
+    text = 'm' * 6 + ''.join(str(i) for i in range(700))
+
+    def test_bit(self):
+        r, ctx, wire, delivered = router()
+        ctx(self.frame)
+        ctx(self.noise)
+        zdata, data = wire
+        self.failUnless(unpack('!H', zdata[:2])[0] & _COMPRESSED)
+        self.failIf(unpack('!H', data[:2])[0] & _COMPRESSED)
+        for bad in (retype(zdata, unpack('!H', zdata[:2])[0] ^ _COMPRESSED),
+                    retype(data, unpack('!H', data[:2])[0] ^ _COMPRESSED)):
+            self.failUnlessRaises(AuthenticationError, r.recv, bad, None)
+        self.failUnlessEqual(delivered, [])
+        r.recv(zdata, None)
+        r.recv(data, None)
+        self.failUnlessEqual(delivered, [self.frame, self.noise])
+
+    def test_fragments(self):
+        for frame, compressed in ((self.text, True), (self.noise, False)):
+            r, ctx, wire, delivered = router()
+            ctx.limit = 300
+            ctx(frame)
+            self.failUnless(len(wire) > 1)
+            for data in wire:
+                self.failUnlessEqual(unpack('!2H', data[:4]), (_FRAGMENT,
+                                        _COMPRESSED if compressed else 0))
+            flag = 0 if compressed else _COMPRESSED
+            for data in wire[:-1]:
+                r.recv(retype(data, id=flag), None)
+            self.failUnlessRaises(AuthenticationError, r.recv,
+                                  retype(wire[-1], id=flag), None)
+            for data in wire:
+                r.recv(data, None)
+            self.failUnlessEqual(delivered, [frame])
+
+class _Network(object):
+    name = 'test_router'
+
+class Fec(unittest.TestCase):
+    def setUp(self):
+        self.r, ctx, self.wire, self.delivered = router()
+        self.r.network = _Network()
+        self.r.fec = fec.FEC(self.r)
+        self.r.fec.groups[ctx.sid] = 3
+        ctx = FecSendContext(self.r, (ctx.address, ctx.sid))
+        self.frames = ['m' * 6 + os.urandom(n) for n in (100, 110, 105)]
+        for frame in self.frames:
+            ctx(frame)
+        ctx.sender.flush()
+        self.a, self.b, self.c, self.parity = self.wire
+
+    def test_rebuild(self):
+        for data in (self.a, self.c, self.parity, self.b):
+            self.r.recv(data, None)
+        self.failUnlessEqual(sorted(self.delivered), sorted(self.frames))
+        self.failUnlessEqual(self.r.fec.recovered, 1)
+
+    def test_spoofed_parity(self):
+        # rebuilds garbage for b, which mustn't stand in for the real one
+        self.r.recv(self.a, None)
+        self.r.recv(self.c, None)
+        first = fec._parity.unpack_from(self.parity, 36)[0]
+        size = len(self.b) - 36
+        self.r.fec.handle_parity(None, fec._parity.pack(first, 3, 0,
+                        (len(self.a) - 36) ^ size ^ (len(self.c) - 36))
+                        + os.urandom(size), None, self.a[20:36])
+        self.failUnlessEqual(self.r.fec.recovered, 0)
+        self.r.recv(self.b, None)
+        self.failUnlessEqual(sorted(self.delivered), sorted(self.frames))
+
+    def test_short_parity(self):
+        for n in range(fec._parity.size):
+            self.r.fec.handle_parity(None, self.parity[36:36 + n], None,
+                                     self.a[20:36])
+        self.failUnlessEqual(self.delivered, [])
+
+class _Peer(object):
+    def __init__(self, n):
+        self.id, self.addr, self.vip = chr(n) * 16, '\x02' + chr(n) * 5, \
+                                        '\x0a\x00\x00' + chr(n)
+
+class _PeerManager(object):
+    def __init__(self, peers):
+        self.peer_list = dict((p.id, p) for p in peers)
+
+class _TapRouter(object):
+    def __init__(self, peers):
+        self.pm = _PeerManager(peers)
+        self.addr_map = dict((p.addr, p.id) for p in peers)
+
+class Neighbours(unittest.TestCase):
+    ip = '\x20\x01' + '\x00' * 13 + '\x01'
+
+    def setUp(self):
+        self.a, self.b = _Peer(1), _Peer(2)
+        self.r = _TapRouter([self.a, self.b])
+        self.nb = neighbours.NeighbourProxy(self.r, max_age=60, max_learned=2)
+
+    def solicit(self, mac, src):
+        return ('\x33\x33\xff\x00\x00\x01' + mac + '\x86\xdd'
+                    + '\x60\x00\x00\x00\x00\x20\x3a\xff' + src
+                    + '\xff\x02' + '\x00' * 14 + '\x87\x00\x00\x00'
+                    + '\x00' * 4 + self.ip)
+
+    def test_learn(self):
+        # b can't claim an address for a by sending from a's mac
+        self.nb.learn(self.b, self.solicit(self.a.addr, self.ip))
+        self.nb.learn(None, self.solicit(self.a.addr, self.ip))
+        self.failUnlessEqual(self.nb._mac_for_ip6(self.ip), None)
+        self.nb.learn(self.a, self.solicit(self.a.addr, self.ip))
+        self.failUnlessEqual(self.nb._mac_for_ip6(self.ip), self.a.addr)
+
+    def test_age(self):
+        for n in range(4):
+            self.nb.learn(self.a, self.solicit(self.a.addr,
+                                               self.ip[:-1] + chr(n)))
+        self.failUnlessEqual(len(self.nb.learned), 2)
+        self.nb.learned[self.ip[:-1] + '\x03'][1] -= 61
+        self.failUnlessEqual(self.nb._mac_for_ip6(self.ip[:-1] + '\x03'), None)
+        self.failUnlessEqual(self.nb._mac_for_ip6(self.ip[:-1] + '\x02'),
+                             self.a.addr)
+
+    def test_vip(self):
+        pm, a, b = self.r.pm, self.a, self.b
+        self.failUnlessEqual(self.nb._mac_for_ip(a.vip), a.addr)
+        c = _Peer(3)
+        self.r.addr_map[c.addr] = c.id
+        event.emit('peer-added', pm, c)
+        self.failUnlessEqual(self.nb._mac_for_ip(c.vip), c.addr)
+        old, a.vip = a.vip, c.vip[:3] + '\x09'
+        event.emit('peer-changed', pm, a)
+        self.failUnlessEqual(self.nb._mac_for_ip(old), None)
+        self.failUnlessEqual(self.nb._mac_for_ip(a.vip), a.addr)
+        event.emit('peer-removed', pm, b)
+        self.failUnlessEqual(self.nb._mac_for_ip(b.vip), None)
+
+if __name__ == '__main__':
+    unittest.main()
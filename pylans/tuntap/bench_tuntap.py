@@ -0,0 +1,106 @@
+# Copyright (C) 2010  Brian Parma (execrable@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# bench_tuntap.py
+#
+# Measure how many frames/sec we can pull off a linux TAP device, one read
+# per select() wakeup (the old doRead) vs. draining in batches (read_batch).
+# Needs root.  Child processes flood the TAP subnet broadcast address with
+# UDP, which the kernel hands straight to the device (no ARP needed).
+#
+# usage: python -m pylans.tuntap.bench_tuntap [frames] [size] [budget ...]
+
+import os
+import select
+import socket
+import subprocess as sp
+import sys
+from multiprocessing import Process
+from time import time
+
+from .linux import TunTapLinux
+
+ADDR = '10.213.0.1/24'
+BCAST = '10.213.0.255'
+PORT = 9
+SENDERS = 2
+
+# devices get closed atexit, keep them alive until then
+_devices = []
+
+def flood(n, size):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    data = os.urandom(size)
+    for i in xrange(n):
+        try:
+            s.sendto(data, (BCAST, PORT))
+        except socket.error:
+            pass # ENOBUFS, just keep going
+
+def run(n, size, budget):
+    t = TunTapLinux(nonblock=budget > 0)
+    _devices.append(t)
+    try:
+        sp.check_call(['ip', 'addr', 'add', ADDR, 'dev', t.ifname])
+        sp.check_call(['ip', 'link', 'set', t.ifname, 'up'])
+
+        fd = t.fileno()
+        got = 0
+        wakeups = 0
+        first = last = None
+
+        ps = [Process(target=flood, args=(n // SENDERS, size))
+                                            for i in range(SENDERS)]
+        for p in ps:
+            p.start()
+        while True:
+            r = select.select([fd], [], [], 1.0)[0]
+            if not r:
+                break # sender is done and device is drained
+            wakeups += 1
+            if budget > 0:
+                k = len(t.read_batch(budget))
+            else:
+                t.read()
+                k = 1
+            if k:
+                last = time()
+                if first is None:
+                    first = last
+                got += k
+        for p in ps:
+            p.join()
+    finally:
+        sp.call(['ip', 'link', 'set', t.ifname, 'down'])
+
+    dt = (last - first) if got > 1 else 0
+    return got, wakeups, dt
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    budgets = [int(x) for x in sys.argv[3:]] or [0, 8, 32, 64]
+
+    for budget in budgets:
+        got, wakeups, dt = run(n, size, budget)
+        name = 'batch %d' % budget if budget > 0 else 'single'
+        print '%-10s %8d frames %8d wakeups %5.2f frames/wakeup' % (name,
+                                        got, wakeups, got/float(wakeups or 1)),
+        if dt > 0:
+            print '%10.0f frames/s' % (got / dt)
+        else:
+            print
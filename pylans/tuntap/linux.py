@@ -1,5 +1,6 @@
 from fcntl import ioctl
 import atexit
+import errno
 import os
 import subprocess as sp
 import struct
@@ -14,6 +15,7 @@ logger = logging.getLogger(__name__)
 IFF_TUN   = 0x0001
 IFF_TAP   = 0x0002
 IFF_NO_PI = 0x1000
+IFF_MULTI_QUEUE = 0x0100
 
 SIOCGIFHWADDR = 0x8927
 SIOCGIFMTU = 0x8921
@@ -30,12 +32,16 @@ class TunTapLinux(TunTapBase):
     TAPMODE = IFF_TAP
 
 
-    def __init__(self, mode="TAP", name=None, dev='/dev/net/tun'):
+    def __init__(self, mode="TAP", name=None, dev='/dev/net/tun',
+                    nonblock=False, queues=1):
     
         # open tun/tap device controller
-        # for some reason NONBLOCK is a lot slower
-#        f = os.open(dev, os.O_RDWR|os.O_NONBLOCK)
-        f = os.open(dev, os.O_RDWR)
+        # NONBLOCK is only a win if we drain the device with read_batch,
+        # one read per wakeup is a lot slower than blocking mode
+        oflags = os.O_RDWR
+        if nonblock:
+            oflags |= os.O_NONBLOCK
+        f = os.open(dev, oflags)
         
 
         # check mode, should come in as 'TUN' or 'TAP'
@@ -50,18 +56,34 @@ class TunTapLinux(TunTapBase):
         elif not name.endswith('%d'):
             name = name + '%d'
 
+        flags = mode|IFF_NO_PI
+        if queues > 1:
+            flags |= IFF_MULTI_QUEUE
+
         # ioctl call to create adapter, retuns adapter name
-        ifs = ioctl(f, TUNSETIFF, struct.pack("16sH", name, 
-                                                    mode|IFF_NO_PI))
+        ifs = ioctl(f, TUNSETIFF, struct.pack("16sH", name, flags))
 
         # get iface name
         self.ifname = ifs[:16].strip("\x00")
 
         logger.info('opened tun device as interface {0}'.format(self.ifname))
 
+        # attach the other queues to the same interface, the kernel spreads
+        # frames across them by flow hash
+        self._queues = [f]
+        for i in range(1, queues):
+            q = os.open(dev, oflags)
+            ioctl(q, TUNSETIFF, struct.pack("16sH", self.ifname, flags))
+            self._queues.append(q)
+
+        if queues > 1:
+            logger.info('attached {0} queues to interface {1}'
+                            .format(queues, self.ifname))
+
         self._f = f
 #        self._file = os.fdopen(f)
         self.mode = mode
+        self.nonblock = nonblock
         self.mtu = 1500 # default mtu
 
         # close device on exit (use weakref to prevent keeping this object from gc)
@@ -74,7 +96,8 @@ class TunTapLinux(TunTapBase):
     def close(self):
         '''Make sure device is closed.'''
         logger.info('closing tun device {0}'.format(self.ifname))
-        os.close(self._f)
+        for q in self._queues:
+            os.close(q)
 
     def start(self):
         '''Start monitoring tun/tap for input'''
@@ -172,6 +195,24 @@ class TunTapLinux(TunTapBase):
 #        return self._file.read()
         return os.read(self._f, size) #TODO wat is max size, what should it be?
 
+    def read_batch(self, budget, size=1024*10, queue=0):
+        '''
+            Drain up to budget frames from the tun/tap 'wire'.  Stops early
+            when the device would block, so it needs a non-blocking device
+            (otherwise it only returns after budget frames came in).
+        '''
+        batch = []
+        ap = batch.append
+        read = os.read
+        f = self._queues[queue]
+        try:
+            while len(batch) < budget:
+                ap(read(f, size))
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return batch
+
     def write(self, data):
         '''
             Write some data out to the tun/tap 'wire'.
@@ -183,3 +224,8 @@ class TunTapLinux(TunTapBase):
         select() our stream.'''
         return self._f
 
+    @property
+    def queues(self):
+        '''Number of queues attached to the interface'''
+        return len(self._queues)
+
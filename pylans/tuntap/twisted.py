@@ -4,6 +4,7 @@ from twisted.internet.interfaces import IReadDescriptor
 from twisted.internet.threads import deferToThread
 from zope.interface import implements
 import logging
+import select
 from . import util
 
 logger = logging.getLogger(__name__)
@@ -38,27 +39,80 @@ class TwistedTTL(TunTapLinux):
     # so it can be used in twisted's main loop
     implements(IReadDescriptor)
 
-    def __init__(self, callback, **kwargs):
+    def __init__(self, callback, batch_callback=None, batch_size=0,
+                    queue_callback=None, **kwargs):
         '''
             initialize tun/tap device.
 
             callback(data) - function that gets called with data when something is
             read on the tun/tap wire.
+
+            batch_callback(list) - if given with a batch_size > 1, the device
+            is opened non-blocking and drained of up to batch_size frames per
+            reactor wakeup, which are passed to this as a list.
+
+            queue_callback(list, queue) - with queues > 1, queue 0 stays on
+            the reactor and every other queue gets its own worker thread,
+            which calls this (in that thread) with each batch it reads.
         '''
         self.callback = callback
+        self.batch_callback = batch_callback
+        self.batch_size = batch_size
+        self.queue_callback = queue_callback
+        self._running = False
+
+        if kwargs.get('queues', 1) > 1:
+            if queue_callback is None or batch_callback is None:
+                raise ValueError('multi-queue mode needs batch and queue '
+                                 'callbacks')
+            kwargs['nonblock'] = True
+            self.batch_size = max(batch_size, 1)
+        elif batch_callback is not None and batch_size > 1:
+            kwargs['nonblock'] = True
+        else:
+            self.batch_size = 0
+
         super(TwistedTTL, self).__init__(**kwargs)
 
     def start(self):
         '''Start monitoring tun/tap for input'''
         # add to twisted mainloop
         reactor.addReader(self)
+
+        # the rest of the queues get a thread each
+        self._running = True
+        for q in range(1, self.queues):
+            self._run_queue(q)
+
         logger.info('linux tun/tap started')
 
     def stop(self):
         '''Stop monitoring tun/tap for input'''
         reactor.removeReader(self)
+        self._running = False
         logger.info('linux tun/tap stopped')
 
+    @util.threaded
+    def _run_queue(self, q):
+        '''Worker loop owning queue q, runs in its own thread.'''
+        fd = self._queues[q]
+        budget = self.batch_size
+        read_batch = self.read_batch
+        callback = self.queue_callback
+        logger.info('tun/tap queue {0} worker started', q)
+        while self._running:
+            # timeout so we notice stop()
+            if not select.select([fd], [], [], 1.0)[0]:
+                continue
+            try:
+                batch = read_batch(budget, queue=q)
+                if batch:
+                    callback(batch, q)
+            except Exception:
+                logger.error('tun/tap queue {0} worker failed', q, 
+                                                    exc_info=True)
+        logger.info('tun/tap queue {0} worker stopped', q)
+
     def _shell(self, cmd):
         '''function for calling something through the shell'''
         return utils.getProcessValue(cmd[0],cmd[1:])
@@ -122,8 +176,13 @@ class TwistedTTL(TunTapLinux):
         '''
             New data is coming in on the tun/tap 'wire'.  Called by twisted.
         '''
-        data = self.read()
-        self.callback(data)
+        if self.batch_size:
+            batch = self.read_batch(self.batch_size)
+            if batch:
+                self.batch_callback(batch)
+        else:
+            data = self.read()
+            self.callback(data)
 
     def doWrite(self, data):
         '''
@@ -162,7 +221,10 @@ class TwistedTTW(TunTapWindows):
         in select().  Instead, we have to create a thread that polls the device
         and returns data when it's available.
     '''
-    def __init__(self, callback, **kwargs):
+    def __init__(self, callback, batch_callback=None, batch_size=0,
+                    queue_callback=None, queues=1, **kwargs):
+        # the polling thread hands frames over one at a time, so batching
+        # and multiple queues don't apply here
         self.callback = callback
         self._running = False
         super(TwistedTTW, self).__init__(**kwargs)
@@ -97,6 +97,24 @@ def ip_ltoa(ip_long):
     '''
     ipn = pack('!L',ip_long)
     return decode_ip(ipn)
+
+# (network, mask) of rfc1918, link-local and loopback ranges
+_PRIVATE_NETS = [(ip_atol(net), ((1<<bits)-1) << (32-bits)) for net, bits in
+                    [('10.0.0.0', 8), ('172.16.0.0', 12), ('192.168.0.0', 16),
+                     ('169.254.0.0', 16), ('127.0.0.0', 8)]]
+
+def is_private_ip(ip_str):
+    '''True for a LAN (private, link-local or loopback) IP, False for anything
+    else (including hostnames)
+
+    >>> is_private_ip('192.168.1.20'), is_private_ip('172.32.0.1')
+    (True, False)
+    '''
+    try:
+        ip = ip_atol(ip_str)
+    except socket.error:
+        return False
+    return any(ip & mask == net for net, mask in _PRIVATE_NETS)
     
 def ip_to_net_host_subnet(addr_str, mask=None):
     '''Takes an address in either 'X.X.X.X/Mask' or with mask passed separately,
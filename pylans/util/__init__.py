@@ -37,6 +37,7 @@ from ..tuntap.util import (
     threaded,
     ip_atol,
     ip_ltoa,
+    is_private_ip,
     ip_to_net_host_subnet,
     get_weakref_proxy,
     get_weakref